@@ -65,6 +65,7 @@ async def main():
 
     updatable_ble_peripheral, (mem_free_char, mem_alloc_char, gc_collect_char) \
     = utils.get_updatable_ble_peripheral()
+    utils.confirm_firmware_update()
 
     await asyncio.gather(
         updatable_ble_peripheral.run_advertising(),
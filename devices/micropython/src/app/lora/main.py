@@ -50,6 +50,9 @@ async def main():
     """
     lora_node = utils.get_updatable_lora_node()
     lora_node.set_callback(on_message_callback)
+    # El arranque se confirma con el nodo ya inicializado, sin esperar a que responda el
+    # gateway (con el ciclo de trabajo de LoRa la conexión puede tardar minutos)
+    utils.confirm_firmware_update()
     await asyncio_gather(
         lora_node.connect(),
         lora_node.listen(),
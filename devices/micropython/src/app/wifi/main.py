@@ -101,4 +101,5 @@ if __name__ == "__main__":
     log.info("Iniciando programa principal")
     client.connect()
     log.info("Conexión establecida con la plataforma Thingsboard")
+    utils.confirm_firmware_update()
     asyncio.run(main())
@@ -1,13 +1,15 @@
 """
 Script de inicio para un dispositivo Micropython genérico.
 Establece conexión con la red y, en caso de encontrar un paquete de actualización
-OTA, lo intenta instalar, informando a Thingsboard del resultado.
+OTA, lo intenta instalar, informando a Thingsboard del resultado. Si el firmware
+instalado en el arranque anterior no llegó a confirmar que funciona, restaura la
+versión previa.
 """
 
 import utils
 from gc import collect as gc_collect
 from sys import print_exception as sys_print_exception
-from thingsboard_ota_helpers.ota_installer import OTAInstaller
+from thingsboard_ota_helpers.ota_installer import OTAInstaller, TRIAL_STATE, COMMITTING_STATE
 
 def main():
 
@@ -16,8 +18,6 @@ def main():
 
     # Información inicial
     log.info("Iniciando dispositivo")
-    current_fw_metadata = utils.read_firmware_metadata()
-    log.info(f"Versión actual de firmware: {current_fw_metadata['title']}({current_fw_metadata['version']})")
 
     # Se descubre el tipo de conectividad configurada y sus parámetros
     connectivity_config = utils.read_config_file('connectivity.json')
@@ -28,10 +28,41 @@ def main():
         wifi_params = utils.read_config_file(connectivity_config['config_filename'])
         utils.network_connect(wifi_params)
 
-    # Se comprueba si hay un nuevo paquete de actualización disponible. Si no es el caso,
-    # se continua con el programa principal
     ota_config = utils.read_config_file('ota_config.json')
     ota_package_filename = ota_config['tmp_filename']
+    utils.get_custom_logger("ota_installer")
+    ota_installer = OTAInstaller(
+        ota_package_filename, quiet=False,
+        buffer_size=ota_config.get('extraction_buffer_size', OTAInstaller.BUFFER_SIZE),
+        rollback=ota_config.get('rollback', False)
+    )
+
+    # Si la última instalación quedó a medias o el firmware instalado no confirmó su
+    # arranque, se vuelve a la versión anterior
+    restored_state = ota_installer.restore_previous_firmware()
+    if restored_state == TRIAL_STATE:
+        restored_fw_metadata = utils.read_firmware_metadata()
+        error_msg = "El nuevo firmware no ha confirmado su arranque. Restaurada la versión " + \
+            f"anterior: {restored_fw_metadata['title']}({restored_fw_metadata['version']})"
+        log.error(error_msg)
+        try:
+            # Por si no se llegó a eliminar el paquete que ha fallado
+            ota_installer.delete_ota_package()
+        except OSError:
+            pass
+        ota_reporter = utils.OTAReporter(connection_type)
+        ota_reporter.report_failure(error_msg)
+        ota_reporter.close_connection()
+        return
+    elif restored_state == COMMITTING_STATE:
+        log.warning("Instalación interrumpida. Restaurada la versión anterior del firmware")
+
+    # Firmware actual (ya restaurado, si hacía falta)
+    current_fw_metadata = utils.read_firmware_metadata()
+    log.info(f"Versión actual de firmware: {current_fw_metadata['title']}({current_fw_metadata['version']})")
+
+    # Se comprueba si hay un nuevo paquete de actualización disponible. Si no es el caso,
+    # se continua con el programa principal
     ota_package_file = None
     try:
         ota_package_file = open(ota_package_filename, 'rb')
@@ -41,21 +72,14 @@ def main():
             "Continuando con el programa principal.")
         return
 
-    # Se procede a instalar el paquete de firmware y se reporta el resultado
-    utils.get_custom_logger("ota_installer")
-    ota_installer = OTAInstaller(ota_package_filename, quiet=False)
-
     # Obtención de un OTAReporter para informar del resultado de la actualización
     ota_reporter = utils.OTAReporter(connection_type)
 
 
     log.info(f"Instalando nuevo paquete de actualización OTA \"{ota_package_filename}\"")
     try:
-        log.debug("Comprobando formato TAR GZ")
-        ota_installer.check_tar_gz_format()
-        log.debug("Comprobando que los metadatos del paquete coinciden con los esperados")
-        ota_installer.check_metadata_in_package()
-        log.debug("Instalando firmware sobre el sistema de ficheros")
+        # Formato, metadatos y extracción en una sola pasada sobre el paquete
+        log.debug("Comprobando e instalando firmware sobre el sistema de ficheros")
         ota_installer.install_firmware(
             ota_config['excluded_files'],
             ota_config['clear_filesystem']
@@ -69,13 +93,34 @@ def main():
         log.info(f"Nueva versión de firmware: {new_fw_title}({new_fw_version})")
         gc_collect()
         ota_reporter.report_succes(new_fw_title, new_fw_version)
+        if ota_installer.rollback:
+            # El programa principal tiene que confirmar el arranque (utils.confirm_firmware_update).
+            # El plazo empieza a contar una vez reportado el éxito de la instalación
+            ota_installer.start_health_check(
+                ota_config.get('health_check_timeout_s', 120),
+                ota_config.get('health_check_timer_id', 0)
+            )
 
     except Exception as e:
         error_msg = "Excepción producida durante la instalación del paquete de OTA: " + \
             f"({type(e).__name__}) {e}"
         log.error(error_msg)
         sys_print_exception(e)
+        restored_state = None
+        if ota_installer.rollback:
+            # No se deja el sistema de ficheros a medio instalar: se vuelve a la versión
+            # anterior y se descarta el paquete, para no repetir la instalación fallida
+            restored_state = ota_installer.restore_previous_firmware()
+            try:
+                ota_installer.delete_ota_package()
+            except OSError:
+                pass
         ota_reporter.report_failure(error_msg)
+        if restored_state is not None:
+            log.warning("Restaurada la versión anterior del firmware. Reiniciando")
+            ota_reporter.close_connection()
+            from machine import reset as machine_reset
+            machine_reset()
 
     finally:
         ota_reporter.close_connection()
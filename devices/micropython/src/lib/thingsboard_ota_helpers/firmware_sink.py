@@ -0,0 +1,131 @@
+"""
+Escritura en flash del paquete de firmware a medida que se recibe.
+
+El paquete se escribe en un fichero temporal (<fw_filename>.part) a través de un buffer
+reutilizable y su SHA-256 se calcula sobre la marcha, de modo que el tamaño del paquete
+no está limitado por la memoria RAM libre. Solo si el checksum es correcto, el fichero
+temporal se renombra a <fw_filename>, que es el que boot.py instala tras el reinicio.
+
+Los datos pueden llegar en orden (write) o cada fragmento en su offset (write_at, para
+LoRa). En el segundo caso el hash avanza sobre el tramo inicial contiguo ya recibido:
+lo recibido en orden se incluye directamente y lo que llega tras un hueco se vuelve a
+leer del fichero cuando se completa el hueco (hash_up_to).
+"""
+
+import logging
+from hashlib import sha256
+from os import remove as os_remove, rename as os_rename
+
+log = logging.getLogger("firmware_sink")
+PART_SUFFIX = ".part"
+
+
+class FirmwareSink():
+
+    BUFFER_SIZE = 1024
+
+    def __init__(self, fw_filename, fw_size, buffer_size=BUFFER_SIZE):
+        """
+        Parámetros:
+            fw_filename: fichero donde quedará el paquete una vez verificado
+            fw_size: tamaño esperado del paquete (bytes)
+            buffer_size: tamaño del buffer de escritura y de relectura
+        """
+        self.fw_filename = fw_filename
+        self.fw_size = fw_size
+        self.bytes_written = 0 # Bytes recibidos en orden (write)
+        self._part_filename = fw_filename + PART_SUFFIX
+        self._file = open(self._part_filename, "w+b")
+        self._hash = sha256()
+        self.hashed = 0 # Bytes iniciales (contiguos) incluidos en el hash
+        self._buffer = bytearray(buffer_size)
+        self._buffered = 0
+
+
+    def _flush(self):
+        if self._buffered:
+            self._file.write(memoryview(self._buffer)[:self._buffered])
+            self._buffered = 0
+
+
+    def write(self, data):
+        """
+        Añade datos a continuación de los anteriores.
+        """
+        self._hash.update(data)
+        self.hashed += len(data)
+        self.bytes_written += len(data)
+        data = memoryview(data)
+        while data:
+            chunk = min(len(data), len(self._buffer) - self._buffered)
+            self._buffer[self._buffered : self._buffered + chunk] = data[:chunk]
+            self._buffered += chunk
+            data = data[chunk:]
+            if self._buffered == len(self._buffer):
+                self._flush()
+
+
+    def write_at(self, offset, data):
+        """
+        Escribe datos en su posición dentro del paquete, en cualquier orden.
+        """
+        self._flush()
+        self._file.seek(offset)
+        self._file.write(data)
+        if offset == self.hashed:
+            self._hash.update(data)
+            self.hashed += len(data)
+
+
+    def hash_up_to(self, end):
+        """
+        Incluye en el hash los datos hasta end, que deben haberse recibido todos.
+        """
+        self._flush()
+        if self.hashed >= end:
+            return
+        self._file.seek(self.hashed)
+        buffer = memoryview(self._buffer)
+        while self.hashed < end:
+            read = self._file.readinto(buffer[: min(len(buffer), end - self.hashed)])
+            if not read:
+                raise OSError("Fichero de firmware incompleto")
+            self._hash.update(buffer[:read])
+            self.hashed += read
+
+
+    def read_at(self, offset, size) -> bytes:
+        self._flush()
+        self._file.seek(offset)
+        return self._file.read(size)
+
+
+    def finish(self, checksum_alg, checksum) -> bool:
+        """
+        Completa el paquete y lo verifica. Si el checksum coincide, el paquete queda en
+        fw_filename; si no, se elimina.
+        """
+        self.hash_up_to(self.fw_size)
+        self._file.close()
+        checksum_of_received_firmware = None
+        if checksum_alg.lower() == "sha256":
+            checksum_of_received_firmware = "".join(["%.2x" % i for i in self._hash.digest()])
+        else:
+            log.error("Algoritmo de checksum no soportado (solo SHA256)")
+        log.debug(f"Checksum del firmware recibido: {checksum_of_received_firmware}")
+        if checksum_of_received_firmware != checksum:
+            os_remove(self._part_filename)
+            return False
+        os_rename(self._part_filename, self.fw_filename)
+        return True
+
+
+    def abort(self):
+        """
+        Descarta el paquete recibido hasta el momento.
+        """
+        self._file.close()
+        try:
+            os_remove(self._part_filename)
+        except OSError:
+            pass
@@ -0,0 +1,29 @@
+"""
+Reconstrucción de fragmentos de firmware con las tramas de paridad de las transferencias
+LoRa a grupos.
+
+Una trama de paridad lleva el XOR de count fragmentos consecutivos de su mismo tamaño (el
+último del paquete, completado con ceros si es más corto). Si a un nodo le falta uno solo
+de ellos, el XOR de la paridad con los demás es el fragmento que falta.
+"""
+
+
+def parity_fragment_starts(offset, size, count, fw_size):
+    """
+    Offsets de los fragmentos que cubre una trama de paridad de size bytes que empieza en
+    offset, sin contar los que quedarían más allá del final del paquete.
+    """
+    return [offset + i * size for i in range(count) if offset + i * size < fw_size]
+
+
+def recover_fragment(parity, fragments):
+    """
+    Retorna el fragmento que falta (con el tamaño de la paridad) a partir de la paridad y
+    de los demás fragmentos que cubre, que pueden ir llegando uno a uno (p.ej. leídos del
+    fichero de firmware) para no tenerlos todos en memoria.
+    """
+    recovered = bytearray(parity)
+    for data in fragments:
+        for i in range(len(data)):
+            recovered[i] ^= data[i]
+    return recovered
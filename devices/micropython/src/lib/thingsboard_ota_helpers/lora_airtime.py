@@ -0,0 +1,62 @@
+"""
+Tiempo en el aire de las tramas LoRa y presupuesto de ciclo de trabajo (banda de 868 MHz).
+
+El presupuesto se lleva con un cubo de fichas que se recarga a razón de duty_cycle ms de
+transmisión por ms, hasta un máximo de duty_cycle * window_ms. Se puede transmitir
+mientras el saldo no sea negativo; el tiempo en el aire de cada trama se descuenta
+después, de modo que la ocupación media del canal nunca supera el límite legal.
+"""
+
+from asyncio import sleep_ms as asyncio_sleep_ms
+from time import ticks_ms, ticks_diff
+
+
+def time_on_air_ms(payload_len, lora_cfg):
+    """
+    Tiempo en el aire (ms) de una trama de payload_len bytes con la configuración de
+    radio indicada (claves "sf", "bw", "coding_rate", "preamble_len" y "crc_en" del
+    fichero lora_config.json), según la fórmula de la hoja de datos del SX1276.
+    """
+    sf = lora_cfg.get("sf", 7)
+    bw_khz = float(lora_cfg.get("bw", 125))
+    coding_rate = lora_cfg.get("coding_rate", 5)
+    crc = 1 if lora_cfg.get("crc_en", True) else 0
+    symbol_ms = (1 << sf) / bw_khz
+    # Optimización para tasas bajas, obligatoria si el símbolo dura más de 16 ms
+    low_dr_optimize = 1 if symbol_ms > 16 else 0
+    numerator = 8 * payload_len - 4 * sf + 28 + 16 * crc
+    denominator = 4 * (sf - 2 * low_dr_optimize)
+    payload_symbols = 8 + max(-(-numerator // denominator) * coding_rate, 0)
+    return int((lora_cfg.get("preamble_len", 8) + 4.25 + payload_symbols) * symbol_ms) + 1
+
+
+class DutyCycleLimiter():
+
+    def __init__(self, duty_cycle=0.01, window_ms=3_600_000):
+        """
+        Parámetros:
+            duty_cycle: fracción del tiempo que se puede transmitir (p.ej. 0.01)
+            window_ms: periodo sobre el que se mide el ciclo de trabajo
+        """
+        self.duty_cycle = duty_cycle
+        self.capacity_ms = duty_cycle * window_ms
+        self.tokens_ms = self.capacity_ms
+        self._updated = ticks_ms()
+
+
+    def _refill(self):
+        now = ticks_ms()
+        elapsed_ms = ticks_diff(now, self._updated)
+        self.tokens_ms = min(self.tokens_ms + elapsed_ms * self.duty_cycle, self.capacity_ms)
+        self._updated = now
+
+
+    async def acquire(self, airtime_ms):
+        """
+        Espera hasta que haya presupuesto para transmitir y descuenta airtime_ms.
+        """
+        self._refill()
+        while self.tokens_ms < 0:
+            await asyncio_sleep_ms(int(-self.tokens_ms / self.duty_cycle) + 1)
+            self._refill()
+        self.tokens_ms -= airtime_ms
@@ -1,13 +1,26 @@
 import logging
 from deflate import DeflateIO, GZIP
 from tarfile import TarFile, DIRTYPE
-from json import loads as json_loads
+from json import loads as json_loads, dumps as json_dumps
 from gc import collect as gc_collect
-from os import remove as os_remove, listdir as os_listdir, rmdir as os_rmdir, mkdir as os_mkdir
+from hashlib import sha256
+from os import (
+    remove as os_remove, listdir as os_listdir, rmdir as os_rmdir, mkdir as os_mkdir,
+    rename as os_rename, stat as os_stat, statvfs as os_statvfs
+)
 
 log = logging.getLogger("ota_installer")
 METADATA_FILE_NAME = "FW_METADATA.json"
 EXPECTED_METADATA_SUFFIX = ".metadata.json" # Sufijo para el archivo de metadatos asociado al paquete OTA
+MANIFEST_FILE_NAME = "OTA_MANIFEST.json" # Hash y tamaño de cada fichero del paquete
+FREE_BLOCKS_MARGIN = 4 # Bloques libres que deben quedar además de los que ocupen los ficheros nuevos
+STAGING_DIR = "ota_staging" # Directorio donde se extrae el paquete antes de aplicarlo
+BACKUP_DIR = "ota_backup" # Directorio donde se guardan los ficheros sustituidos, para poder revertir
+JOURNAL_FILE = "ota_journal.json" # Diario de la última instalación, mientras no se confirme
+JOURNAL_TMP_SUFFIX = ".tmp"
+# Estados del diario de instalación
+COMMITTING_STATE = "COMMITTING" # Sustituyendo ficheros del sistema
+TRIAL_STATE = "TRIAL" # Instalado, pendiente de que el nuevo firmware confirme su arranque
 
 
 class OTAInstaller():
@@ -19,15 +32,25 @@ class OTAInstaller():
     un nuevo paquete OTA listo para instalarse.
     """
 
-    def __init__(self, ota_package_path: str, quiet=False):
+    BUFFER_SIZE = 1024
+    _health_check_timer = None # Compartido entre boot.py y el programa principal
+
+    def __init__(self, ota_package_path: str, quiet=False, buffer_size=BUFFER_SIZE, rollback=False):
         """
         Contruye un objeto de tipo OTAInstaller.
         Parámetros:
             ota_package_path: ruta del paquete de OTA que se pretende instalar
             quiet: si es True, no se emitará ningún mensaje de log
+            buffer_size: tamaño del buffer con el que se copian los ficheros extraídos, de
+                         modo que la memoria usada no depende del tamaño de los ficheros
+            rollback: si es True, los ficheros sustituidos se conservan hasta que el nuevo
+                      firmware confirme su arranque (confirm_update), y si no lo hace se
+                      restauran en el siguiente inicio
         """
         self.ota_package_path = ota_package_path
         self.quiet = quiet
+        self.buffer_size = buffer_size
+        self.rollback = rollback
 
 
     def __log_if_not_quiet(self, message):
@@ -52,14 +75,14 @@ class OTAInstaller():
 
 
     @staticmethod
-    def __read_fw_metadata_json(json_file) -> dict:
+    def __parse_fw_metadata(json_content) -> dict:
         """
-        Retorna un diccionario a partir de un archivo JSON.
-        Lanza una excepción si el archivo no se puede leer como JSON o si no contiene
+        Retorna un diccionario a partir del contenido de un archivo JSON.
+        Lanza una excepción si el contenido no se puede leer como JSON o si no contiene
         los atributos "title" y "version".
         """
         try:
-            fw_metadata = json_loads(json_file.read())
+            fw_metadata = json_loads(json_content)
         except ValueError as e:
             raise ValueError("Error mientras se cargaba el fichero JSON de metadatos") from e
         if ( 'title' not in fw_metadata or 'version' not in fw_metadata):
@@ -68,35 +91,56 @@ class OTAInstaller():
         return fw_metadata
 
 
+    def __read_expected_metadata(self) -> dict:
+        with open(
+            self.ota_package_path + EXPECTED_METADATA_SUFFIX, 'rb'
+        ) as expected_metadata_file:
+            return self.__parse_fw_metadata(expected_metadata_file.read())
+
+
+    def __read_package_head(self, tar_file):
+        """
+        Lee la cabecera del paquete: sus dos primeros miembros deben ser FW_METADATA.json y
+        el manifiesto (OTA_MANIFEST.json), con el hash y el tamaño de cada fichero. Comprueba
+        el formato TAR.GZ y que los metadatos coinciden con los reportados por la plataforma.
+        Retorna el contenido de FW_METADATA.json y las entradas del manifiesto.
+        """
+        try:
+            # Esto dará error si el archivo no sigue el formato tar gz
+            file_entry = tar_file.next()
+        except Exception as e :
+            raise RuntimeError("No se puede leer el paquete OTA como un archivo en"
+            " formato .tar.gz") from e
+        if file_entry is None or file_entry.name != METADATA_FILE_NAME:
+            raise ValueError(f"'{METADATA_FILE_NAME}' no es el primer miembro del paquete OTA.")
+        metadata_content = tar_file.extractfile(file_entry).read()
+        if self.__parse_fw_metadata(metadata_content) != self.__read_expected_metadata():
+            raise ValueError("Título y versión de firmware del paquete recibido no coinciden con los "
+                "reportados por la plataforma")
+
+        file_entry = tar_file.next()
+        if file_entry is None or file_entry.name != MANIFEST_FILE_NAME:
+            raise ValueError(f"'{MANIFEST_FILE_NAME}' no es el segundo miembro del paquete OTA.")
+        try:
+            package_manifest = json_loads(tar_file.extractfile(file_entry).read())["files"]
+        except (ValueError, KeyError) as e:
+            raise ValueError(f"'{MANIFEST_FILE_NAME}' no válido") from e
+        return metadata_content, package_manifest
+
+
     def check_metadata_in_package(self):
         """
-        Inspecciona como un TAR.GZ el fichero de OTA y comprueba que contenga dentro el
-        fichero FW_METADATA.json.
+        Inspecciona como un TAR.GZ el fichero de OTA y comprueba que empiece por el fichero
+        FW_METADATA.json y el manifiesto de ficheros. Solo se descomprime la cabecera del
+        paquete.
         Los campos "title" y "version" de FW_METADATA.json deberán coincidir con los reportados
         con la plataforma antes del reincio, almacenados un fichero "<ota_file_name>.metadata.json".
         Lanza una excepción si no se superan las comprobaciones.
         """
-
-        metadata_inside_ota_file = None
         with open(self.ota_package_path, 'rb') as ota_file:
             decompressed_file = DeflateIO(ota_file, GZIP)
             tar_file = TarFile(fileobj=decompressed_file)
-            for file_entry in tar_file:
-                if file_entry.name == METADATA_FILE_NAME:
-                    metadata_file = tar_file.extractfile(file_entry)
-                    metadata_inside_ota_file = self.__read_fw_metadata_json(metadata_file)
-                    break
-        if metadata_inside_ota_file == None:
-            raise ValueError(f"'{METADATA_FILE_NAME} no encontrado en el paquete OTA.'")
-
-        with open(
-            self.ota_package_path + EXPECTED_METADATA_SUFFIX, 'rb'
-        ) as expected_metadata_file:
-            expected_metadata = self.__read_fw_metadata_json(expected_metadata_file)
-
-        if metadata_inside_ota_file != expected_metadata:
-            raise ValueError("Título y versión de firmware del paquete recibido no coinciden con los "
-                "reportados por la plataforma")
+            self.__read_package_head(tar_file)
 
 
     def delete_ota_package(self):
@@ -107,9 +151,10 @@ class OTAInstaller():
         os_remove(self.ota_package_path + EXPECTED_METADATA_SUFFIX)
 
 
-    def __recursive_delete(self, path: str, excluded_paths: list):
+    def __recursive_delete(self, path: str, excluded_paths: list, backup=False):
         """
         Elimina recursivamente todos los ficheros excepto los indicados.
+        Si backup es True, los ficheros se mueven a BACKUP_DIR en lugar de borrarse.
         """
 
         path = path[:-1] if path.endswith('/') else path
@@ -121,10 +166,13 @@ class OTAInstaller():
             children = os_listdir(path)
             # no exception thrown, this is a directory
             for child in children:
-                self.__recursive_delete(path + '/' + child, excluded_paths)
+                self.__recursive_delete(path + '/' + child, excluded_paths, backup)
         except OSError:
-            self.__log_if_not_quiet(f"Borrando archivo {path}")
-            os_remove(path)
+            if backup:
+                self.__backup_file(path[1:])
+            else:
+                self.__log_if_not_quiet(f"Borrando archivo {path}")
+                os_remove(path)
             return
 
         if path == "" :
@@ -140,9 +188,261 @@ class OTAInstaller():
                 raise e
 
 
+    def __make_dir(self, path: str):
+        try:
+            os_mkdir(path)
+        except OSError as e:
+            if e.errno == 17:
+                self.__log_if_not_quiet(f"El directorio {path} ya existe")
+            else:
+                raise e
+
+
+    def __make_parent_dirs(self, path: str):
+        parent = ""
+        for dir_name in path.split("/")[:-1]:
+            parent += dir_name
+            self.__make_dir(parent)
+            parent += "/"
+
+
+    @staticmethod
+    def __exists(path: str) -> bool:
+        try:
+            os_stat(path)
+            return True
+        except OSError:
+            return False
+
+
+    def __remove_dir_tree(self, path: str):
+        if self.__exists(path):
+            self.__recursive_delete(f"/{path}", [])
+
+
+    def __remove_staging_dir(self):
+        self.__remove_dir_tree(STAGING_DIR)
+
+
+    def __backup_file(self, path: str):
+        """
+        Mueve un fichero del sistema a su misma ruta dentro de BACKUP_DIR.
+        """
+        self.__log_if_not_quiet(f"Guardando copia de {path}")
+        self.__make_parent_dirs(f"{BACKUP_DIR}/{path}")
+        os_rename(path, f"{BACKUP_DIR}/{path}")
+
+
+    @staticmethod
+    def __read_journal():
+        """
+        Retorna el diario de instalación, o None si no hay ninguna instalación pendiente.
+        Si se cortó la alimentación mientras se sustituía el diario, vale la copia temporal,
+        que ya estaba completa.
+        """
+        for journal_path in (JOURNAL_FILE, JOURNAL_FILE + JOURNAL_TMP_SUFFIX):
+            try:
+                with open(journal_path) as journal_file:
+                    return json_loads(journal_file.read())
+            except (OSError, ValueError):
+                pass
+        return None
+
+
+    def __write_journal(self, journal: dict):
+        """
+        Sustituye el diario escribiendo primero una copia temporal y renombrándola después,
+        de modo que siempre queda una versión completa en el sistema de ficheros.
+        """
+        with open(JOURNAL_FILE + JOURNAL_TMP_SUFFIX, "w") as journal_file:
+            journal_file.write(json_dumps(journal))
+        self.__remove_journal(keep_tmp=True)
+        os_rename(JOURNAL_FILE + JOURNAL_TMP_SUFFIX, JOURNAL_FILE)
+
+
+    @staticmethod
+    def __remove_journal(keep_tmp=False):
+        journal_paths = (JOURNAL_FILE,) if keep_tmp else (JOURNAL_FILE, JOURNAL_FILE + JOURNAL_TMP_SUFFIX)
+        for journal_path in journal_paths:
+            try:
+                os_remove(journal_path)
+            except OSError:
+                pass
+
+
+    def __restore_backup(self, path: str):
+        """
+        Devuelve a su sitio los ficheros guardados en BACKUP_DIR bajo la ruta indicada.
+        """
+        backup_path = f"{BACKUP_DIR}/{path}" if path else BACKUP_DIR
+        try:
+            children = os_listdir(backup_path)
+        except OSError:
+            self.__log_if_not_quiet(f"Restaurando archivo {path}")
+            try:
+                os_remove(path)
+            except OSError:
+                pass
+            self.__make_parent_dirs(path)
+            os_rename(backup_path, path)
+            return
+        for child in children:
+            self.__restore_backup(f"{path}/{child}" if path else child)
+
+
+    @staticmethod
+    def __copy_file(source, destination, buffer: memoryview, file_hash=None):
+        while True:
+            read = source.readinto(buffer)
+            if not read:
+                return
+            if file_hash is not None:
+                file_hash.update(buffer[:read])
+            destination.write(buffer[:read])
+
+
+    @staticmethod
+    def __read_installed_manifest() -> dict:
+        """
+        Retorna las entradas del manifiesto de los ficheros instalados (vacío si no hay).
+        """
+        try:
+            with open(MANIFEST_FILE_NAME) as manifest_file:
+                return json_loads(manifest_file.read())["files"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+
+    @staticmethod
+    def __hex_digest(file_hash) -> str:
+        return "".join(["%.2x" % i for i in file_hash.digest()])
+
+
+    def __is_installed(self, path: str, manifest_entry: dict, installed_manifest: dict, buffer: memoryview) -> bool:
+        """
+        Indica si el fichero ya está instalado con el contenido que describe manifest_entry.
+        El manifiesto instalado y el tamaño descartan rápido los ficheros que han cambiado, pero
+        el fichero puede haberse modificado o corrompido después: antes de omitirlo se calcula
+        el hash de su contenido real, leyéndolo con el buffer de copia.
+        """
+        if installed_manifest.get(path) != manifest_entry:
+            return False
+        try:
+            if os_stat(path)[6] != manifest_entry["size"]:
+                return False
+            file_hash = sha256()
+            with open(path, 'rb') as installed_file:
+                while True:
+                    read = installed_file.readinto(buffer)
+                    if not read:
+                        break
+                    file_hash.update(buffer[:read])
+        except OSError:
+            return False
+        return self.__hex_digest(file_hash) == manifest_entry["sha256"]
+
+
+    @staticmethod
+    def __check_free_space(file_sizes):
+        """
+        Lanza una excepción si no hay espacio libre para escribir ficheros de los tamaños
+        indicados (cada uno ocupa bloques completos del sistema de ficheros).
+        """
+        fs_stat = os_statvfs("/")
+        block_size = fs_stat[1]
+        # Un bloque más por fichero para sus metadatos, y unos cuantos para el diario y el manifiesto
+        required_blocks = FREE_BLOCKS_MARGIN + sum(
+            (size + block_size - 1) // block_size + 1 for size in file_sizes
+        )
+        if required_blocks > fs_stat[4]:
+            raise RuntimeError("Espacio libre insuficiente para instalar el paquete OTA "
+                f"({fs_stat[4] * block_size} bytes libres, {required_blocks * block_size} necesarios)")
+
+
+    def __extract_to_staging(self, excluded_files: list):
+        """
+        Recorre el paquete una sola vez, extrayendo sus ficheros (menos los excluidos) en
+        STAGING_DIR. Con la cabecera del paquete (metadatos y manifiesto) se comprueban el
+        formato y los metadatos y se planifica la instalación antes de escribir nada: los
+        ficheros que ya están instalados con el mismo hash no se extraen y se comprueba que
+        hay espacio libre para los demás. El hash de cada fichero extraído se comprueba al
+        copiarlo, y el manifiesto de los ficheros instalados se prepara en STAGING_DIR como
+        uno más.
+        Retorna la lista de entradas extraídas (ruta, es_directorio), en orden, y la lista de
+        ficheros que no han cambiado.
+        """
+        installed_manifest = self.__read_installed_manifest()
+        with open(self.ota_package_path, 'rb') as ota_file:
+            decompressed_file = DeflateIO(ota_file, GZIP)
+            tar_file = TarFile(fileobj=decompressed_file)
+            metadata_content, package_manifest = self.__read_package_head(tar_file)
+            # Un único buffer para comprobar y copiar todos los ficheros
+            buffer = memoryview(bytearray(self.buffer_size))
+
+            # Planificación con el manifiesto, antes de tocar el sistema de ficheros
+            unchanged_paths = [
+                path for path, entry in package_manifest.items()
+                if path != METADATA_FILE_NAME and path not in excluded_files
+                and self.__is_installed(path, entry, installed_manifest, buffer)
+            ]
+            self.__check_free_space([
+                entry["size"] for path, entry in package_manifest.items()
+                if path not in excluded_files and path not in unchanged_paths
+            ])
+
+            os_mkdir(STAGING_DIR)
+            with open(f"{STAGING_DIR}/{METADATA_FILE_NAME}", "wb") as metadata_file:
+                metadata_file.write(metadata_content)
+            staged_entries = [(METADATA_FILE_NAME, False)]
+            file_entry = tar_file.next()
+            while file_entry:
+                file_name = file_entry.name
+                if file_name in excluded_files:
+                    item_type = 'directorio' if file_name.endswith('/') else 'fichero'
+                    self.__log_if_not_quiet(f'Omitiendo escritura de {item_type} excluido "{file_name}"')
+                    if file_entry.type == DIRTYPE:
+                        # Solo para poder preparar los ficheros no excluidos que contenga
+                        self.__make_dir(f"{STAGING_DIR}/{file_name[:-1]}")
+                elif file_entry.type == DIRTYPE:
+                    self.__make_dir(f"{STAGING_DIR}/{file_name[:-1]}")
+                    staged_entries.append((file_name[:-1], True))
+                elif file_name in unchanged_paths:
+                    self.__log_if_not_quiet(f"Omitiendo archivo sin cambios {file_name}")
+                elif file_name not in package_manifest:
+                    raise ValueError(f"'{file_name}' no figura en el manifiesto del paquete OTA")
+                else:
+                    self.__log_if_not_quiet(f"Extrayendo archivo {file_name}")
+                    file = tar_file.extractfile(file_entry)
+                    file_hash = sha256()
+                    with open(f"{STAGING_DIR}/{file_name}", "wb") as of:
+                        self.__copy_file(file, of, buffer, file_hash)
+                    if self.__hex_digest(file_hash) != package_manifest[file_name]["sha256"]:
+                        raise ValueError(f"El hash de {file_name} no coincide con el del manifiesto")
+                    staged_entries.append((file_name, False))
+                file_entry = tar_file.next()
+
+        # Solo se anotan los ficheros que quedarán instalados tal y como los describe
+        installed_paths = unchanged_paths + [path for path, is_dir in staged_entries if not is_dir]
+        with open(f"{STAGING_DIR}/{MANIFEST_FILE_NAME}", "w") as manifest_file:
+            manifest_file.write(json_dumps({"files": {
+                path: package_manifest[path] for path in installed_paths if path in package_manifest
+            }}))
+        staged_entries.append((MANIFEST_FILE_NAME, False))
+        return staged_entries, unchanged_paths
+
+
     def install_firmware(self, excluded_files: list, cleanup: bool):
         """
-        Aplica el paquete OTA sobreescribiendo el sistema de ficheros.
+        Aplica el paquete OTA sobre el sistema de ficheros, descomprimiéndolo una sola vez:
+        en esa pasada se comprueban el formato y los metadatos del paquete y se extraen sus
+        ficheros en un directorio de preparación. Solo si todo es correcto se mueven a su
+        ubicación definitiva; si no, el sistema de ficheros queda intacto y se lanza una
+        excepción. Los ficheros que el manifiesto del paquete indica que ya están instalados
+        con el mismo contenido no se vuelven a escribir.
+        Con rollback activado, el cambio de ficheros se registra en un diario y los ficheros
+        sustituidos o borrados se guardan en BACKUP_DIR: si la instalación se interrumpe o el
+        nuevo firmware no confirma su arranque, restore_previous_firmware vuelve a la versión
+        anterior.
         Parámetros:
             excluded_files: lista de rutas excluidas (no se modificarán ni borrarán en ningún caso)
             cleanup: si es True, se realizará un borrado de todos los archivos (menos los excluidos)
@@ -150,37 +450,124 @@ class OTAInstaller():
         """
         gc_collect()
 
+        self.__remove_staging_dir() # Restos de un intento anterior
+        self.__log_if_not_quiet("Extrayendo y comprobando el paquete OTA")
+        try:
+            staged_entries, unchanged_paths = self.__extract_to_staging(excluded_files)
+        except Exception:
+            self.__remove_staging_dir()
+            raise
+
+        if self.rollback:
+            # Copia de la versión anterior de una instalación ya confirmada
+            self.__remove_dir_tree(BACKUP_DIR)
+            os_mkdir(BACKUP_DIR)
+            # Antes de tocar el sistema se anota qué ficheros y directorios son nuevos,
+            # que son los que habría que borrar para revertir
+            self.__write_journal({
+                "state": COMMITTING_STATE,
+                "new_paths": [path for path, _ in staged_entries if not self.__exists(path)]
+            })
+
         if cleanup:
             excluded_paths = [
                 f"/{path[:-1]}"  if path.endswith("/") else f"/{path}" for path in excluded_files
             ] + [
                 f"/{self.ota_package_path}",
-                f"/{self.ota_package_path}{EXPECTED_METADATA_SUFFIX}"
+                f"/{self.ota_package_path}{EXPECTED_METADATA_SUFFIX}",
+                f"/{STAGING_DIR}",
+                f"/{BACKUP_DIR}",
+                f"/{JOURNAL_FILE}",
+                f"/{JOURNAL_FILE}{JOURNAL_TMP_SUFFIX}"
+            ] + [
+                # Los ficheros sin cambios quedarían igual tras borrarlos e instalarlos
+                f"/{path}" for path in unchanged_paths
             ]
             self.__log_if_not_quiet("Realizando limpieza recursiva")
-            self.__recursive_delete("/", excluded_paths)
+            self.__recursive_delete("/", excluded_paths, backup=self.rollback)
 
         self.__log_if_not_quiet("Aplicando paquete OTA sobre el sistema de ficheros")
-        with open(self.ota_package_path, 'rb') as ota_file:
-            decompressed_file = DeflateIO(ota_file, GZIP)
-            tar_file = TarFile(fileobj=decompressed_file)
-            for file_entry in tar_file:
-                file_name = file_entry.name
-                if file_name in excluded_files:
-                    item_type = 'directorio' if file_name.endswith('/') else 'fichero'
-                    self.__log_if_not_quiet(f'Omitiendo escritura de {item_type} excluido "{file_name}"')
-                    continue
-                if file_entry.type == DIRTYPE:
-                    try:
-                        self.__log_if_not_quiet(f"Creando directorio {file_name}")
-                        os_mkdir(file_entry.name[:-1])
-                    except OSError as e:
-                        if e.errno == 17:
-                            self.__log_if_not_quiet('El directorio ya existe')
-                        else:
-                            raise e
-                else:
-                    self.__log_if_not_quiet(f"Escribiendo archivo {file_name}")
-                    file = tar_file.extractfile(file_entry)
-                    with open(file_name, "wb") as of:
-                        of.write(file.read())
+        for path, is_dir in staged_entries:
+            if is_dir:
+                self.__log_if_not_quiet(f"Creando directorio {path}")
+                self.__make_dir(path)
+                continue
+            self.__log_if_not_quiet(f"Escribiendo archivo {path}")
+            if self.rollback and self.__exists(path):
+                self.__backup_file(path)
+            else:
+                try:
+                    os_remove(path)
+                except OSError:
+                    pass
+            os_rename(f"{STAGING_DIR}/{path}", path)
+        self.__remove_staging_dir()
+
+        if self.rollback:
+            journal = self.__read_journal()
+            journal["state"] = TRIAL_STATE
+            self.__write_journal(journal)
+
+
+    def restore_previous_firmware(self):
+        """
+        Revisa el diario de la última instalación y, si quedó a medias o el firmware instalado
+        no llegó a confirmar su arranque, restaura los ficheros de la versión anterior.
+        Retorna el estado en el que se encontraba la instalación revertida (COMMITTING_STATE o
+        TRIAL_STATE), o None si no había nada que revertir.
+        """
+        journal = self.__read_journal()
+        if journal is None:
+            return None
+        self.__log_if_not_quiet(f"Revirtiendo instalación no confirmada (estado {journal['state']})")
+        # Primero se borran los ficheros nuevos y después los directorios nuevos (ya vacíos)
+        new_paths = journal["new_paths"]
+        for path in reversed(new_paths):
+            try:
+                os_remove(path)
+            except OSError:
+                pass
+        for path in reversed(new_paths):
+            try:
+                os_rmdir(path)
+            except OSError:
+                pass
+        if self.__exists(BACKUP_DIR):
+            self.__restore_backup("")
+        self.__remove_dir_tree(BACKUP_DIR)
+        self.__remove_staging_dir()
+        self.__remove_journal()
+        return journal["state"]
+
+
+    def start_health_check(self, timeout_s: int, timer_id: int = 0):
+        """
+        Reinicia el dispositivo si el nuevo firmware no confirma su arranque (confirm_update)
+        en timeout_s segundos. El temporizador sigue activo al pasar de boot.py al programa
+        principal, de modo que también un fallo que deje el dispositivo parado acaba en
+        reinicio y, con él, en la restauración de la versión anterior. timer_id indica el
+        temporizador de machine.Timer a emplear (-1 para uno virtual, en los puertos que
+        lo admiten), de modo que no coincida con ninguno de los que use la aplicación.
+        """
+        from machine import Timer, reset as machine_reset
+        OTAInstaller._health_check_timer = Timer(timer_id)
+        OTAInstaller._health_check_timer.init(
+            mode=Timer.ONE_SHOT, period=timeout_s * 1000, callback=lambda timer: machine_reset()
+        )
+
+
+    def confirm_update(self):
+        """
+        Da por buena la última instalación: cancela la comprobación de arranque y descarta
+        la copia de la versión anterior. Debe llamarlo el programa principal una vez que ha
+        arrancado correctamente; no hace nada si no hay ninguna instalación pendiente.
+        """
+        if OTAInstaller._health_check_timer is not None:
+            OTAInstaller._health_check_timer.deinit()
+            OTAInstaller._health_check_timer = None
+        journal = self.__read_journal()
+        if journal is None or journal["state"] != TRIAL_STATE:
+            return
+        self.__log_if_not_quiet("Confirmando la instalación del nuevo firmware")
+        self.__remove_dir_tree(BACKUP_DIR)
+        self.__remove_journal()
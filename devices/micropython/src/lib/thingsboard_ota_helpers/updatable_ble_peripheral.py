@@ -1,11 +1,11 @@
 import aioble
 import logging
-from hashlib import sha256
 from machine import reset
 from bluetooth import UUID as bluetooth_UUID
 from asyncio import Event as asyncio_Event
 from gc import collect as gc_collect
 from json import dumps as json_dumps
+from thingsboard_ota_helpers.firmware_sink import FirmwareSink
 
 log = logging.getLogger("updatable_ble_peripheral")
 EXPECTED_METADATA_SUFFIX = ".metadata.json" # Sufijo para el archivo de metadatos asociado al paquete OTA
@@ -33,6 +33,14 @@ class UpdatableBLEPeripheral():
 
     # Característica sobre la cual recibir el firmware por fragmentos
     FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID = bluetooth_UUID('f4c7000e-40c5-88cc-c1d6-77bfb6baf772')
+    FIRMWARE_FRAGMENT_MAX_LEN = 512
+
+    # Característica para confirmar los fragmentos recibidos en el modo por ventanas
+    FIRMWARE_ACK_CHARACTERISTIC_UUID = bluetooth_UUID('f4c70010-40c5-88cc-c1d6-77bfb6baf772')
+    WINDOWED_TRANSFER_MODE = 0x01
+    # aioble guarda como mucho 10 escrituras capturadas pendientes de leer
+    MAX_WINDOW_SIZE = 8
+    PREFERRED_MTU = 517
 
 
     class FirmwareStateCharacteristic(aioble.Characteristic):
@@ -55,6 +63,8 @@ class UpdatableBLEPeripheral():
 
         address = aioble.config("mac")
         log.info(f"Dirección MAC del módulo BLE: {address[1]}")
+        # MTU preferido en el intercambio de MTU que inicia el gateway
+        aioble.config(mtu=self.PREFERRED_MTU)
 
         self.ble_service = aioble.Service(self.CUSTOM_SERVICE_UUID)
 
@@ -75,7 +85,8 @@ class UpdatableBLEPeripheral():
         self.ota_connectivity_char = aioble.Characteristic(self.ble_service, self.OTA_CONNECTIVITY_CHARACTERISTIC_UUID, read=True)
 
         # Característica sobre la cual recibir el firmware por fragmentos
-        self.firmware_fragment_char = aioble.BufferedCharacteristic(self.ble_service, self.FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, write=True, capture=True, max_len=128)
+        self.firmware_fragment_char = aioble.BufferedCharacteristic(self.ble_service, self.FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, write=True, capture=True, max_len=self.FIRMWARE_FRAGMENT_MAX_LEN)
+        self.firmware_ack_char = aioble.Characteristic(self.ble_service, self.FIRMWARE_ACK_CHARACTERISTIC_UUID, read=True, notify=True)
 
 
     async def _wait_for_OTA_startup(self):
@@ -98,30 +109,60 @@ class UpdatableBLEPeripheral():
 
     async def _receive_firmware_data(self):
         """
-        Recibe y retorna el firmware en fragmentos, través de la característica BLE
-        dedicada a ello.
+        Recibe el firmware en fragmentos, través de la característica BLE dedicada a
+        ello, y lo escribe en flash a medida que llega. Retorna el FirmwareSink con el
+        firmware recibido, pendiente de verificar.
+        La primera escritura es una cabecera con el tamaño del firmware (4 bytes). Si le
+        siguen el modo por ventanas, el tamaño de ventana y el tamaño de fragmento, los
+        fragmentos llegan numerados y sin respuesta (véase _receive_windowed_fragments).
         """
-        _, coded_fw_size = await self.firmware_fragment_char.written()
-        fw_size = int.from_bytes(coded_fw_size, 'big')
+        _, header = await self.firmware_fragment_char.written()
+        fw_size = int.from_bytes(header[0:4], 'big')
         log.debug(f"Esperando recibir {fw_size} bytes de firmware")
         gc_collect()
-        fw_data = bytearray()
-        bytes_received = 0
-        while bytes_received < fw_size:
-            _, fw_fragment = await self.firmware_fragment_char.written()
-            fw_data.extend(fw_fragment)
-            bytes_received = bytes_received + len(fw_fragment)
-        return fw_data
-
-
-    def _verify_checksum(self, firmware_data, checksum_alg, checksum):
-        checksum_of_received_firmware = None
-        if checksum_alg.lower() == "sha256":
-            checksum_of_received_firmware = "".join(["%.2x" % i for i in sha256(firmware_data).digest()])
-        else:
-            log.error("Algoritmo de checksum no soportado (solo SHA256)")
-        log.debug(f"Checksum del firmware recibido: {checksum_of_received_firmware}")
-        return checksum_of_received_firmware == checksum
+        fw_sink = FirmwareSink(self.fw_filename, fw_size)
+        try:
+            if len(header) >= 8 and header[4] == self.WINDOWED_TRANSFER_MODE:
+                window_size = max(1, min(header[5], self.MAX_WINDOW_SIZE))
+                fragment_size = int.from_bytes(header[6:8], 'big')
+                log.debug(f"Modo por ventanas: ventana de {window_size} fragmentos de {fragment_size} bytes")
+                await self._receive_windowed_fragments(fw_sink, fw_size, window_size)
+                return fw_sink
+            while fw_sink.bytes_written < fw_size:
+                _, fw_fragment = await self.firmware_fragment_char.written()
+                fw_sink.write(fw_fragment)
+        except Exception:
+            fw_sink.abort()
+            raise
+        return fw_sink
+
+
+    def _notify_ack(self, connection, next_seq, gap):
+        self.firmware_ack_char.notify(connection, next_seq.to_bytes(2, 'big') + bytes([1 if gap else 0]))
+
+
+    async def _receive_windowed_fragments(self, fw_sink, fw_size, window_size):
+        """
+        Recibe fragmentos precedidos de su número de secuencia (2 bytes). Cada window_size
+        fragmentos consecutivos, y al completar el firmware, se notifica el siguiente número
+        de secuencia esperado. Los fragmentos fuera de orden se descartan y se notifica
+        una vez el hueco para que el gateway reenvíe desde el primero que falta.
+        """
+        expected_seq = 0
+        gap_reported = False
+        while fw_sink.bytes_written < fw_size:
+            connection, fw_fragment = await self.firmware_fragment_char.written()
+            seq = int.from_bytes(fw_fragment[0:2], 'big')
+            if seq != expected_seq:
+                if not gap_reported:
+                    self._notify_ack(connection, expected_seq, True)
+                    gap_reported = True
+                continue
+            gap_reported = False
+            fw_sink.write(memoryview(fw_fragment)[2:])
+            expected_seq = (expected_seq + 1) & 0xFFFF
+            if expected_seq % window_size == 0 or fw_sink.bytes_written >= fw_size:
+                self._notify_ack(connection, expected_seq, False)
 
 
     async def _manage_OTA_update(self):
@@ -159,7 +200,7 @@ class UpdatableBLEPeripheral():
         # Recibir el firmware y a continuación reportar el estado DOWNLOADED
         log.debug("En espera de recibir el nuevo firmware")
         try:
-            fw_data = await self._receive_firmware_data()
+            fw_sink = await self._receive_firmware_data()
         except Exception as e:
             error_msg = "Excepción producida durante la recepción del paquete de OTA: " + \
                 f"({type(e).__name__}) {e}"
@@ -170,8 +211,9 @@ class UpdatableBLEPeripheral():
         log.debug("Se ha recibido el firmware")
         self.fw_state_char.write("DOWNLOADED".encode('utf-8'))
 
-        # Verificación del firmware recibido
-        if not self._verify_checksum(fw_data, fw_checksum_alg, fw_checksum):
+        # Verificación del firmware recibido (ya escrito en flash): si es correcto queda
+        # guardado en el archivo correspondiente
+        if not fw_sink.finish(fw_checksum_alg, fw_checksum):
             error_msg = "No se ha podido verificar el checksum"
             log.error(error_msg)
             self.fw_state_char.write("FAILED".encode('utf-8'))
@@ -181,10 +223,6 @@ class UpdatableBLEPeripheral():
         self.fw_state_char.fw_state_read_event.clear()
         log.debug("Esperando a que sea leído el estado VERIFIED")
         await self.fw_state_char.fw_state_read_event.wait()
-
-        # Guardar el firmware en el archivo correspondiente
-        with open(self.fw_filename, "wb") as firmware_file:
-            firmware_file.write(fw_data)
         log.info(f"El paquete de firmware recibido se ha guardado en {self.fw_filename}")
 
         # Guardar los metadatos esperados del firmware recibido
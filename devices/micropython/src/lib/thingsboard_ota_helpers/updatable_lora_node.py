@@ -1,13 +1,18 @@
 import logging
-from asyncio import sleep_ms as asyncio_sleep_ms, create_task as asyncio_create_task
-from hashlib import sha256
+from asyncio import sleep_ms as asyncio_sleep_ms, create_task as asyncio_create_task, Event, Lock
+from asyncio import wait_for_ms as asyncio_wait_for_ms, TimeoutError as AsyncioTimeoutError
 from machine import reset
+from random import getrandbits
+from time import ticks_ms, ticks_diff
 from gc import collect as gc_collect
 from json import dumps as json_dumps, loads as json_loads
-from binascii import a2b_base64
+from struct import unpack_from as struct_unpack_from
 from network import WLAN, STA_IF
-from ubinascii import hexlify
+from ubinascii import hexlify, unhexlify, b2a_base64
 from collections import deque
+from thingsboard_ota_helpers.lora_airtime import time_on_air_ms, DutyCycleLimiter
+from thingsboard_ota_helpers.firmware_sink import FirmwareSink
+from thingsboard_ota_helpers.fw_parity import parity_fragment_starts, recover_fragment
 
 
 log = logging.getLogger("updatable_lora_node")
@@ -18,24 +23,82 @@ class UpdatableLoraNode():
 
     MAX_RETRIES = 15
     ACK_MAX_COUNT = 100
-    RETRY_TIMEOUT_MS = 1000
+    # Timeout de reenvío estimado a partir del RTT (SRTT + 4*RTTVAR, RFC 6298). Mientras
+    # no hay muestras se usa INITIAL_RTO_MS. Cada reenvío duplica el timeout del mensaje.
+    INITIAL_RTO_MS = 1000
+    MIN_RTO_MS = 300
+    MAX_RTO_MS = 30000
+    # Mensajes fiables que pueden estar pendientes de ACK a la vez
+    WINDOW_SIZE = 4
+    # Bits del campo "sack" de los ACKs: el bit i confirma también la secuencia count-1-i
+    SACK_BITS = 8
+
+    # Trama binaria con un fragmento de firmware:
+    # tipo (1) | id del dispositivo (6) | secuencia fiable (1) | bloque (2) | offset (4) | datos
+    FW_FRAGMENT_FRAME = 0xF1
+    # En las transferencias a un grupo, el id del grupo sustituye al del dispositivo. Las
+    # tramas multicast no llevan secuencia fiable ni se confirman. Las de paridad llevan el
+    # XOR de varios fragmentos consecutivos (tantos como indica el campo de secuencia)
+    FW_MULTICAST_FRAME = 0xF2
+    FW_PARITY_FRAME = 0xF3
+    FW_FRAME_TYPES = (FW_FRAGMENT_FRAME, FW_MULTICAST_FRAME, FW_PARITY_FRAME)
+    FRAME_HEADER_FORMAT = '>B6sBHI'
+    FRAME_HEADER_SIZE = 14
+    # El firmware se transfiere en bloques de FW_BLOCK_SIZE bytes: el índice de cada trama es
+    # el de su primer bloque y una trama puede llevar varios bloques seguidos (el gateway
+    # elige el tamaño de fragmento según la calidad del enlace)
+    FW_BLOCK_SIZE = 32
+    # Máximo de bytes del mapa de bloques recibidos que se incluyen en un informe
+    MAX_BITMAP_REPORT_BYTES = 96
+
+    # Adaptación de la tasa de datos: cada LINK_REPORT_INTERVAL paquetes recibidos se
+    # informa al gateway de la SNR media del enlace de bajada. El gateway anuncia los
+    # cambios de SF con el mensaje {"lora_sf": sf, "in_s": segundos} y cambia él mismo
+    # pasados in_s segundos, igual que el nodo. Con un SF distinto del inicial se vuelve a
+    # este si se agotan los reenvíos de un mensaje o si no se recibe nada del gateway en
+    # SF_SILENCE_TIMEOUT_MS (el gateway emite una baliza cada 5 minutos si no tiene tráfico)
+    LINK_REPORT_INTERVAL = 16
+    SF_SILENCE_TIMEOUT_MS = 15 * 60 * 1000
+    SF_SILENCE_CHECK_MS = 60 * 1000
 
     def __init__(self,
         lora_modem,
         fw_current_title="Initial",
         fw_current_version="v0",
         fw_filename="new_firmware.tar.gz",
+        lora_cfg=None,
+        duty_cycle=0.01,
     ):
+        """
+        lora_cfg es la configuración de radio del módem (lora_config.json), con la que se
+        calcula el tiempo en el aire de cada trama. Las transmisiones se espacian para no
+        superar el ciclo de trabajo duty_cycle (1% por defecto, límite de la banda de 868 MHz).
+        """
         self.fw_current_title = fw_current_title
         self.fw_current_version = fw_current_version
         self.fw_filename = fw_filename
         self.device_id = self._get_mac_address()
+        self.device_mac = unhexlify(self.device_id)
         self.lora_modem = lora_modem
         lora_modem_info = str(self.lora_modem.__dict__)
         log.info(f"Modem lora = {lora_modem_info}")
         self.callback = None
-        self.received_acks = set() # Lista de identificadores de ACKs recibidos
+        self.received_acks = {} # Identificador de ACK recibido -> instante de llegada (ticks_ms)
+        # Identificadores de los mensajes enviados pendientes de ACK -> Event que se activa al llegar
+        self.awaited_acks = {}
         self.ack_counter = 0 # Contador circular entre 0 y 99 para identificar el próximo ACK
+        self.window_event = Event() # Se activa al quedar libre un hueco de la ventana
+        self.srtt_ms = None
+        self.rttvar_ms = None
+        self.rto_ms = self.INITIAL_RTO_MS
+        self.send_lock = Lock() # El módem no admite transmisiones simultáneas
+        self.lora_cfg = lora_cfg or {}
+        self.base_sf = self.lora_cfg.get("sf", 7)
+        self.downlink_snr = None # Medias móviles de la calidad de los paquetes recibidos
+        self.downlink_rssi = None
+        self.packets_since_report = 0
+        self.last_rx_ticks = ticks_ms() # Instante de la última trama recibida del gateway
+        self.duty_cycle_limiter = DutyCycleLimiter(duty_cycle)
         # Cola para evitar tratar varias veces un mensaje que se puede reenviar
         self.last_reliable_msgs_received = deque([], 10)
         self.fw_title              = None
@@ -44,8 +107,12 @@ class UpdatableLoraNode():
         self.fw_checksum           = None
         self.fw_checksum_algorithm = None
         self.downloading_firmware = False
-        self.fw_bin_data = bytearray()
-        self.bytes_received = 0
+        self.fw_sink = None # Fichero donde se escribe el firmware a medida que llega
+        self.fw_bitmap = None # Mapa de bits de los bloques recibidos
+        self.fw_group = None # Grupo multicast de la transferencia en curso (id en hexadecimal)
+        self.fw_group_mac = None
+        self.blocks_total = 0
+        self.blocks_received = 0
 
 
     def _get_mac_address(self):
@@ -56,16 +123,6 @@ class UpdatableLoraNode():
         return mac
 
 
-    def _verify_checksum(self, firmware_data, checksum_alg, checksum):
-        checksum_of_received_firmware = None
-        if checksum_alg.lower() == "sha256":
-            checksum_of_received_firmware = "".join(["%.2x" % i for i in sha256(firmware_data).digest()])
-        else:
-            log.error("Algoritmo de checksum no soportado (solo SHA256)")
-        log.debug(f"Checksum del firmware recibido: {checksum_of_received_firmware}")
-        return checksum_of_received_firmware == checksum
-
-
     async def connect(self):
         self.lora_modem.calibrate() # Calibración inicial para oscilador RC, PLL y ADC
         await self.reliable_send("connect", {})
@@ -73,16 +130,64 @@ class UpdatableLoraNode():
         await self.reliable_send("attributes", connectivity_attrs)
 
 
+    async def _transmit(self, msg_bytes):
+        async with self.send_lock:
+            await self.duty_cycle_limiter.acquire(time_on_air_ms(len(msg_bytes), self.lora_cfg))
+            await self.lora_modem.send(msg_bytes)
+
+
     async def send(self, subtopic, msg):
         msg_bytes = json_dumps({
             "id": f"{self.device_id}/{subtopic}",
             "msg": msg
         }).encode("utf-8")
-        await self.lora_modem.send(msg_bytes)
+        await self._transmit(msg_bytes)
+
+
+    async def _send_ack(self, count):
+        # Se confirman también los mensajes recibidos justo antes (por si se perdió su ACK)
+        ack = {"count": count}
+        sack = 0
+        for i in range(self.SACK_BITS):
+            if (count - 1 - i) % self.ACK_MAX_COUNT in self.last_reliable_msgs_received:
+                sack |= 1 << i
+        if sack:
+            ack["sack"] = sack
+        await self.send("ack", ack)
+
+
+    def _update_rtt(self, rtt_ms):
+        if self.srtt_ms is None:
+            self.srtt_ms = rtt_ms
+            self.rttvar_ms = rtt_ms // 2
+        else:
+            self.rttvar_ms = (3 * self.rttvar_ms + abs(self.srtt_ms - rtt_ms)) // 4
+            self.srtt_ms = (7 * self.srtt_ms + rtt_ms) // 8
+        self.rto_ms = min(max(self.srtt_ms + 4 * self.rttvar_ms, self.MIN_RTO_MS), self.MAX_RTO_MS)
+        log.debug(f"RTT={rtt_ms}ms: SRTT={self.srtt_ms}ms, RTTVAR={self.rttvar_ms}ms, RTO={self.rto_ms}ms")
+
+
+    def _retry_timeout_ms(self, tries):
+        # Backoff exponencial con un jitter de hasta el 25%
+        timeout_ms = min(self.rto_ms << tries, self.MAX_RTO_MS)
+        return timeout_ms + (timeout_ms * getrandbits(8) >> 10)
+
+
+    def get_rtt_estimates(self) -> dict:
+        """
+        Devuelve las estimaciones actuales del enlace con el gateway (en milisegundos).
+        """
+        return {"srtt": self.srtt_ms, "rttvar": self.rttvar_ms, "rto": self.rto_ms}
 
 
     async def reliable_send(self, subtopic, msg):
+        # Ventana deslizante: como mucho WINDOW_SIZE mensajes pendientes de ACK a la vez
+        while len(self.awaited_acks) >= self.WINDOW_SIZE:
+            self.window_event.clear()
+            await self.window_event.wait()
         ack_count = self.ack_counter
+        ack_event = Event()
+        self.awaited_acks[ack_count] = ack_event
         msg_bytes = json_dumps({
             "id": f"{self.device_id}/reliable/{subtopic}",
             "msg": msg,
@@ -91,19 +196,80 @@ class UpdatableLoraNode():
         log.debug(f"Enviando mensaje fiable: {msg_bytes}")
         self.ack_counter = (self.ack_counter + 1) % self.ACK_MAX_COUNT
         success = False
-        for tries in range(self.MAX_RETRIES):
-            await self.lora_modem.send(msg_bytes)
-            await asyncio_sleep_ms(self.RETRY_TIMEOUT_MS)
-            if ack_count in self.received_acks:
-                self.received_acks.remove(ack_count)
+        try:
+            for tries in range(self.MAX_RETRIES):
+                await self._transmit(msg_bytes)
+                sent_ticks = ticks_ms()
+                # Se espera a que llegue el ACK (_handle_msg_data activa el evento) o venza el timeout
+                try:
+                    await asyncio_wait_for_ms(ack_event.wait(), self._retry_timeout_ms(tries))
+                except AsyncioTimeoutError:
+                    continue
+                # Algoritmo de Karn: solo se mide el RTT de mensajes no reenviados
+                if tries == 0:
+                    self._update_rtt(ticks_diff(self.received_acks[ack_count], sent_ticks))
                 success = True
                 break
+        finally:
+            self.awaited_acks.pop(ack_count, None)
+            self.received_acks.pop(ack_count, None)
+            self.window_event.set()
         if not success:
             log.error("No se ha obtenido ACK. Mensaje descartado")
+            if self.lora_cfg.get("sf", 7) != self.base_sf:
+                # El gateway puede haber vuelto al SF inicial
+                await self._set_sf(self.base_sf)
 
         self.lora_modem.calibrate_image() # prueba y mejora la sensibilidad de RX para la próxima recepción
 
 
+    async def _set_sf(self, sf):
+        if sf == self.lora_cfg.get("sf", 7):
+            return
+        async with self.send_lock:
+            self.lora_modem.configure({"sf": sf})
+            self.lora_cfg = dict(self.lora_cfg)
+            self.lora_cfg["sf"] = sf
+        self.last_rx_ticks = ticks_ms()
+        log.info(f"Spreading factor cambiado a {sf}")
+
+
+    async def _switch_sf(self, sf, delay_s):
+        # El gateway cambia en el mismo instante
+        await asyncio_sleep_ms(delay_s * 1000)
+        await self._set_sf(sf)
+
+
+    async def _watch_gateway_silence(self):
+        while True:
+            await asyncio_sleep_ms(self.SF_SILENCE_CHECK_MS)
+            if (self.lora_cfg.get("sf", 7) != self.base_sf and
+                ticks_diff(ticks_ms(), self.last_rx_ticks) > self.SF_SILENCE_TIMEOUT_MS
+            ):
+                log.warning("Sin noticias del gateway. Volviendo al SF inicial")
+                await self._set_sf(self.base_sf)
+
+
+    def _record_link_quality(self, rx):
+        self.last_rx_ticks = ticks_ms()
+        # rx.snr se expresa en cuartos de dB
+        snr = rx.snr / 4
+        if self.downlink_snr is None:
+            self.downlink_snr, self.downlink_rssi = snr, rx.rssi
+        else:
+            self.downlink_snr += (snr - self.downlink_snr) / 4
+            self.downlink_rssi += (rx.rssi - self.downlink_rssi) / 4
+        self.packets_since_report += 1
+        if self.packets_since_report >= self.LINK_REPORT_INTERVAL:
+            self.packets_since_report = 0
+            link_report = {
+                "snr": round(self.downlink_snr, 1),
+                "rssi": round(self.downlink_rssi),
+                "sf": self.lora_cfg.get("sf", 7)
+            }
+            asyncio_create_task(self.send("link", link_report))
+
+
     def set_callback(self, callback):
         """
         Establece la función de callback que se llamará más tarde.
@@ -149,59 +315,107 @@ class UpdatableLoraNode():
         self.fw_size               = None
         self.fw_checksum           = None
         self.fw_checksum_algorithm = None
+        if self.fw_sink is not None:
+            self.fw_sink.abort()
+            self.fw_sink = None
+        self.fw_bitmap = None
+        self.fw_group = None
+        self.fw_group_mac = None
+        self.blocks_total = 0
+        self.blocks_received = 0
+
+
+    def _fail_fw_download(self, error_msg):
+        log.error(error_msg)
+        failed_telemetry = {
+            "fw_state": "FAILED", "fw_error": error_msg
+        }
+        asyncio_create_task(self.reliable_send("telemetry", failed_telemetry ))
+        self.downloading_firmware = False
+        self._clean_ota_status()
+
+
+    def _first_missing_block(self, start_block=0):
+        for byte_index in range(start_block >> 3, len(self.fw_bitmap)):
+            if self.fw_bitmap[byte_index] != 0xFF:
+                for bit in range(8):
+                    if not self.fw_bitmap[byte_index] & (1 << bit):
+                        return byte_index * 8 + bit
+        return self.blocks_total
+
+
+    async def _report_fw_bitmap(self, repair_round=None, spread_s=0):
+        """
+        Informa al gateway de los bloques recibidos, para que reenvíe solo los que faltan.
+        Se envía el tramo del mapa de bits (bit i del byte j = bloque 8*j+i) que empieza
+        en el primer bloque que falta, limitado a MAX_BITMAP_REPORT_BYTES bytes.
+        Las consultas multicast indican un periodo spread_s en el que se responde en un
+        instante aleatorio, para no colisionar con el resto del grupo.
+        """
+        if spread_s:
+            await asyncio_sleep_ms((getrandbits(16) * spread_s * 1000) >> 16)
+        report = {"round": repair_round}
+        if self.blocks_received == self.blocks_total:
+            report["done"] = True
+        else:
+            start_byte = self._first_missing_block() // 8
+            bitmap_slice = self.fw_bitmap[start_byte : start_byte + self.MAX_BITMAP_REPORT_BYTES]
+            report["from"] = start_byte * 8
+            report["bitmap"] = b2a_base64(bitmap_slice).decode().strip()
+            log.debug(f"Bloques recibidos: {self.blocks_received}/{self.blocks_total}")
+        await self.reliable_send("fw_bitmap", report)
 
 
-    async def _handle_fw_download(self, msg_data):
+    async def _handle_fw_fragment(self, index, offset, fragment):
 
          # Transferencia del firmware
         try:
-            if "fw_fragment" in msg_data:
-                self.fw_str_fragment = msg_data["fw_fragment"]
-                self.fw_bin_fragment = a2b_base64(self.fw_str_fragment)
-                self.fw_bin_data.extend(self.fw_bin_fragment)
-                self.bytes_received = self.bytes_received + len(self.fw_bin_fragment)
-                log.debug(f"Descargando... {self.bytes_received}/{self.fw_size}B")
+            end = offset + len(fragment)
+            # Solo el último fragmento puede no ocupar un número entero de bloques
+            if (index * self.FW_BLOCK_SIZE != offset or end > self.fw_size or
+                (len(fragment) % self.FW_BLOCK_SIZE and end != self.fw_size)
+            ):
+                log.warning(f"Fragmento {index} con offset {offset} no válido. Descartado")
+                return
+            self.fw_sink.write_at(offset, fragment)
+            last_block = (end + self.FW_BLOCK_SIZE - 1) // self.FW_BLOCK_SIZE
+            for block in range(index, last_block):
+                if not self.fw_bitmap[block >> 3] & (1 << (block & 7)):
+                    self.fw_bitmap[block >> 3] |= 1 << (block & 7)
+                    self.blocks_received += 1
+            # Si el fragmento prolonga el tramo inicial contiguo, el hash avanza también
+            # sobre los bloques que llegaron antes tras el hueco
+            if offset <= self.fw_sink.hashed:
+                first_missing = self._first_missing_block(index)
+                self.fw_sink.hash_up_to(min(first_missing * self.FW_BLOCK_SIZE, self.fw_size))
+            log.debug(f"Descargando... {self.blocks_received}/{self.blocks_total} bloques")
         except Exception as e:
-            error_msg = "Excepción producida durante la recepción del paquete de OTA: " + \
-                f"({type(e).__name__}) {e}"
-            log.error(error_msg)
-            failed_telemetry = {
-                "fw_state": "FAILED", "fw_error": error_msg
-            }
-            asyncio_create_task(self.reliable_send("telemetry", failed_telemetry ))
-            self.downloading_firmware = False
-            self._clean_ota_status()
+            self._fail_fw_download("Excepción producida durante la recepción del paquete de OTA: " + \
+                f"({type(e).__name__}) {e}")
             return
 
-        if self.bytes_received != self.fw_size:
-            # Aún faltan fragmentos por recibir
+        if self.blocks_received != self.blocks_total:
+            # Aún faltan bloques por recibir
             return
 
         # Descarga completada
         log.info("Todo el firmware ha sido recibido")
+        asyncio_create_task(self._report_fw_bitmap())
         downloaded_telemetry = { "fw_state": "DOWNLOADED"}
         asyncio_create_task(self.reliable_send("telemetry", downloaded_telemetry ))
         self.downloading_firmware = False
 
-        # Verificación del firmware recibido
-        if not self._verify_checksum(self.fw_bin_data, self.fw_checksum_algorithm, self.fw_checksum):
-            error_msg = "No se ha podido verificar el checksum"
-            log.error(error_msg)
-            failed_telemetry = {
-                "fw_state": "FAILED", "fw_error": error_msg
-            }
-            asyncio_create_task(self.reliable_send("telemetry", failed_telemetry ))
-            self._clean_ota_status()
+        # Verificación del firmware recibido (ya escrito en flash): si es correcto queda
+        # guardado en el archivo correspondiente
+        fw_sink, self.fw_sink = self.fw_sink, None
+        if not fw_sink.finish(self.fw_checksum_algorithm, self.fw_checksum):
+            self._fail_fw_download("No se ha podido verificar el checksum")
             return
+        log.info(f"El paquete de firmware recibido se ha guardado en {self.fw_filename}")
         verified_telemetry = { "fw_state": "VERIFIED"}
         asyncio_create_task(self.reliable_send("telemetry", verified_telemetry ))
         await asyncio_sleep_ms(4000) # Espera a que sea lea el estado verified
 
-        # Guardar el firmware en el archivo correspondiente
-        with open(self.fw_filename, "wb") as firmware_file:
-            firmware_file.write(self.fw_bin_data)
-        log.info(f"El paquete de firmware recibido se ha guardado en {self.fw_filename}")
-
         # Guardar los metadatos esperados del firmware recibido
         metadata_file_name = self.fw_filename + EXPECTED_METADATA_SUFFIX
         with open(metadata_file_name, "wb") as firmware_metadata_file:
@@ -214,12 +428,86 @@ class UpdatableLoraNode():
         reset()
 
 
-    async def _manage_ota(self, msg_data):
+    def _blocks_received(self, start, end):
+        for block in range(start // self.FW_BLOCK_SIZE, (end + self.FW_BLOCK_SIZE - 1) // self.FW_BLOCK_SIZE):
+            if not self.fw_bitmap[block >> 3] & (1 << (block & 7)):
+                return False
+        return True
 
-        if self.downloading_firmware:
-            await self._handle_fw_download(msg_data)
 
+    async def _handle_fw_parity(self, index, offset, count, parity):
+        """
+        Reconstruye con una trama de paridad el fragmento que falte de los count fragmentos
+        consecutivos que cubre. Si falta más de uno no se puede recuperar ninguno.
+        """
+        size = len(parity)
+        if index * self.FW_BLOCK_SIZE != offset or size % self.FW_BLOCK_SIZE:
+            log.warning(f"Trama de paridad {index} con offset {offset} no válida. Descartada")
+            return
+        starts = parity_fragment_starts(offset, size, count, self.fw_size)
+        missing = [start for start in starts
+            if not self._blocks_received(start, min(start + size, self.fw_size))]
+        if len(missing) != 1:
+            return
+        recovered = recover_fragment(parity, (
+            self.fw_sink.read_at(start, min(start + size, self.fw_size) - start)
+            for start in starts if start != missing[0]
+        ))
+        end = min(missing[0] + size, self.fw_size)
+        log.debug(f"Fragmento con offset {missing[0]} reconstruido con la paridad")
+        await self._handle_fw_fragment(missing[0] // self.FW_BLOCK_SIZE, missing[0],
+            memoryview(recovered)[: end - missing[0]])
+
+
+    async def _handle_fragment_frame(self, frame):
+        """
+        Trata una trama binaria con un fragmento de firmware: confirma las dirigidas a
+        este dispositivo (descartando los reenvíos ya tratados), acepta las del grupo
+        multicast de la descarga en curso y entrega el fragmento a la descarga.
+        """
+        frame_type, device_mac, seq, index, offset = struct_unpack_from(self.FRAME_HEADER_FORMAT, frame)
+        if frame_type == self.FW_FRAGMENT_FRAME and device_mac == self.device_mac:
+            await self._send_ack(seq)
+            if seq in self.last_reliable_msgs_received:
+                return
+            self.last_reliable_msgs_received.append(seq)
+        elif frame_type == self.FW_FRAGMENT_FRAME or device_mac != self.fw_group_mac:
+            log.debug("La trama no lleva la identificación de este dispositivo ni de su grupo")
+            return
+        if not self.downloading_firmware:
+            log.warning(f"Fragmento de firmware {index} recibido sin una descarga en curso")
+            return
+        payload = memoryview(frame)[self.FRAME_HEADER_SIZE:]
+        if frame_type == self.FW_PARITY_FRAME:
+            await self._handle_fw_parity(index, offset, seq, payload)
         else:
+            await self._handle_fw_fragment(index, offset, payload)
+
+
+    async def _manage_ota(self, msg_data):
+
+        # Consulta del gateway sobre los fragmentos recibidos (también tras completar la
+        # descarga, por si el informe final se perdió)
+        if "fw_query" in msg_data:
+            if self.downloading_firmware or self.fw_bitmap is not None:
+                asyncio_create_task(self._report_fw_bitmap(msg_data["fw_query"], msg_data.get("spread", 0)))
+            return
+
+        # Transferencia cancelada (o abandonada) por el gateway
+        if "fw_cancel" in msg_data:
+            if self.downloading_firmware:
+                self._fail_fw_download("Transferencia de firmware cancelada por el gateway")
+            return
+
+        # Transferencia a un grupo: se aceptan también las tramas dirigidas a este id
+        if "fw_group" in msg_data:
+            self.fw_group = msg_data["fw_group"]
+            self.fw_group_mac = unhexlify(self.fw_group)
+            log.info(f"Miembro del grupo multicast {self.fw_group}")
+            return
+
+        # Durante la descarga el firmware llega en tramas binarias (_handle_fragment_frame)
+        if not self.downloading_firmware:
 
             if not self._read_fw_attrs(msg_data):
                 return
@@ -239,6 +527,11 @@ class UpdatableLoraNode():
             # (al recibirlo en Thingsboard, el rule chain activará ls transferencia de la OTA)
             downloading_state_telemetry = { "fw_state" : "DOWNLOADING" }
             asyncio_create_task(self.reliable_send("telemetry", downloading_state_telemetry ))
+            gc_collect()
+            # Los fragmentos se escriben en su offset, en el orden en que lleguen
+            self.fw_sink = FirmwareSink(self.fw_filename, self.fw_size)
+            self.blocks_total = (self.fw_size + self.FW_BLOCK_SIZE - 1) // self.FW_BLOCK_SIZE
+            self.fw_bitmap = bytearray((self.blocks_total + 7) // 8)
             self.downloading_firmware = True
             log.info("Esperando transferencia de firmware")
 
@@ -249,20 +542,41 @@ class UpdatableLoraNode():
         ack_count = msg_data.get('ack')
         required_ack_count = msg_data.get('requires_ack')
 
-        # El mensaje es un ACK
+        # El mensaje es un ACK (con el campo opcional "sack" confirma también mensajes anteriores)
         if ack_count != None:
-            self.received_acks.add(ack_count)
+            sack = msg_data.get('sack', 0)
+            for i in range(-1, self.SACK_BITS):
+                if i < 0 or sack & (1 << i):
+                    count = (ack_count - 1 - i) % self.ACK_MAX_COUNT
+                    if count in self.awaited_acks and count not in self.received_acks:
+                        self.received_acks[count] = ticks_ms()
+                        self.awaited_acks[count].set()
             return
 
         # El mensaje requiere confirmación
         elif required_ack_count != None:
-            await self.send("ack", {"count": required_ack_count})
+            await self._send_ack(required_ack_count)
             if required_ack_count in self.last_reliable_msgs_received:
                 # log.debug("El mensaje ya ha sido tratado")
                 return
             else:
                 self.last_reliable_msgs_received.append(required_ack_count)
 
+        # Varios mensajes agrupados en una trama (confirmados con un único ACK)
+        if "batch" in msg_data:
+            for batched_msg_data in msg_data["batch"]:
+                await self._process_msg_data(batched_msg_data)
+        else:
+            await self._process_msg_data(msg_data)
+
+
+    async def _process_msg_data(self, msg_data):
+
+        # Cambio de SF anunciado por el gateway (el ACK ya se ha enviado con el SF anterior)
+        if "lora_sf" in msg_data:
+            asyncio_create_task(self._switch_sf(msg_data["lora_sf"], msg_data.get("in_s", 0)))
+            return
+
         # Manejo de una posible actualización OTA
         await self._manage_ota(msg_data)
 
@@ -277,16 +591,26 @@ class UpdatableLoraNode():
 
     async def listen(self):
         log.info("A la escucha de mensajes LoRa")
-        async for rx in self.lora_modem.recv_continuous():
-            log.debug(f'Paquete recibido ({len(rx)} bytes, SNR={rx.snr}, RSSI={rx.rssi}, '
-                f'valid_CRC={rx.valid_crc}). Contenido: {rx}')
-            try:
-                recv_data = json_loads(rx)
-                recv_data["id"]
-            except ValueError as e:
-                log.debug("El mensaje recibido no está en formato JSON")
-                continue
-            if recv_data.get("id") != self.device_id:
-                log.debug("El mensaje no lleva la identificación de este dispositivo")
-                continue
-            await self._handle_msg_data(recv_data)
+        silence_watch = asyncio_create_task(self._watch_gateway_silence())
+        try:
+            async for rx in self.lora_modem.recv_continuous():
+                self._record_link_quality(rx)
+                if len(rx) >= self.FRAME_HEADER_SIZE and rx[0] in self.FW_FRAME_TYPES:
+                    log.debug(f'Trama de firmware recibida ({len(rx)} bytes, SNR={rx.snr}, '
+                        f'RSSI={rx.rssi}, valid_CRC={rx.valid_crc})')
+                    await self._handle_fragment_frame(rx)
+                    continue
+                log.debug(f'Paquete recibido ({len(rx)} bytes, SNR={rx.snr}, RSSI={rx.rssi}, '
+                    f'valid_CRC={rx.valid_crc}). Contenido: {rx}')
+                try:
+                    recv_data = json_loads(rx)
+                    recv_data["id"]
+                except ValueError as e:
+                    log.debug("El mensaje recibido no está en formato JSON")
+                    continue
+                if recv_data.get("id") not in (self.device_id, self.fw_group):
+                    log.debug("El mensaje no lleva la identificación de este dispositivo ni de su grupo")
+                    continue
+                await self._handle_msg_data(recv_data)
+        finally:
+            silence_watch.cancel()
@@ -3,7 +3,7 @@ from time import sleep
 from machine import reset
 from sys import modules as sys_modules
 from json import loads as json_loads, dumps as json_dumps
-from tb_client_sdk.sdk_utils import verify_checksum
+from thingsboard_ota_helpers.firmware_sink import FirmwareSink
 import lib.tb_client_sdk.umqtt
 sys_modules['umqtt']=lib.tb_client_sdk.umqtt
 import lib.tb_client_sdk.sdk_utils
@@ -12,11 +12,12 @@ import lib.tb_client_sdk.provision_client
 sys_modules['provision_client']=lib.tb_client_sdk.provision_client
 from tb_client_sdk.tb_device_mqtt import (
     TBDeviceMqttClient, ATTRIBUTES_TOPIC, FW_VERSION_ATTR, FW_TITLE_ATTR,
-    FW_STATE_ATTR, FW_CHECKSUM_ALG_ATTR, FW_CHECKSUM_ATTR, REQUIRED_SHARED_KEYS
+    FW_STATE_ATTR, FW_CHECKSUM_ALG_ATTR, FW_CHECKSUM_ATTR, FW_SIZE_ATTR, REQUIRED_SHARED_KEYS
 )
 
 log = logging.getLogger("updatable_mqtt_client")
 EXPECTED_METADATA_SUFFIX = ".metadata.json" # Sufijo para el archivo de metadatos asociado al paquete OTA
+FIRMWARE_CHUNK_TOPIC = "v2/fw/response/"
 
 
 class UpdatableMqttClient(TBDeviceMqttClient):
@@ -26,8 +27,8 @@ class UpdatableMqttClient(TBDeviceMqttClient):
         - fw_current_title      (título del firmware actual)
         - fw_current_version    (versión actual del firmware)
         - fw_filename           (nombre de fichero para almacenar el paquete OTA que se reciba)
-    - Guardar el firmware recibido en un fichero <fw_filename>, para posibilitar
-      la actualización después de reiniciar.
+    - Guardar el firmware recibido en un fichero <fw_filename> a medida que llega (sin
+      acumularlo en memoria), para posibilitar la actualización después de reiniciar.
     - Guardar el título y versión notifados del nuevo firmware en un fichero
       <fw_filename>.metadata.json, para poder realizar una comprobación tras el reinicio.
     - No notificar estado UPDATED hasta que el dispositivo aplique la actualización
@@ -48,9 +49,15 @@ class UpdatableMqttClient(TBDeviceMqttClient):
             "current_fw_version" : fw_current_version
         }
         self.fw_file_name = fw_filename
+        self.__fw_sink = None
 
 
     def _on_decode_message(self, topic, msg):
+        # Los fragmentos del firmware no se acumulan en memoria como en el SDK: se
+        # escriben en flash con un FirmwareSink
+        if topic.startswith(FIRMWARE_CHUNK_TOPIC):
+            self.__on_firmware_chunk(msg)
+            return
         super()._on_decode_message(topic, msg)
 
         if topic.startswith(ATTRIBUTES_TOPIC):
@@ -71,22 +78,42 @@ class UpdatableMqttClient(TBDeviceMqttClient):
                 self.send_telemetry(self.current_firmware_info)
 
 
+    def __on_firmware_chunk(self, chunk):
+        """
+        Equivalente a la rama de fragmentos del SDK (que pide el siguiente fragmento con el
+        contador __current_chunk), pero escribiendo cada fragmento en el FirmwareSink.
+        MicroPython no renombra los atributos con doble guion bajo, por lo que se comparten
+        con los del SDK (igual que __request_id).
+        """
+        if self.__current_chunk == 0:
+            # Primer fragmento de una descarga: se descarta la anterior si quedó a medias
+            if self.__fw_sink is not None:
+                self.__fw_sink.abort()
+            self.__fw_sink = FirmwareSink(self.fw_file_name, int(self.firmware_info.get(FW_SIZE_ATTR)))
+        self.__fw_sink.write(chunk)
+        self.__current_chunk = self.__current_chunk + 1
+        log.debug(f"Recibido fragmento {self.__current_chunk} del firmware ({len(chunk)} bytes)")
+        if self.__fw_sink.bytes_written >= self.__fw_sink.fw_size:
+            self.__process_firmware()
+        else:
+            self.__get_firmware()
+
+
     def __process_firmware(self):
         self.current_firmware_info[FW_STATE_ATTR] = "DOWNLOADED"
         self.send_telemetry(self.current_firmware_info)
         sleep(1)
 
-        verification_result = verify_checksum(self.firmware_data, self.firmware_info.get(FW_CHECKSUM_ALG_ATTR),
+        # Si el checksum es correcto el paquete queda guardado en self.fw_file_name
+        verification_result = self.__fw_sink.finish(self.firmware_info.get(FW_CHECKSUM_ALG_ATTR),
                                                 self.firmware_info.get(FW_CHECKSUM_ATTR))
+        self.__fw_sink = None
 
         if verification_result:
             log.info('Checksum verificado')
             self.current_firmware_info[FW_STATE_ATTR] = "VERIFIED"
             self.send_telemetry(self.current_firmware_info)
             sleep(1)
-
-            with open(self.fw_file_name, "wb") as firmware_file:
-                firmware_file.write(self.firmware_data)
             log.info(f"El paquete de firmware recibido se ha guardado en {self.fw_file_name}")
 
             expected_fw_metadata = {
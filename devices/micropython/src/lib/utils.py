@@ -31,6 +31,18 @@ def read_firmware_metadata() -> dict:
     return fw_metadata
 
 
+def confirm_firmware_update():
+    """
+    Confirma que el firmware instalado en la última actualización arranca correctamente,
+    de modo que ya no se restaurará la versión anterior. Debe llamarse desde el programa
+    principal una vez que está en marcha (p.ej. tras conectarse a la plataforma); si no
+    hay ninguna actualización pendiente de confirmar, no hace nada.
+    """
+    from thingsboard_ota_helpers.ota_installer import OTAInstaller
+    ota_config = read_config_file('ota_config.json')
+    OTAInstaller(ota_config['tmp_filename']).confirm_update()
+
+
 def network_connect(network_config):
     """
     Conecta el dispositivo a una red Wi-Fi utilizando la configuración especificada
@@ -136,7 +148,8 @@ def get_updatable_lora_node():
         lora_modem=custom_lora_modem,
         fw_current_title=fw_metadata['title'],
         fw_current_version=fw_metadata['version'],
-        fw_filename=ota_config['tmp_filename']
+        fw_filename=ota_config['tmp_filename'],
+        lora_cfg=lora_config
     )
 
 
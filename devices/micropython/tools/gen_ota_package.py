@@ -6,35 +6,82 @@ import subprocess
 import os
 import tarfile
 import json
+import hashlib
+import io
+import time
 
+METADATA_FILE_NAME = "FW_METADATA.json"
+MANIFEST_FILE_NAME = "OTA_MANIFEST.json"
 
-def create_ota_pkg(out_file_dir, out_file_name=None):
+
+def build_manifest(root_dir):
+    """
+    Manifiesto (índice) con el hash SHA-256 y el tamaño de cada fichero del paquete, indexado
+    por su ruta dentro del paquete. Con él, el instalador puede planificar la instalación
+    (espacio libre necesario y ficheros que ya están instalados con el mismo contenido)
+    antes de tocar el sistema de ficheros.
+    """
+    files = {}
+    for dir_path, _, file_names in os.walk(root_dir):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            arcname = os.path.relpath(file_path, root_dir).replace(os.sep, "/")
+            if arcname == MANIFEST_FILE_NAME:
+                continue
+            with open(file_path, "rb") as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            files[arcname] = {"sha256": digest, "size": os.path.getsize(file_path)}
+    return {"files": files}
+
+
+def write_ota_pkg(root_dir, out_file_path):
+    """
+    Empaqueta root_dir en un TAR GZ con FW_METADATA.json y el manifiesto como primeros
+    miembros, de modo que el instalador puede validar el paquete leyendo solo su cabecera.
+    El manifiesto que hubiera en root_dir (el instalado en el dispositivo) se sustituye.
+    """
+    print("Generando manifiesto de ficheros")
+    manifest_bytes = json.dumps(build_manifest(root_dir), separators=(",", ":")).encode("utf-8")
+
+    print("Creando archivo comprimido TAR GZ")
+    with tarfile.open(out_file_path, "w:gz", format=tarfile.GNU_FORMAT) as tar:
+        tar.add(os.path.join(root_dir, METADATA_FILE_NAME), arcname=METADATA_FILE_NAME)
+        manifest_info = tarfile.TarInfo(MANIFEST_FILE_NAME)
+        manifest_info.size = len(manifest_bytes)
+        manifest_info.mtime = int(time.time())
+        tar.addfile(manifest_info, io.BytesIO(manifest_bytes))
+        for name in sorted(os.listdir(root_dir)):
+            if name not in (METADATA_FILE_NAME, MANIFEST_FILE_NAME):
+                tar.add(os.path.join(root_dir, name), arcname=name)
+    print(f"Archivo de salida creado: {out_file_path}")
+
+
+def create_ota_pkg(out_file_dir, out_file_name=None, source_dir=None):
 
     with tempfile.TemporaryDirectory() as temp_dir:
-        print("Copiando sistema de ficheros del dispositivo a un directorio temporal")
-        cmd = ["mpremote", "cp", "-r", ":/", temp_dir]
-        try:
-            subprocess.run(
-                cmd,
-                check=True,
-                text=True,
-                capture_output=False
-            )
-        except subprocess.CalledProcessError as e:
-            print("Error al ejecutar mpremote: ", e)
-            return -1
+        if source_dir is None:
+            print("Copiando sistema de ficheros del dispositivo a un directorio temporal")
+            cmd = ["mpremote", "cp", "-r", ":/", temp_dir]
+            try:
+                subprocess.run(
+                    cmd,
+                    check=True,
+                    text=True,
+                    capture_output=False
+                )
+            except subprocess.CalledProcessError as e:
+                print("Error al ejecutar mpremote: ", e)
+                return -1
+        else:
+            temp_dir = source_dir
 
         if out_file_name == None:
-            fw_metadata_path = os.path.join(temp_dir, "FW_METADATA.json")
+            fw_metadata_path = os.path.join(temp_dir, METADATA_FILE_NAME)
             with open(fw_metadata_path, 'r', encoding='utf-8') as archivo:
                 fw_metadata = json.load(archivo)
             out_file_name = f"{fw_metadata['title']}_{fw_metadata['version']}.tar.gz"
 
-        print("Creando archivo comprimido TAR GZ")
-        out_file_path = os.path.join(out_file_dir, out_file_name)
-        with tarfile.open(out_file_path, "w:gz", format=tarfile.GNU_FORMAT) as tar:
-            tar.add(temp_dir, arcname="/")
-        print(f"Archivo de salida creado: {out_file_path}")
+        write_ota_pkg(temp_dir, os.path.join(out_file_dir, out_file_name))
 
 
 def main():
@@ -47,6 +94,11 @@ def main():
         help="Nombre del archivo de salida (por defecto se forma a partir de la "
              "info. encontrada en FW_METADATA.json)"
     )
+    parser.add_argument(
+        "-d", "--dir", type=str, default=None,
+        help="Generar el paquete a partir de un directorio local en lugar del dispositivo "
+             "(p.ej. el contenido extraído de un paquete anterior)"
+    )
     args = parser.parse_args()
 
     this_script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -54,7 +106,7 @@ def main():
     if not os.path.exists(generated_dir):
         os.makedirs(generated_dir)
 
-    create_ota_pkg(generated_dir, args.name)
+    create_ota_pkg(generated_dir, args.name, args.dir)
 
 if __name__ == "__main__":
     main()
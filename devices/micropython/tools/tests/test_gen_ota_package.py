@@ -0,0 +1,46 @@
+import hashlib
+import json
+import tarfile
+
+import pytest
+
+from gen_ota_package import MANIFEST_FILE_NAME, METADATA_FILE_NAME, build_manifest, write_ota_pkg
+
+
+@pytest.fixture
+def fw_dir(tmp_path):
+    (tmp_path / METADATA_FILE_NAME).write_text(json.dumps({"title": "fw", "version": "v2"}))
+    (tmp_path / "main.py").write_bytes(b"print('hola')\n")
+    (tmp_path / "lib" / "app").mkdir(parents=True)
+    (tmp_path / "lib" / "app" / "util.py").write_bytes(b"")
+    # Manifiesto instalado en el dispositivo (de la versión anterior)
+    (tmp_path / MANIFEST_FILE_NAME).write_text('{"files": {}}')
+    return tmp_path
+
+
+def test_manifest_lists_every_file_with_its_hash_and_size(fw_dir):
+    manifest = build_manifest(str(fw_dir))["files"]
+
+    assert set(manifest) == {METADATA_FILE_NAME, "main.py", "lib/app/util.py"}
+    assert manifest["main.py"] == {
+        "sha256": hashlib.sha256(b"print('hola')\n").hexdigest(),
+        "size": len(b"print('hola')\n"),
+    }
+    assert manifest["lib/app/util.py"] == {"sha256": hashlib.sha256(b"").hexdigest(), "size": 0}
+
+
+def test_package_starts_with_metadata_and_manifest(fw_dir, tmp_path_factory):
+    out_path = tmp_path_factory.mktemp("out") / "fw_v2.tar.gz"
+    write_ota_pkg(str(fw_dir), str(out_path))
+
+    with tarfile.open(out_path, "r:gz") as tar:
+        members = tar.getmembers()
+        assert [member.name for member in members[:2]] == [METADATA_FILE_NAME, MANIFEST_FILE_NAME]
+        # El manifiesto del directorio se sustituye por el generado
+        assert [member.name for member in members].count(MANIFEST_FILE_NAME) == 1
+        manifest = json.loads(tar.extractfile(members[1]).read())
+        assert manifest == build_manifest(str(fw_dir))
+        for member in members[2:]:
+            if member.isfile():
+                content = tar.extractfile(member).read()
+                assert manifest["files"][member.name]["sha256"] == hashlib.sha256(content).hexdigest()
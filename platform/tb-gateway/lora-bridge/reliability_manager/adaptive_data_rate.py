@@ -0,0 +1,89 @@
+"""
+Adaptación de la tasa de datos (spreading factor y tamaño de fragmento) a la calidad del enlace.
+
+Para cada dispositivo se mantiene una media móvil de la SNR medida en los dos sentidos:
+la de subida la indica OpenMQTTGateway en cada mensaje recibido y la de bajada la
+informa el propio nodo. Con el peor de los dos sentidos se calcula el margen respecto a
+la SNR mínima que necesita cada SF para demodular, y se elige el SF más rápido que
+deja un margen suficiente. El tamaño de los fragmentos de firmware se elige con el
+margen restante: con más margen hay menos pérdidas y compensan tramas más largas.
+
+Los tamaños de fragmento son múltiplos del bloque base de la transferencia, de modo que
+los índices de los fragmentos se siguen expresando en bloques aunque cambie el tamaño.
+"""
+
+import time
+
+# SNR mínima (dB) para demodular con cada SF (hoja de datos del SX1276)
+REQUIRED_SNR_DB = {7: -7.5, 8: -10, 9: -12.5, 10: -15, 11: -17.5, 12: -20}
+MIN_MARGIN_DB = 5 # Margen mínimo exigido para usar un SF
+SNR_EWMA_WEIGHT = 0.2
+# Margen sobrante (dB) a partir del cual se usa cada tamaño de fragmento (de mayor a menor)
+FRAGMENT_SIZE_BY_MARGIN = ((10, 224), (6, 160), (3, 128), (0, 96), (float("-inf"), 64))
+FW_BLOCK_SIZE = 32 # Bloque base de la transferencia de firmware (bytes)
+STATS_MAX_AGE_S = 3600 # Las estadísticas más antiguas no se tienen en cuenta
+
+
+class LinkQuality():
+
+    def __init__(self):
+        self.uplink_snr = None
+        self.downlink_snr = None
+        self.rssi = None
+        self.updated = 0
+
+
+    @staticmethod
+    def _average(current, sample):
+        if current is None:
+            return sample
+        return (1 - SNR_EWMA_WEIGHT) * current + SNR_EWMA_WEIGHT * sample
+
+
+    def add_uplink_sample(self, snr, rssi=None):
+        self.uplink_snr = self._average(self.uplink_snr, snr)
+        if rssi is not None:
+            self.rssi = self._average(self.rssi, rssi)
+        self.updated = time.time()
+
+
+    def add_downlink_report(self, snr):
+        self.downlink_snr = self._average(self.downlink_snr, snr)
+        self.updated = time.time()
+
+
+    def worst_snr(self):
+        """
+        SNR del peor sentido del enlace, o None si no hay estadísticas recientes.
+        """
+        if time.time() - self.updated > STATS_MAX_AGE_S:
+            return None
+        samples = [snr for snr in (self.uplink_snr, self.downlink_snr) if snr is not None]
+        return min(samples) if samples else None
+
+
+    def status(self) -> dict:
+        return {"uplink_snr": self.uplink_snr, "downlink_snr": self.downlink_snr, "rssi": self.rssi}
+
+
+def recommended_sf(snr, min_sf: int, max_sf: int = 12) -> int:
+    """
+    SF más rápido (menor) que deja al menos MIN_MARGIN_DB de margen con la SNR indicada.
+    Sin estadísticas se usa min_sf (el SF configurado en la red).
+    """
+    if snr is None:
+        return min_sf
+    for sf in range(min_sf, max_sf + 1):
+        if snr - REQUIRED_SNR_DB[sf] >= MIN_MARGIN_DB:
+            return sf
+    return max_sf
+
+
+def recommended_fragment_size(snr, sf: int, default_size: int) -> int:
+    if snr is None:
+        return default_size
+    spare_margin = snr - REQUIRED_SNR_DB[sf] - MIN_MARGIN_DB
+    for margin, fragment_size in FRAGMENT_SIZE_BY_MARGIN:
+        if spare_margin >= margin:
+            return fragment_size
+    return FRAGMENT_SIZE_BY_MARGIN[-1][1]
@@ -0,0 +1,90 @@
+"""
+Tiempo en el aire de las tramas LoRa y presupuesto de ciclo de trabajo.
+
+En la banda de 868 MHz cada emisor puede ocupar el canal como mucho un porcentaje del
+tiempo (normalmente el 1%, medido sobre una hora). El presupuesto se lleva con un cubo
+de fichas: se recarga a razón de duty_cycle segundos de transmisión por segundo, hasta
+un máximo de duty_cycle * window_s. Una trama se puede enviar siempre que el saldo no
+sea negativo, y su tiempo en el aire se descuenta después (el saldo puede quedar en
+deuda), de modo que la ocupación media nunca supera el límite legal.
+"""
+
+import math
+import time
+
+
+def time_on_air(payload_len: int, sf: int, bw_khz: float, coding_rate: int, preamble_len: int,
+    crc: bool = True, explicit_header: bool = True
+) -> float:
+    """
+    Tiempo en el aire (segundos) de una trama LoRa de payload_len bytes, según la
+    fórmula de la hoja de datos del SX1276. coding_rate es el denominador de la tasa
+    de codificación (5 para 4/5 ... 8 para 4/8).
+    """
+    symbol_time = (2 ** sf) / (bw_khz * 1000)
+    # Optimización para tasas bajas, obligatoria si el símbolo dura más de 16 ms
+    low_dr_optimize = 1 if symbol_time > 0.016 else 0
+    payload_symbols = 8 + max(
+        math.ceil(
+            (8 * payload_len - 4 * sf + 28 + 16 * int(crc) - 20 * int(not explicit_header))
+            / (4 * (sf - 2 * low_dr_optimize))
+        ) * coding_rate,
+        0
+    )
+    return (preamble_len + 4.25) * symbol_time + payload_symbols * symbol_time
+
+
+class DutyCycleBudget():
+
+    def __init__(self, duty_cycle: float, window_s: float):
+        """
+        Parámetros:
+            duty_cycle: fracción del tiempo que se puede transmitir (p.ej. 0.01)
+            window_s: periodo sobre el que se mide el ciclo de trabajo
+        """
+        self.duty_cycle = duty_cycle
+        self.capacity = duty_cycle * window_s
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self._updated) * self.duty_cycle, self.capacity)
+        self._updated = now
+
+
+    def consume(self, airtime: float):
+        self._refill()
+        self.tokens -= airtime
+
+
+    def ready_in(self) -> float:
+        """
+        Segundos que faltan para poder transmitir (0 si ya se puede).
+        """
+        self._refill()
+        return max(-self.tokens / self.duty_cycle, 0)
+
+
+    def status(self) -> dict:
+        self._refill()
+        return {"available_airtime_s": self.tokens, "max_airtime_s": self.capacity}
+
+
+    def snapshot(self) -> dict:
+        """
+        Saldo actual y el instante (epoch) al que corresponde, para conservarlo tras un reinicio.
+        """
+        self._refill()
+        return {"tokens": self.tokens, "at": time.time()}
+
+
+    def restore(self, snapshot: dict):
+        """
+        Retoma el saldo guardado con snapshot(), recargado con el tiempo transcurrido desde
+        entonces: un reinicio no devuelve el presupuesto completo.
+        """
+        elapsed = max(time.time() - snapshot["at"], 0)
+        self.tokens = min(snapshot["tokens"] + elapsed * self.duty_cycle, self.capacity)
+        self._updated = time.monotonic()
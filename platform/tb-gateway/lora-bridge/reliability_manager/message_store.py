@@ -0,0 +1,163 @@
+"""
+Almacenamiento persistente de los mensajes fiables hacia LoRa.
+
+Los mensajes se guardan en una base de datos SQLite en modo WAL desde que se reciben
+hasta que el dispositivo los confirma (o se descartan), junto con el número de secuencia
+con el que se han enviado y el siguiente número de secuencia de cada dispositivo. Así,
+tras un reinicio del servicio se retoman los envíos pendientes y los que estaban en
+vuelo con las mismas secuencias, sin que el nodo tenga que volver a empezar. También se
+guarda el estado de la red que debe sobrevivir a un reinicio (p.ej. el SF en uso).
+
+Las escrituras se agrupan en transacciones que se confirman con flush(), de modo que
+varios mensajes recibidos seguidos (p.ej. los fragmentos de un firmware) comparten un
+único fsync.
+"""
+
+import json
+import sqlite3
+
+
+class StoredMessage():
+
+    def __init__(self, row_id, device_id, lane, msg_data, seq, tries):
+        self.row_id = row_id
+        self.device_id = device_id
+        self.lane = lane
+        self.msg_data = msg_data
+        self.seq = seq # None si aún no se ha enviado
+        self.tries = tries
+
+
+class MessageStore():
+
+    def __init__(self, path: str):
+        """
+        Parámetros:
+            path: ruta del fichero de la base de datos (se crea si no existe)
+        """
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, device_id TEXT NOT NULL, lane TEXT NOT NULL, "
+            "payload BLOB NOT NULL, binary INTEGER NOT NULL, seq INTEGER, tries INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS devices (device_id TEXT PRIMARY KEY, next_seq INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS registered_devices (device_id TEXT PRIMARY KEY)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._in_transaction = False
+
+
+    def _begin(self):
+        if not self._in_transaction:
+            self._db.execute("BEGIN")
+            self._in_transaction = True
+
+
+    def add(self, device_id, lane, msg_data) -> int:
+        """
+        Guarda un mensaje pendiente de envío y devuelve su identificador.
+        msg_data es un diccionario (mensaje JSON) o un bytearray (trama binaria).
+        """
+        self._begin()
+        binary = isinstance(msg_data, bytearray)
+        payload = bytes(msg_data) if binary else json.dumps(msg_data).encode('utf-8')
+        cursor = self._db.execute(
+            "INSERT INTO messages (device_id, lane, payload, binary) VALUES (?, ?, ?, ?)",
+            (device_id, lane, payload, int(binary))
+        )
+        return cursor.lastrowid
+
+
+    def mark_sent(self, row_id, seq, next_seq):
+        """
+        Registra la secuencia asignada a un mensaje y la siguiente secuencia del dispositivo.
+        """
+        self._begin()
+        self._db.execute("UPDATE messages SET seq = ?, tries = 1 WHERE id = ?", (seq, row_id))
+        self._db.execute(
+            "INSERT INTO devices (device_id, next_seq) SELECT device_id, ? FROM messages WHERE id = ? "
+            "ON CONFLICT(device_id) DO UPDATE SET next_seq = excluded.next_seq",
+            (next_seq, row_id)
+        )
+
+
+    def mark_retry(self, row_id, tries):
+        self._begin()
+        self._db.execute("UPDATE messages SET tries = ? WHERE id = ?", (tries, row_id))
+
+
+    def remove(self, row_id):
+        """
+        Elimina un mensaje confirmado o descartado.
+        """
+        self._begin()
+        self._db.execute("DELETE FROM messages WHERE id = ?", (row_id,))
+
+
+    def register_device(self, device_id):
+        self._begin()
+        self._db.execute("INSERT OR IGNORE INTO registered_devices VALUES (?)", (device_id,))
+
+
+    def unregister_device(self, device_id):
+        """
+        Da de baja un dispositivo, descartando sus mensajes pendientes y su secuencia.
+        """
+        self._begin()
+        self._db.execute("DELETE FROM registered_devices WHERE device_id = ?", (device_id,))
+        self._db.execute("DELETE FROM messages WHERE device_id = ?", (device_id,))
+        self._db.execute("DELETE FROM devices WHERE device_id = ?", (device_id,))
+
+
+    def registered_devices(self) -> list:
+        return [row[0] for row in self._db.execute("SELECT device_id FROM registered_devices")]
+
+
+    def set_setting(self, name, value):
+        """
+        Guarda un valor serializable en JSON (None lo elimina).
+        """
+        self._begin()
+        if value is None:
+            self._db.execute("DELETE FROM settings WHERE name = ?", (name,))
+        else:
+            self._db.execute(
+                "INSERT INTO settings (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                (name, json.dumps(value))
+            )
+
+
+    def get_setting(self, name, default=None):
+        row = self._db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+
+    def flush(self):
+        """
+        Confirma en disco todas las escrituras pendientes.
+        """
+        if self._in_transaction:
+            self._db.execute("COMMIT")
+            self._in_transaction = False
+
+
+    def next_seqs(self) -> dict:
+        return dict(self._db.execute("SELECT device_id, next_seq FROM devices"))
+
+
+    def pending_messages(self) -> list:
+        """
+        Mensajes guardados (enviados o no) en el orden en que se recibieron.
+        """
+        messages = []
+        for row_id, device_id, lane, payload, binary, seq, tries in self._db.execute(
+            "SELECT id, device_id, lane, payload, binary, seq, tries FROM messages ORDER BY id"
+        ):
+            msg_data = bytearray(payload) if binary else json.loads(payload)
+            messages.append(StoredMessage(row_id, device_id, lane, msg_data, seq, tries))
+        return messages
@@ -3,114 +3,1008 @@ import paho.mqtt.client as mqtt
 import os
 import json
 import threading
-import queue
 import time
+import random
+from collections import OrderedDict, deque
+from message_store import MessageStore
+from lora_airtime import DutyCycleBudget, time_on_air
+from adaptive_data_rate import LinkQuality, recommended_sf, recommended_fragment_size, FW_BLOCK_SIZE
 
 MQTT_BROKER_HOST = "host.docker.internal"
 MQTT_BROKER_PORT = 1884
 MQTT_TO_LORA_TOPIC = "thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA"
+MQTT_FROM_LORA_TOPIC = "thingsboard/OMG_ESP32_LORA/LORAtoMQTT"
+MQTT_RELIABLE_TO_LORA_TOPIC = "thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/reliable"
+# Envíos multicast (sin ACK) a un grupo de dispositivos: MQTT_MULTICAST_TO_LORA_TOPIC/<grupo>.
+# Se transmiten una sola vez, en el orden en que llegan y en el carril bulk
+MQTT_MULTICAST_TO_LORA_TOPIC = "thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/multicast"
+# Alta y baja de dispositivos en tiempo de ejecución: se publica {"id": "<id>"} en
+# MQTT_ADMIN_TOPIC/register o MQTT_ADMIN_TOPIC/unregister. La lista de dispositivos
+# registrados se publica (retained) en MQTT_DEVICES_TOPIC. Con MQTT_ADMIN_TOPIC/purge se
+# descartan los envíos del carril bulk pendientes hacia un dispositivo o grupo (al
+# cancelarse una transferencia de firmware)
+MQTT_ADMIN_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/admin"
+# Los mensajes fiables desde LoRa se reenvían una sola vez (sin las copias de los reenvíos)
+# a MQTT_DEDUPLICATED_TOPIC/<id>/<subtopic>, que es donde los recoge Thingsboard
+MQTT_DEDUPLICATED_TOPIC = "thingsboard/OMG_ESP32_LORA/deduplicated"
+MQTT_DEVICES_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/devices"
 MAX_RETRIES = 4
+MQTT_RTT_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/{}/rtt" # Estimaciones publicadas (retained)
+# Resultado de cada envío del carril bulk, para seguir el progreso real de las transferencias:
+# {"status": "ACKED" | "DROPPED" (dispositivos) | "SENT" (grupos), "bytes": bytes de firmware}
+MQTT_DELIVERY_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/{}/delivery"
+# Estado del gestor (retained, cada STATUS_INTERVAL_S segundos): SF de la red, presupuesto de
+# ciclo de trabajo y mensajes pendientes de cada dispositivo
+MQTT_STATUS_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/status"
+STATUS_INTERVAL_S = 30
 ACK_MAX_COUNT = 100
+# Bits del campo "sack" de los ACKs: el bit i confirma también la secuencia count-1-i
+SACK_BITS = 8
+
+# Estimación del RTT (RFC 6298): timeout = SRTT + 4*RTTVAR, acotado entre MIN y MAX.
+# Mientras no hay muestras se usa INITIAL_RTO_S. Cada reenvío duplica el timeout del
+# mensaje (con un jitter de hasta RTO_JITTER) para no saturar un enlace degradado.
+INITIAL_RTO_S = 10
+MIN_RTO_S = 1
+MAX_RTO_S = 60
+RTT_ALPHA = 1/8
+RTT_BETA = 1/4
+RTO_JITTER = 0.25
+
+# Tamaño máximo del contenido de una trama LoRa. Los mensajes JSON pendientes para un mismo
+# dispositivo se agrupan en una sola trama ({"id", "requires_ack", "batch": [...]}) mientras quepan
+LORA_MAX_PAYLOAD = int(os.getenv('lora_max_payload', '255'))
+
+# Caché de mensajes fiables ya reenviados, para descartar las copias
+DEDUP_TTL_S = 120
+DEDUP_MAX_ENTRIES = 10000
+
+# Carriles de prioridad de los mensajes hacia LoRa, de mayor a menor prioridad:
+#   control: atributos (inicio de OTA), cambios de SF, cancelaciones de transferencias, etc.
+#   interactive: RPCs enviadas desde Thingsboard
+#   bulk: fragmentos de firmware (tramas binarias) y mensajes de la misma transferencia
+#         (BULK_JSON_KEYS), que no deben adelantar a los fragmentos encolados antes que ellos
+LANES = ("control", "interactive", "bulk")
+# Cuando hay fragmentos esperando, al menos 1 de cada BULK_SHARE_INTERVAL+1 envíos nuevos es
+# del carril bulk, para que las transferencias avancen aunque haya tráfico prioritario constante
+BULK_SHARE_INTERVAL = 4
+BULK_JSON_KEYS = ("fw_query", "fw_group")
+
+# Tramas binarias (fragmentos de firmware). El primer byte indica el tipo de trama y el
+# byte FRAME_SEQ_OFFSET lleva el número de secuencia fiable, que se rellena aquí (salvo en
+# las tramas multicast, que no la usan). OpenMQTTGateway las transmite tal cual si se le
+# entregan en el campo "hex". Tipos: 0xF1 fragmento, 0xF2 fragmento multicast, 0xF3 paridad
+BINARY_FRAME_TYPES = (0xF1, 0xF2, 0xF3)
+PARITY_FRAME_TYPE = 0xF3
+FRAME_HEADER_SIZE = 14
+FRAME_SEQ_OFFSET = 7
+
+# Adaptación de la tasa de datos (ADR). OpenMQTTGateway tiene una sola radio, así que el SF
+# es común a toda la red: se usa el que necesita el dispositivo con peor enlace (nunca menor
+# que lora_sf). El cambio se anuncia a todos los dispositivos con el mensaje fiable
+# {"lora_sf": sf, "in_s": segundos}, donde in_s es lo que falta (recalculado en cada envío)
+# para el instante del cambio, SF_SWITCH_DELAY_S después del anuncio: el gateway y los nodos
+# cambian a la vez. Con un SF distinto del base, si ninguno de los dispositivos oídos
+# recientemente responde (todos han agotado los reenvíos de algún mensaje desde la última vez
+# que se les oyó), el gateway anuncia la vuelta a lora_sf del mismo modo; un nodo apagado no
+# basta para ello. Los nodos vuelven si se agotan sus reenvíos o si no oyen nada durante
+# un tiempo (con un SF distinto del base el gateway emite una baliza cada
+# SF_BEACON_INTERVAL_S si no ha transmitido otra cosa), de modo que un cambio fallido no deja
+# a nadie incomunicado. El SF de la red y el cambio en curso se conservan entre reinicios.
+# El tamaño de fragmento de firmware recomendado para cada nodo se publica (retained) en
+# MQTT_DATARATE_TOPIC junto con el SF actual, para el servicio de transferencia OTA.
+MQTT_LORA_CONFIG_TOPIC = "thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/config"
+MQTT_DATARATE_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/{}/datarate"
+ADR_MIN_INTERVAL_S = 600 # Tiempo mínimo entre dos cambios de SF
+ADR_HYSTERESIS_DB = 3 # Margen adicional exigido para bajar de SF (evita oscilaciones)
+DEFAULT_FRAGMENT_SIZE = 128 # Tamaño de fragmento mientras no hay estadísticas del enlace
+SF_SWITCH_DELAY_S = (MAX_RETRIES + 1) * MAX_RTO_S # Da tiempo a agotar los reenvíos del anuncio
+SF_BEACON_INTERVAL_S = 300
+SF_BEACON_ID = "ffffffffffff" # No coincide con ningún nodo: solo indica que el gateway sigue ahí
 
 # Environment variables
 username = os.getenv('mqtt_user')
 password = os.getenv('mqtt_password')
-id_list = os.getenv('device_id_list').split(',')
-print(f"IDs de los dispositivos a manejar: {id_list}")
+# Dispositivos registrados al arrancar (se añaden a los registrados en ejecuciones anteriores)
+id_list = [device_id for device_id in os.getenv('device_id_list', '').split(',') if device_id]
+# Mensajes que pueden estar pendientes de ACK a la vez en cada dispositivo (repetición selectiva)
+window_size = min(int(os.getenv('window_size', '4')), SACK_BITS)
+# Parámetros de radio del gateway LoRa (para calcular el tiempo en el aire de cada trama)
+# y ciclo de trabajo máximo permitido en la banda (1% en 868 MHz, medido sobre una hora)
+lora_sf = int(os.getenv('lora_sf', '7'))
+lora_bw_khz = float(os.getenv('lora_bw_khz', '125'))
+lora_coding_rate = int(os.getenv('lora_coding_rate', '5'))
+lora_preamble_len = int(os.getenv('lora_preamble_len', '8'))
+lora_duty_cycle = float(os.getenv('lora_duty_cycle', '0.01'))
+lora_duty_cycle_window_s = float(os.getenv('lora_duty_cycle_window_s', '3600'))
+# Base de datos donde se guardan los mensajes pendientes (debe estar en un volumen persistente)
+store_path = os.getenv('store_path', '/data/reliability_manager.db')
 
-estimated_rtt_time = 5 # (segundos) Este valor  puede ir reduciéndose si se detectan ACKs que tardan menos en volver
-retry_timeout = estimated_rtt_time * 2
-
-to_lora_queue = queue.Queue()
 mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-expected_ack_count = 0
-ack_received_event = threading.Event()
+window_condition = threading.Condition() # Protege el estado de los canales y el almacén
+store = MessageStore(store_path)
+airtime_budget = DutyCycleBudget(lora_duty_cycle, lora_duty_cycle_window_s)
+network_sf = lora_sf # SF con el que transmite y recibe actualmente el gateway
+sf_switch = None # Cambio de SF anunciado: {"sf": nuevo SF, "at": instante del cambio (epoch)}
+last_sf_change = 0
+last_transmission = 0
+
+
+class RttEstimator():
+    """
+    Estimador del tiempo de ida y vuelta de un dispositivo (SRTT/RTTVAR, RFC 6298).
+    Solo debe alimentarse con muestras de mensajes no reenviados (algoritmo de Karn),
+    ya que el ACK de un mensaje reenviado no indica a qué transmisión responde.
+    """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO_S
+
+
+    def add_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO_S), MAX_RTO_S)
+
+
+    def timeout(self, tries) -> float:
+        """
+        Timeout para la transmisión número tries de un mensaje (backoff exponencial con jitter).
+        """
+        backoff = min(self.rto * 2 ** (tries - 1), MAX_RTO_S)
+        return backoff * random.uniform(1, 1 + RTO_JITTER)
+
+
+    def status(self) -> dict:
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto}
+
+
+class PendingMessage():
+
+    def __init__(self, row_ids, msg_data, payload, lane, timeout, fw_bytes=0):
+        self.row_ids = row_ids # Identificadores en el almacén de los mensajes que contiene
+        self.msg_data = msg_data
+        self.payload = payload
+        self.lane = lane
+        self.fw_bytes = fw_bytes # Bytes de firmware que lleva (tramas binarias)
+        self.first_sent = time.time()
+        self.deadline = self.first_sent + timeout
+        self.tries = 1
+
+
+class DeviceChannel():
+    """
+    Estado de la entrega fiable hacia un dispositivo: cada dispositivo tiene su propio
+    espacio de secuencias, sus colas de mensajes (una por carril) y su ventana de
+    mensajes en vuelo, de modo que un nodo que no responde no retrasa la entrega al resto.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.next_seq = 0
+        # Mensajes pendientes de enviar: (identificador en el almacén, mensaje)
+        self.queues = {lane: deque() for lane in LANES}
+        self.in_flight = {} # secuencia -> PendingMessage enviado y aún sin confirmar
+        # Secuencias recibidas recientemente del dispositivo, para los ACKs selectivos
+        self.received_seqs = deque([], SACK_BITS)
+        self.rtt = RttEstimator()
+        self.link = LinkQuality()
+        self.datarate = None # Última tasa de datos publicada para el dispositivo
+        self.failing = False # Ha agotado los reenvíos de un mensaje desde la última vez que se le oyó
+
+
+    def can_send(self, lane) -> bool:
+        if not self.queues[lane] or len(self.in_flight) >= window_size:
+            return False
+        if lane != "bulk":
+            return True
+        # Un mensaje JSON del carril bulk (p.ej. la consulta de fragmentos recibidos) espera a
+        # que se resuelvan los fragmentos anteriores, para que el nodo responda con todos ellos
+        if not isinstance(self.queues[lane][0][1], bytearray):
+            return self.bulk_in_flight() == 0
+        # Los fragmentos no ocupan toda la ventana: siempre queda un hueco para el
+        # tráfico prioritario
+        return self.bulk_in_flight() < max(window_size - 1, 1)
+
+
+    def bulk_in_flight(self) -> int:
+        return sum(1 for pending in self.in_flight.values() if pending.lane == "bulk")
+
+
+    def take_batch(self, lane) -> list:
+        """
+        Saca de las colas el siguiente mensaje del carril indicado y, si es un mensaje
+        JSON, los mensajes JSON que le siguen mientras quepan junto a él en una trama.
+        """
+        batch = [self.queues[lane].popleft()]
+        if lane == "bulk":
+            return batch
+        for batch_lane in ("control", "interactive"):
+            queue = self.queues[batch_lane]
+            while queue:
+                candidate = [msg_data for _, msg_data in batch] + [queue[0][1]]
+                # Se mide con la mayor secuencia posible (2 dígitos)
+                if lora_payload_size(self.device_id, candidate, ACK_MAX_COUNT - 1) > LORA_MAX_PAYLOAD:
+                    return batch
+                batch.append(queue.popleft())
+        return batch
+
+
+    def send_next(self, lane):
+        batch = self.take_batch(lane)
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) % ACK_MAX_COUNT
+        row_ids = [row_id for row_id, _ in batch]
+        for row_id in row_ids:
+            store.mark_sent(row_id, seq, self.next_seq)
+        msg_data = batch[0][1] if len(batch) == 1 else [msg_data for _, msg_data in batch]
+        msg_to_send = format_lora_message(self.device_id, msg_data, seq)
+        print(f"Realizando envío fiable hacia LoRa del mensaje: {msg_to_send}")
+        self.in_flight[seq] = PendingMessage(row_ids, msg_data, msg_to_send.encode('utf-8'), lane,
+            self.rtt.timeout(1), fw_payload_size(msg_data))
+        transmit(self.in_flight[seq].payload)
+
+
+    def retransmit_expired(self, now):
+        for seq, pending in list(self.in_flight.items()):
+            if now < pending.deadline:
+                continue
+            if airtime_budget.ready_in() > 0:
+                return
+            if pending.tries >= MAX_RETRIES:
+                print(f"ERROR: Número máximo de reenvíos alcanzado. Descartando mensaje {seq} "
+                    f"hacia {self.device_id}")
+                del self.in_flight[seq]
+                for row_id in pending.row_ids:
+                    store.remove(row_id)
+                notify_delivery(self.device_id, pending, "DROPPED")
+                self.failing = True
+                fall_back_if_unreachable()
+                continue
+            print(f"Reenviando mensaje {seq} hacia {self.device_id} (intento {pending.tries + 1})")
+            # Se vuelve a construir: los anuncios de cambio de SF llevan el tiempo que falta
+            pending.payload = format_lora_message(self.device_id, pending.msg_data, seq).encode('utf-8')
+            transmit(pending.payload)
+            pending.tries += 1
+            for row_id in pending.row_ids:
+                store.mark_retry(row_id, pending.tries)
+            pending.deadline = now + self.rtt.timeout(pending.tries)
+
+
+    def handle_ack(self, ack_data):
+        for seq in acked_seqs(ack_data):
+            pending = self.in_flight.pop(seq, None)
+            if pending is None:
+                continue
+            for row_id in pending.row_ids:
+                store.remove(row_id)
+            notify_delivery(self.device_id, pending, "ACKED")
+            # Algoritmo de Karn: el ACK de un mensaje reenviado es ambiguo y no se usa
+            if pending.tries == 1:
+                self.rtt.add_sample(time.time() - pending.first_sent)
+                print(f"RTT de {self.device_id}: SRTT={self.rtt.srtt:.2f}s, "
+                    f"RTTVAR={self.rtt.rttvar:.2f}s, RTO={self.rtt.rto:.2f}s")
+                mqttc.publish(MQTT_RTT_TOPIC.format(self.device_id),
+                    json.dumps(self.rtt.status()), retain=True)
+
+
+class MulticastChannel():
+    """
+    Cola de los envíos multicast. No tiene secuencias ni ACKs: cada trama se transmite una
+    vez, en el carril bulk, cuando ningún dispositivo tiene fragmentos propios que enviar.
+    Como no hay ventana que limite las tramas entregadas a OpenMQTTGateway, se entrega una
+    sola cada vez y la siguiente no sale hasta que ha pasado el tiempo en el aire de la
+    anterior; entonces se avisa de que se ha emitido (SENT).
+    """
+
+    def __init__(self):
+        self.device_id = None
+        self.queue = deque()
+        self.on_air = None # (grupo, bytes de firmware, instante en que termina de emitirse)
+
+
+    def can_send(self, lane) -> bool:
+        return lane == "bulk" and bool(self.queue) and self.on_air is None
+
+
+    def send_next(self, lane):
+        group_id, payload, fw_bytes = self.queue.popleft()
+        print(f"Realizando envío multicast hacia el grupo {group_id} ({len(payload)} bytes)")
+        airtime = transmit(payload)
+        self.on_air = (group_id, fw_bytes, time.monotonic() + airtime)
+
+
+    def settle(self):
+        """
+        Avisa de la trama en curso si ya ha terminado de emitirse. Devuelve los segundos
+        que faltan para ello, o None si no hay ninguna trama en el aire.
+        """
+        if self.on_air is None:
+            return None
+        group_id, fw_bytes, ends_at = self.on_air
+        remaining = ends_at - time.monotonic()
+        if remaining > 0:
+            return remaining
+        self.on_air = None
+        mqttc.publish(MQTT_DELIVERY_TOPIC.format(group_id),
+            json.dumps({"status": "SENT", "bytes": fw_bytes}), qos=1)
+        return None
+
+
+# Canales de los dispositivos registrados, en el orden en que se les dará turno de envío
+channels = OrderedDict()
+multicast_channel = MulticastChannel()
+
+
+def get_channel(device_id) -> DeviceChannel:
+    if device_id not in channels:
+        channels[device_id] = DeviceChannel(device_id)
+    return channels[device_id]
+
+
+def notify_delivery(device_id, pending, status):
+    # Solo interesa el carril bulk (transferencias de firmware)
+    if pending.lane == "bulk":
+        mqttc.publish(MQTT_DELIVERY_TOPIC.format(device_id),
+            json.dumps({"status": status, "bytes": pending.fw_bytes}), qos=1)
+
+
+def purge_bulk_messages(target_id):
+    """
+    Descarta los envíos del carril bulk pendientes (encolados o a la espera de ACK) hacia
+    un dispositivo o un grupo multicast, p.ej. al cancelarse su transferencia de firmware.
+    """
+    with window_condition:
+        purged = 0
+        channel = channels.get(target_id)
+        if channel is not None:
+            for row_id, _ in channel.queues["bulk"]:
+                store.remove(row_id)
+            purged += len(channel.queues["bulk"])
+            channel.queues["bulk"].clear()
+            for seq, pending in list(channel.in_flight.items()):
+                if pending.lane == "bulk":
+                    del channel.in_flight[seq]
+                    for row_id in pending.row_ids:
+                        store.remove(row_id)
+                    purged += 1
+            store.flush()
+        remaining = deque(entry for entry in multicast_channel.queue if entry[0] != target_id)
+        purged += len(multicast_channel.queue) - len(remaining)
+        multicast_channel.queue = remaining
+        window_condition.notify()
+    print(f"Descartados {purged} envíos pendientes hacia {target_id}")
+
+
+def publish_device_list():
+    mqttc.publish(MQTT_DEVICES_TOPIC, json.dumps(list(channels)), retain=True)
+
+
+def register_device(device_id):
+    with window_condition:
+        if device_id in channels:
+            return
+        get_channel(device_id)
+        store.register_device(device_id)
+        store.flush()
+    print(f"Dispositivo {device_id} registrado")
+    publish_device_list()
+
+
+def unregister_device(device_id):
+    with window_condition:
+        if channels.pop(device_id, None) is None:
+            return
+        store.unregister_device(device_id)
+        store.flush()
+        for topic in [topic for topic, route in routes.items() if route[1] == device_id]:
+            del routes[topic]
+    print(f"Dispositivo {device_id} dado de baja")
+    publish_device_list()
 
 
 # Callback para el establecimiento de la conexión (se recibe CONNACK desde el servidor)
 def on_connect(client, userdata, flags, reason_code, properties):
     print(f"Connected with result code {reason_code}")
-    # Suscripciones
-    for device_id in id_list:
-        client.subscribe(f"thingsboard/OMG_ESP32_LORA/LORAtoMQTT/{device_id}/reliable/#")
-        client.subscribe(f"thingsboard/OMG_ESP32_LORA/LORAtoMQTT/{device_id}/ack")
-        client.subscribe(f"thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/reliable/{device_id}")
+    # Suscripciones (comunes a todos los dispositivos)
+    client.subscribe(f"{MQTT_FROM_LORA_TOPIC}/+/reliable/#")
+    client.subscribe(f"{MQTT_FROM_LORA_TOPIC}/+/ack")
+    client.subscribe(f"{MQTT_FROM_LORA_TOPIC}/+/link")
+    client.subscribe(f"{MQTT_RELIABLE_TO_LORA_TOPIC}/+")
+    client.subscribe(f"{MQTT_MULTICAST_TO_LORA_TOPIC}/+")
+    client.subscribe(f"{MQTT_ADMIN_TOPIC}/+")
+    publish_device_list()
 
 
-# Recepción de mensajes
-def on_message(client, userdata, msg):
+class DedupCache():
+    """
+    Mensajes fiables recibidos recientemente, por (dispositivo, secuencia). Un mensaje es
+    una copia si ya se recibió uno con la misma secuencia y el mismo contenido antes de
+    DEDUP_TTL_S segundos (el contenido se compara por si el nodo se ha reiniciado y ha
+    vuelto a empezar la numeración). La caché está acotada a DEDUP_MAX_ENTRIES entradas.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict() # (dispositivo, secuencia) -> (expiración, contenido)
+
+
+    def is_duplicate(self, device_id, seq, content) -> bool:
+        now = time.time()
+        while self._entries and (
+            len(self._entries) >= DEDUP_MAX_ENTRIES or next(iter(self._entries.values()))[0] <= now
+        ):
+            self._entries.popitem(last=False)
+        entry = self._entries.get((device_id, seq))
+        if entry is not None and entry[0] > now and entry[1] == content:
+            return True
+        self._entries.pop((device_id, seq), None)
+        self._entries[(device_id, seq)] = (now + DEDUP_TTL_S, content)
+        # La secuencia opuesta en el espacio circular ya no puede llegar como copia de un
+        # mensaje reciente: se olvida para no confundirla con el siguiente uso del número
+        self._entries.pop((device_id, (seq + ACK_MAX_COUNT // 2) % ACK_MAX_COUNT), None)
+        return False
+
+
+dedup_cache = DedupCache()
+
+
+def is_binary_frame(payload) -> bool:
+    return len(payload) >= FRAME_HEADER_SIZE and payload[0] in BINARY_FRAME_TYPES
+
+
+def fw_payload_size(msg_data) -> int:
+    # Bytes de firmware que transporta un mensaje (las tramas de paridad no cuentan)
+    if not isinstance(msg_data, (bytes, bytearray)) or msg_data[0] == PARITY_FRAME_TYPE:
+        return 0
+    return len(msg_data) - FRAME_HEADER_SIZE
+
+
+def sack_mask(seq, received) -> int:
+    """
+    Máscara de ACK selectivo: el bit i indica que también se ha recibido la
+    secuencia (seq-1-i) módulo ACK_MAX_COUNT.
+    """
+    mask = 0
+    for i in range(SACK_BITS):
+        if (seq - 1 - i) % ACK_MAX_COUNT in received:
+            mask |= 1 << i
+    return mask
+
+
+def acked_seqs(ack_data) -> list:
+    """
+    Secuencias confirmadas por un ACK: la del campo "count" y, si está presente,
+    las indicadas en la máscara "sack".
+    """
+    seq = ack_data.get("count")
+    if seq is None:
+        return []
+    mask = ack_data.get("sack", 0)
+    return [seq] + [(seq - 1 - i) % ACK_MAX_COUNT for i in range(SACK_BITS) if mask & (1 << i)]
+
+
+def message_lane(msg_data) -> str:
+    if isinstance(msg_data, bytearray):
+        return "bulk"
+    if "rpc" in msg_data:
+        return "interactive"
+    if any(key in msg_data for key in BULK_JSON_KEYS):
+        return "bulk"
+    return "control"
+
+
+def enqueue_to_lora(device_id, msg_data):
+    with window_condition:
+        channel = channels.get(device_id)
+        if channel is None: # Dado de baja mientras tanto
+            return
+        lane = message_lane(msg_data)
+        row_id = store.add(device_id, lane, msg_data)
+        channel.queues[lane].append((row_id, msg_data))
+        window_condition.notify()
+        return row_id
+
+
+def publish_datarate(channel):
+    """
+    Publica el SF actual y el tamaño de fragmento recomendado para el dispositivo, si han cambiado.
+    """
+    snr = channel.link.worst_snr()
+    fragment_size = recommended_fragment_size(snr, network_sf, DEFAULT_FRAGMENT_SIZE)
+    # Los fragmentos deben caber en una trama junto con su cabecera
+    max_fragment_size = (LORA_MAX_PAYLOAD - FRAME_HEADER_SIZE) // FW_BLOCK_SIZE * FW_BLOCK_SIZE
+    datarate = {"sf": network_sf, "fragment_size": min(fragment_size, max_fragment_size)}
+    if datarate == channel.datarate:
+        return
+    channel.datarate = datarate
+    print(f"Tasa de datos para {channel.device_id}: {datarate}")
+    mqttc.publish(MQTT_DATARATE_TOPIC.format(channel.device_id),
+        json.dumps({**datarate, **channel.link.status()}), retain=True)
+
+
+def target_network_sf() -> int:
+    snrs = [channel.link.worst_snr() for channel in channels.values()]
+    target = max((recommended_sf(snr, lora_sf) for snr in snrs), default=lora_sf)
+    if target < network_sf:
+        # Para bajar de SF se exige un margen adicional; si no lo hay, se mantiene el actual
+        target = min(max(
+            (recommended_sf(None if snr is None else snr - ADR_HYSTERESIS_DB, lora_sf) for snr in snrs),
+            default=lora_sf
+        ), network_sf)
+    return target
+
+
+def adapt_network_sf():
+    """
+    Anuncia un cambio de SF si el peor enlace lo requiere.
+    """
+    target = target_network_sf()
+    if target == network_sf or sf_switch is not None or time.time() - last_sf_change < ADR_MIN_INTERVAL_S:
+        return
+    announce_sf_switch(target)
+
+
+def fall_back_if_unreachable():
+    """
+    Anuncia la vuelta a lora_sf si, con un SF distinto, ningún dispositivo oído recientemente
+    responde y alguno ha dejado de hacerlo. Los dispositivos sin estadísticas recientes (p.ej.
+    apagados) no impiden ni provocan la vuelta por sí solos.
+    """
+    if network_sf == lora_sf or sf_switch is not None:
+        return
+    if any(channel.link.worst_snr() is not None and not channel.failing for channel in channels.values()):
+        return
+    if any(channel.failing for channel in channels.values()):
+        print(f"Ningún dispositivo responde con SF{network_sf}. Volviendo a SF{lora_sf}")
+        announce_sf_switch(lora_sf)
+
+
+def announce_sf_switch(target):
+    """
+    El gateway y los dispositivos cambian de SF en el mismo instante, SF_SWITCH_DELAY_S
+    después del anuncio (reliable_delivery).
+    """
+    global sf_switch
+    sf_switch = {"sf": target, "at": time.time() + SF_SWITCH_DELAY_S}
+    print(f"Cambiando el SF de la red de {network_sf} a {target} dentro de {SF_SWITCH_DELAY_S} s")
+    store.set_setting("sf_switch", sf_switch)
+    for device_id in list(channels):
+        enqueue_to_lora(device_id, {"lora_sf": target, "at": sf_switch["at"]})
+
+
+def apply_network_sf(sf):
+    global network_sf, sf_switch, last_sf_change
+    network_sf = sf
+    sf_switch = None
+    last_sf_change = time.time()
+    store.set_setting("network_sf", sf)
+    store.set_setting("sf_switch", None)
+    store.flush()
+    for channel in channels.values():
+        channel.failing = False
+    mqttc.publish(MQTT_LORA_CONFIG_TOPIC, json.dumps({"spreadingfactor": sf}), qos=1, retain=True)
+    print(f"SF del gateway: {sf}")
+    for channel in channels.values():
+        publish_datarate(channel)
+
+
+def record_uplink_quality(device_id, message_data):
+    # OpenMQTTGateway añade a cada mensaje recibido la SNR y el RSSI medidos
+    snr = message_data.get("snr")
+    if snr is None:
+        return
+    with window_condition:
+        channel = channels.get(device_id)
+        if channel is None:
+            return
+        channel.link.add_uplink_sample(snr, message_data.get("rssi"))
+        channel.failing = False
+        publish_datarate(channel)
+        adapt_network_sf()
+
+
+def handle_to_lora(client, device_id, msg):
+    # Trama binaria hacia LoRa: se reenvía sin descodificar
+    if is_binary_frame(msg.payload):
+        print(f">>>> {msg.topic} | trama binaria de {len(msg.payload)} bytes")
+        enqueue_to_lora(device_id, bytearray(msg.payload))
+        return
+    message_data = decode_json_message(msg)
+    if message_data is not None:
+        # Mensaje hacia LoRa (activamos rutina de reenvío hasta recibir ACK)
+        enqueue_to_lora(device_id, message_data)
+
+
+def handle_multicast_to_lora(client, group_id, msg):
+    if is_binary_frame(msg.payload):
+        print(f">>>> {msg.topic} | trama binaria de {len(msg.payload)} bytes")
+        payload = json.dumps({"hex": msg.payload.hex()})
+        fw_bytes = fw_payload_size(msg.payload)
+    else:
+        message_data = decode_json_message(msg)
+        if message_data is None:
+            return
+        payload = format_text_message({**message_data, "id": group_id})
+        fw_bytes = 0
+    with window_condition:
+        multicast_channel.queue.append((group_id, payload.encode('utf-8'), fw_bytes))
+        window_condition.notify()
+
+
+def handle_reliable_from_lora(client, device_id, msg):
+    message_data = decode_json_message(msg)
+    if message_data is None:
+        return
+    # Mensaje desde LoRa (devolveremos ACK)
+    print(f"Mensaje para confirmar proveniente del dispositivo {device_id}")
+    ack_count = message_data.get("count")
+    if ack_count == None:
+        print('ERROR: El JSON recibido no contiene un campo "count"')
+        return
+    record_uplink_quality(device_id, message_data)
+    ack_msg = {"id": device_id, "ack": ack_count}
+    with window_condition:
+        received = channels[device_id].received_seqs if device_id in channels else deque()
+        sack = sack_mask(ack_count, received)
+        if ack_count not in received:
+            received.append(ack_count)
+    if sack:
+        ack_msg["sack"] = sack
+    # Las copias también se confirman (puede haberse perdido el ACK anterior)
+    print("Enviando ACK")
+    with window_condition:
+        # Los ACKs no esperan: su tiempo en el aire se descuenta del presupuesto común
+        transmit(format_text_message(ack_msg).encode('utf-8'), qos=2)
+
+    content = json.dumps(message_data.get("msg"), sort_keys=True)
+    if dedup_cache.is_duplicate(device_id, ack_count, content):
+        print(f"Mensaje {ack_count} de {device_id} duplicado. No se reenvía")
+        return
+    subtopic = msg.topic.split('/', 5)[5]
+    client.publish(f"{MQTT_DEDUPLICATED_TOPIC}/{device_id}/{subtopic}", msg.payload, qos=1)
+
+
+def handle_ack_from_lora(client, device_id, msg):
+    message_data = decode_json_message(msg)
+    if message_data is None:
+        return
+    record_uplink_quality(device_id, message_data)
+    # ACK desde LoRa recibido
+    with window_condition:
+        if device_id in channels:
+            channels[device_id].handle_ack(message_data.get("msg", {}))
+        window_condition.notify()
+
+
+def handle_link_report(client, device_id, msg):
+    message_data = decode_json_message(msg)
+    if message_data is None:
+        return
+    # Calidad del enlace de bajada medida por el nodo
+    snr = message_data.get("msg", {}).get("snr")
+    if snr is not None:
+        with window_condition:
+            if device_id in channels:
+                channels[device_id].link.add_downlink_report(snr)
+    record_uplink_quality(device_id, message_data)
+
 
+def handle_admin(client, command, msg):
+    message_data = decode_json_message(msg)
+    device_id = message_data.get("id") if isinstance(message_data, dict) else None
+    if not device_id:
+        print('ERROR: La petición de administración no contiene un campo "id"')
+    elif command == "register":
+        register_device(device_id)
+    elif command == "unregister":
+        unregister_device(device_id)
+    elif command == "purge":
+        purge_bulk_messages(device_id)
+    else:
+        print(f"ERROR: Petición de administración desconocida: {command}")
+
+
+def decode_json_message(msg):
     print(f">>>> {msg.topic} | {msg.payload}")
     try:
-        message_data = json.loads(msg.payload.decode('utf-8'))
+        return json.loads(msg.payload.decode('utf-8'))
     except Exception as e:
         print(f"Error al descodificar el mensaje recibido como JSON: {e}")
+        return None
+
+
+def resolve_route(topic):
+    """
+    Devuelve el manejador de los mensajes de un topic y el identificador de dispositivo
+    (o la petición de administración) que contiene, o (None, None) si no es un topic atendido.
+    """
+    topic_parts = topic.split('/')
+    if topic.startswith(MQTT_FROM_LORA_TOPIC + '/') and len(topic_parts) >= 5:
+        if topic_parts[4] == "reliable" and len(topic_parts) >= 6:
+            return handle_reliable_from_lora, topic_parts[3]
+        if topic_parts[4] == "ack" and len(topic_parts) == 5:
+            return handle_ack_from_lora, topic_parts[3]
+        if topic_parts[4] == "link" and len(topic_parts) == 5:
+            return handle_link_report, topic_parts[3]
+    elif topic.startswith(MQTT_RELIABLE_TO_LORA_TOPIC + '/') and len(topic_parts) == 6:
+        return handle_to_lora, topic_parts[5]
+    elif topic.startswith(MQTT_MULTICAST_TO_LORA_TOPIC + '/') and len(topic_parts) == 6:
+        return handle_multicast_to_lora, topic_parts[5]
+    elif topic.startswith(MQTT_ADMIN_TOPIC + '/') and len(topic_parts) == 5:
+        return handle_admin, topic_parts[4]
+    return None, None
+
+
+# Tabla de rutas: topic -> (manejador, dispositivo). Cada topic se analiza una única vez
+routes = {}
+# Manejadores cuyos topics no corresponden a un dispositivo registrado
+UNFILTERED_HANDLERS = (handle_admin, handle_multicast_to_lora)
+
+
+# Recepción de mensajes
+def on_message(client, userdata, msg):
+    route = routes.get(msg.topic)
+    if route is None:
+        route = resolve_route(msg.topic)
+        if route[0] is None:
+            return
+        if route[0] in UNFILTERED_HANDLERS or route[1] in channels:
+            with window_condition:
+                routes[msg.topic] = route
+    handler, device_id = route
+    if handler not in UNFILTERED_HANDLERS and device_id not in channels:
+        # Con las suscripciones comodín llegan también mensajes de dispositivos no registrados
         return
+    handler(client, device_id, msg)
 
-    topic_parts = msg.topic.split('/')
 
-    # Mensaje desde LoRa (devolveremos ACK)
-    if topic_parts[2] == "LORAtoMQTT" and topic_parts[4] == "reliable":
-        device_id = topic_parts[3]
-        print(f"Mensaje para confirmar proveniente del dispositivo {device_id}")
-        ack_count = message_data.get("count")
-        if ack_count == None:
-            print('ERROR: El JSON recibido no contiene un campo "count"')
-        ack_msg = '{"message":"{' + \
-            f'\\"id\\":\\"{device_id}\\",\\"ack\\":{ack_count}'  + \
-            '}"}'
-        print("Enviando ACK")
-        client.publish(MQTT_TO_LORA_TOPIC, ack_msg.encode('utf-8'), qos=2)
+def lora_frame_size(payload) -> int:
+    """
+    Tamaño de la trama LoRa que transmitirá OpenMQTTGateway para un mensaje dirigido a él.
+    """
+    omg_message = json.loads(payload)
+    if "hex" in omg_message:
+        return len(omg_message["hex"]) // 2
+    return len(omg_message["message"].encode('utf-8'))
 
-    # ACK desde LoRa recibido
-    elif topic_parts[2] == "LORAtoMQTT" and topic_parts[4] == "ack":
-        if message_data.get("msg", {}).get("count") == expected_ack_count:
-            ack_received_event.set()
 
-    # Mensaje hacia LoRa (activamos rutina de reenvío hasta recibir ACK)
-    elif topic_parts[3] == "MQTTtoLORA":
-        device_id = topic_parts[5]
-        to_lora_queue.put((device_id, message_data))
+def transmit(payload, qos=0):
+    global last_transmission
+    last_transmission = time.time()
+    airtime = time_on_air(lora_frame_size(payload), network_sf, lora_bw_khz, lora_coding_rate, lora_preamble_len)
+    airtime_budget.consume(airtime)
+    # Se guarda con el resto del estado, para no recuperar el presupuesto completo al reiniciar
+    store.set_setting("duty_cycle_budget", airtime_budget.snapshot())
+    mqttc.publish(MQTT_TO_LORA_TOPIC, payload, qos=qos)
+    return airtime
+
+
+def format_text_message(msg_data) -> str:
+    msg_data_json = json.dumps(msg_data, separators=(',', ':'))
+    msg_data_json_formatted = msg_data_json.replace('"', '\\"')
+    return '{"message":"' + msg_data_json_formatted + '"}'
+
+
+def sf_announcement_data(msg_data) -> dict:
+    # Los anuncios de cambio de SF guardan el instante del cambio; al nodo se le indica lo que falta
+    if "lora_sf" not in msg_data:
+        return msg_data
+    return {"lora_sf": msg_data["lora_sf"], "in_s": max(round(msg_data["at"] - time.time()), 0)}
+
+
+def lora_message_data(device_id, msg_data, seq) -> dict:
+    if isinstance(msg_data, list):
+        return {"id": device_id, "requires_ack": seq, "batch": [sf_announcement_data(m) for m in msg_data]}
+    return {**sf_announcement_data(msg_data), "id": device_id, "requires_ack": seq}
+
+
+def lora_payload_size(device_id, msg_data, seq) -> int:
+    return len(json.dumps(lora_message_data(device_id, msg_data, seq), separators=(',', ':')))
+
+
+def format_lora_message(device_id, msg_data, seq) -> str:
+    """
+    Construye el mensaje para OpenMQTTGateway con el número de secuencia fiable indicado.
+    Los mensajes JSON se envían como texto (campo "message") y las tramas binarias
+    como bytes (campo "hex"). Una lista de mensajes JSON se envía agrupada en una trama.
+    """
+    if isinstance(msg_data, bytearray):
+        msg_data[FRAME_SEQ_OFFSET] = seq
+        return json.dumps({"hex": msg_data.hex()})
+    return format_text_message(lora_message_data(device_id, msg_data, seq))
+
+
+sends_since_bulk = 0 # Envíos de carriles prioritarios con fragmentos esperando
+
+
+def next_to_send(lanes):
+    # Dentro de un carril, turno rotatorio entre dispositivos (el que envía pasa al final)
+    for lane in lanes:
+        for channel in channels.values():
+            if channel.can_send(lane):
+                return channel, lane
+        if multicast_channel.can_send(lane):
+            return multicast_channel, lane
+    return None, None
+
+
+def send_new_messages():
+    global sends_since_bulk
+    # Solo se envía si queda presupuesto de ciclo de trabajo
+    while airtime_budget.ready_in() == 0:
+        lanes = LANES
+        if sends_since_bulk >= BULK_SHARE_INTERVAL:
+            lanes = ("bulk",) + LANES
+        channel, lane = next_to_send(lanes)
+        if channel is None:
+            return
+        channel.send_next(lane)
+        if channel is not multicast_channel:
+            channels.move_to_end(channel.device_id)
+        if lane == "bulk" or not any(channel.queues["bulk"] for channel in channels.values()):
+            sends_since_bulk = 0
+        else:
+            sends_since_bulk += 1
+
+
+last_status_published = 0
+
+
+def publish_status():
+    global last_status_published
+    now = time.monotonic()
+    if now - last_status_published < STATUS_INTERVAL_S:
+        return
+    last_status_published = now
+    status = {
+        "network_sf": network_sf,
+        "duty_cycle": airtime_budget.status(),
+        "devices": {
+            device_id: {
+                "queued": {lane: len(queue) for lane, queue in channel.queues.items()},
+                "in_flight": len(channel.in_flight),
+            }
+            for device_id, channel in channels.items()
+        },
+        "multicast_queued": len(multicast_channel.queue),
+    }
+    mqttc.publish(MQTT_STATUS_TOPIC, json.dumps(status), retain=True)
+
+
+def send_sf_beacon(now):
+    # Con un SF distinto del base, los nodos vuelven al base si dejan de oír al gateway
+    if network_sf == lora_sf or now - last_transmission < SF_BEACON_INTERVAL_S or airtime_budget.ready_in() > 0:
+        return
+    print(f"Enviando baliza de SF{network_sf}")
+    transmit(format_text_message({"id": SF_BEACON_ID, "sf": network_sf}).encode('utf-8'))
 
 
 def reliable_delivery():
-    global expected_ack_count
-    global estimated_rtt_time
-    global retry_timeout
-    while True:
-        device_id, msg_data = to_lora_queue.get()
-        msg_data["id"] = device_id
-        msg_data["requires_ack"] = expected_ack_count
-        msg_data_json = json.dumps(msg_data, separators=(',', ':'))
-        msg_data_json_formatted = msg_data_json.replace('"', '\\"')
-        msg_to_send = '{"message":"' + msg_data_json_formatted + '"}'
-        print(f"Realizando envío fiable hacia LoRa del mensaje: {msg_to_send}")
-        success = False
-        start_time = time.time()
-        for tries in range(MAX_RETRIES):
-            mqttc.publish(MQTT_TO_LORA_TOPIC, msg_to_send.encode('utf-8'))
-            if ack_received_event.wait(timeout=retry_timeout):
-                elapsed_time = time.time() - start_time
-                if elapsed_time < estimated_rtt_time:
-                    estimated_rtt_time = elapsed_time
-                    retry_timeout = estimated_rtt_time * 2
-                    print(f"Reajustado el tiempo RTT estimado: {estimated_rtt_time}s "
-                        f"(retry_timeout={retry_timeout})")
-                success = True
-                ack_received_event.clear()
-                break
-        if not success:
-            print("ERROR: Número máximo de reenvíos alcanzado. Descartando mensaje")
-        expected_ack_count = (expected_ack_count + 1) % ACK_MAX_COUNT
-
-
-mqttc.on_connect = on_connect
-mqttc.on_message = on_message
-
-threading.Thread(target=reliable_delivery, daemon=True).start()
-
-# Autenticación y conexión
-mqttc.username_pw_set(username, password)
-mqttc.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
-
-mqttc.loop_forever()
+    """
+    Envío fiable con ventana deslizante y repetición selectiva: cada dispositivo puede
+    tener hasta window_size mensajes pendientes de ACK y solo se reenvían los que no se
+    han confirmado dentro del timeout calculado a partir del RTT estimado del dispositivo.
+    """
+    with window_condition:
+        while True:
+            now = time.time()
+            if sf_switch is not None and now >= sf_switch["at"]:
+                apply_network_sf(sf_switch["sf"])
+            for channel in channels.values():
+                channel.retransmit_expired(now)
+            multicast_channel.settle()
+            send_new_messages()
+            send_sf_beacon(now)
+            # Una única escritura en disco por cada ronda de envíos
+            store.flush()
+            publish_status()
+            # Se despierta al vencer el siguiente timeout, si hay envíos retenidos por el
+            # ciclo de trabajo cuando se recupere el presupuesto y, en todo caso, para
+            # publicar el estado
+            budget_wait = airtime_budget.ready_in()
+            wait_times = [
+                max(pending.deadline - now, budget_wait)
+                for channel in channels.values() for pending in channel.in_flight.values()
+            ]
+            if budget_wait > 0 and next_to_send(LANES)[0] is not None:
+                wait_times.append(budget_wait)
+            if sf_switch is not None:
+                wait_times.append(sf_switch["at"] - now)
+            multicast_on_air = multicast_channel.settle()
+            if multicast_on_air is not None:
+                wait_times.append(multicast_on_air)
+            if network_sf != lora_sf:
+                wait_times.append(max(last_transmission + SF_BEACON_INTERVAL_S - now, budget_wait))
+            window_condition.wait(min(wait_times + [STATUS_INTERVAL_S]))
+
+
+def register_initial_devices():
+    with window_condition:
+        for device_id in store.registered_devices() + id_list:
+            get_channel(device_id)
+            store.register_device(device_id)
+        store.flush()
+    print(f"IDs de los dispositivos a manejar: {list(channels)}")
+
+
+def restore_pending_messages():
+    """
+    Recupera los mensajes guardados antes de un reinicio: los que ya se habían enviado
+    se reenvían con su misma secuencia y el resto se vuelven a encolar en orden.
+    """
+    for device_id, next_seq in store.next_seqs().items():
+        get_channel(device_id).next_seq = next_seq
+    messages = store.pending_messages()
+    sent_batches = OrderedDict() # (dispositivo, secuencia) -> mensajes enviados en la misma trama
+    for message in messages:
+        if message.seq is None:
+            get_channel(message.device_id).queues[message.lane].append((message.row_id, message.msg_data))
+        else:
+            sent_batches.setdefault((message.device_id, message.seq), []).append(message)
+    for (device_id, seq), batch in sent_batches.items():
+        # Se reenvía en cuanto arranque la entrega (como reenvío, de modo que su ACK
+        # no se usa en la estimación del RTT)
+        msg_data = batch[0].msg_data if len(batch) == 1 else [message.msg_data for message in batch]
+        msg_to_send = format_lora_message(device_id, msg_data, seq)
+        pending = PendingMessage([message.row_id for message in batch], msg_data, msg_to_send.encode('utf-8'),
+            batch[0].lane, 0, fw_payload_size(msg_data))
+        # Los reintentos se cuentan de nuevo: el nodo no podía confirmar mientras el gestor
+        # estaba parado, y con el contador agotado se descartaría al primer vencimiento
+        pending.tries = 1
+        get_channel(device_id).in_flight[seq] = pending
+    store.flush()
+    if messages:
+        print(f"Recuperados {len(messages)} mensajes pendientes de una ejecución anterior")
+
+
+def restore_duty_cycle_budget():
+    """
+    Retoma el tiempo de transmisión consumido en la ejecución anterior, de modo que reiniciar
+    el gestor no permita superar el ciclo de trabajo.
+    """
+    snapshot = store.get_setting("duty_cycle_budget")
+    if snapshot is not None:
+        airtime_budget.restore(snapshot)
+        print(f"Presupuesto de ciclo de trabajo recuperado: {airtime_budget.status()}")
+
+
+def restore_network_sf():
+    """
+    Retoma el SF de la red de la ejecución anterior (los nodos siguen con él) y el cambio de
+    SF que estuviera anunciado, que los nodos aplicarán en el instante acordado.
+    """
+    global sf_switch
+    announced_switch = store.get_setting("sf_switch")
+    apply_network_sf(max(store.get_setting("network_sf", lora_sf), lora_sf))
+    if announced_switch is not None:
+        sf_switch = announced_switch
+        store.set_setting("sf_switch", sf_switch)
+        store.flush()
+        print(f"Cambio a SF{sf_switch['sf']} pendiente de una ejecución anterior")
+
+
+def main():
+    mqttc.on_connect = on_connect
+    mqttc.on_message = on_message
+
+    # Autenticación y conexión
+    mqttc.username_pw_set(username, password)
+    mqttc.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+
+    register_initial_devices()
+    restore_pending_messages()
+    restore_network_sf()
+    restore_duty_cycle_budget()
+    threading.Thread(target=reliable_delivery, daemon=True).start()
+
+    mqttc.loop_forever()
+
+
+if __name__ == "__main__":
+    main()
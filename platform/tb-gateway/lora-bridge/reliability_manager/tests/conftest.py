@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import pytest
+
+# Los módulos del gestor se importan como en el contenedor (desde su directorio)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# reliability_manager abre el almacén de mensajes al importarse
+os.environ.setdefault('store_path', os.path.join(tempfile.mkdtemp(prefix="reliability-manager-test-"), "store.db"))
+
+import reliability_manager as rm
+from lora_airtime import DutyCycleBudget
+from message_store import MessageStore
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """
+    Publicaciones MQTT del gestor: (topic, payload).
+    """
+    published = []
+    monkeypatch.setattr(rm.mqttc, "publish",
+        lambda topic, payload=None, qos=0, retain=False: published.append((topic, payload)))
+    return published
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "store.db")
+
+
+@pytest.fixture(autouse=True)
+def bridge(monkeypatch, published, store_path):
+    """
+    Estado del gestor vacío para cada prueba, con su propio almacén.
+    """
+    monkeypatch.setattr(rm, "store", MessageStore(store_path))
+    monkeypatch.setattr(rm, "channels", OrderedDict())
+    monkeypatch.setattr(rm, "multicast_channel", rm.MulticastChannel())
+    monkeypatch.setattr(rm, "dedup_cache", rm.DedupCache())
+    monkeypatch.setattr(rm, "routes", {})
+    monkeypatch.setattr(rm, "airtime_budget", DutyCycleBudget(rm.lora_duty_cycle, rm.lora_duty_cycle_window_s))
+    monkeypatch.setattr(rm, "network_sf", rm.lora_sf)
+    monkeypatch.setattr(rm, "sf_switch", None)
+    monkeypatch.setattr(rm, "last_sf_change", 0)
+    monkeypatch.setattr(rm, "last_transmission", 0)
+    monkeypatch.setattr(rm, "sends_since_bulk", 0)
+    monkeypatch.setattr(rm, "last_status_published", 0)
+    return rm
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import reliability_manager as rm
+from adaptive_data_rate import recommended_sf, recommended_fragment_size
+
+
+DEVICE_ID = "f024f9b18b08"
+OTHER_ID = "a0b1c2d3e4f5"
+
+
+def config_updates(published):
+    return [json.loads(payload)["spreadingfactor"] for topic, payload in published
+        if topic == rm.MQTT_LORA_CONFIG_TOPIC]
+
+
+def test_recommended_sf_keeps_the_margin():
+    assert recommended_sf(None, 7) == 7
+    assert recommended_sf(5, 7) == 7
+    assert recommended_sf(-5, 7) == 8
+    assert recommended_sf(-30, 7) == 12
+    assert recommended_sf(5, 9) == 9
+
+
+def test_fragment_size_grows_with_the_margin():
+    assert recommended_fragment_size(None, 7, 128) == 128
+    assert recommended_fragment_size(10, 7, 128) > recommended_fragment_size(-1, 7, 128)
+
+
+def test_bad_link_announces_a_slower_sf(published):
+    rm.register_device(DEVICE_ID)
+    rm.record_uplink_quality(DEVICE_ID, {"snr": -5})
+
+    assert rm.sf_switch["sf"] == rm.lora_sf + 1
+    assert rm.store.get_setting("sf_switch") == rm.sf_switch
+    announcement = rm.channels[DEVICE_ID].queues["control"][0][1]
+    assert announcement == {"lora_sf": rm.lora_sf + 1, "at": rm.sf_switch["at"]}
+    # Al nodo se le indica el tiempo que falta para el cambio
+    data = rm.lora_message_data(DEVICE_ID, announcement, 0)
+    assert data["in_s"] == pytest.approx(rm.SF_SWITCH_DELAY_S, abs=1)
+    datarate = [json.loads(payload) for topic, payload in published
+        if topic == rm.MQTT_DATARATE_TOPIC.format(DEVICE_ID)]
+    assert datarate[-1]["sf"] == rm.lora_sf
+
+
+def test_sf_changes_are_rate_limited(published, monkeypatch):
+    rm.register_device(DEVICE_ID)
+    monkeypatch.setattr(rm, "last_sf_change", rm.time.time())
+    rm.record_uplink_quality(DEVICE_ID, {"snr": -5})
+    assert rm.sf_switch is None
+
+
+def test_lowering_the_sf_needs_extra_margin(published, monkeypatch):
+    rm.register_device(DEVICE_ID)
+    monkeypatch.setattr(rm, "network_sf", rm.lora_sf + 1)
+    # Justo el margen para lora_sf, pero no el adicional para bajar: se mantiene el SF actual
+    rm.channels[DEVICE_ID].link.add_uplink_sample(-2.5)
+    assert rm.target_network_sf() == rm.lora_sf + 1
+    rm.channels[DEVICE_ID].link.uplink_snr = 5
+    assert rm.target_network_sf() == rm.lora_sf
+
+
+def test_apply_network_sf_reconfigures_the_gateway(published):
+    rm.register_device(DEVICE_ID)
+    rm.channels[DEVICE_ID].failing = True
+    rm.announce_sf_switch(rm.lora_sf + 1)
+
+    rm.apply_network_sf(rm.sf_switch["sf"])
+
+    assert rm.network_sf == rm.lora_sf + 1 and rm.sf_switch is None
+    assert config_updates(published) == [rm.lora_sf + 1]
+    assert rm.store.get_setting("network_sf") == rm.lora_sf + 1
+    assert not rm.channels[DEVICE_ID].failing
+
+
+def test_unreachable_network_falls_back_to_the_base_sf(published, monkeypatch):
+    rm.register_device(DEVICE_ID)
+    rm.register_device(OTHER_ID)
+    monkeypatch.setattr(rm, "network_sf", rm.lora_sf + 2)
+    channel = rm.channels[DEVICE_ID]
+    channel.link.add_uplink_sample(-10)
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 1})
+    rm.send_new_messages()
+
+    for _ in range(rm.MAX_RETRIES):
+        channel.retransmit_expired(channel.in_flight[0].deadline)
+
+    assert channel.failing
+    # El otro dispositivo, sin estadísticas (p.ej. apagado), no impide la vuelta
+    assert rm.sf_switch["sf"] == rm.lora_sf
+
+
+def test_no_fallback_while_another_device_responds(published, monkeypatch):
+    rm.register_device(DEVICE_ID)
+    rm.register_device(OTHER_ID)
+    monkeypatch.setattr(rm, "network_sf", rm.lora_sf + 2)
+    rm.channels[DEVICE_ID].failing = True
+    rm.channels[OTHER_ID].link.add_uplink_sample(-10)
+
+    rm.fall_back_if_unreachable()
+
+    assert rm.sf_switch is None
@@ -0,0 +1,67 @@
+import json
+
+import reliability_manager as rm
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+def sent_frames(published):
+    return [json.loads(payload) for topic, payload in published if topic == rm.MQTT_TO_LORA_TOPIC]
+
+
+def test_small_messages_share_one_frame(published):
+    rm.register_device(DEVICE_ID)
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 1})
+    rm.enqueue_to_lora(DEVICE_ID, {"rpc": {"method": "reboot"}})
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 2})
+    rm.send_new_messages()
+
+    frames = sent_frames(published)
+    assert len(frames) == 1
+    message = json.loads(frames[0]["message"])
+    # Primero los mensajes de control, después los interactivos
+    assert message == {"id": DEVICE_ID, "requires_ack": 0,
+        "batch": [{"set": 1}, {"set": 2}, {"rpc": {"method": "reboot"}}]}
+
+
+def test_batches_fit_in_a_lora_frame(published):
+    rm.register_device(DEVICE_ID)
+    for i in range(12):
+        rm.enqueue_to_lora(DEVICE_ID, {"set": i, "value": "x" * 30})
+    rm.send_new_messages()
+
+    frames = sent_frames(published)
+    assert len(frames) > 1
+    assert all(len(frame["message"].encode('utf-8')) <= rm.LORA_MAX_PAYLOAD for frame in frames)
+    batched = [msg_data["set"] for frame in frames for msg_data in json.loads(frame["message"])["batch"]]
+    assert batched == list(range(12))
+
+
+def test_single_message_is_not_wrapped(published):
+    rm.register_device(DEVICE_ID)
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 1})
+    rm.send_new_messages()
+    assert json.loads(sent_frames(published)[0]["message"]) == {"set": 1, "id": DEVICE_ID, "requires_ack": 0}
+
+
+def test_fragments_are_never_batched(published):
+    rm.register_device(DEVICE_ID)
+    for _ in range(2):
+        rm.enqueue_to_lora(DEVICE_ID, bytearray([0xF1]) + bytes(rm.FRAME_HEADER_SIZE + 8))
+    rm.send_new_messages()
+    assert [len(bytes.fromhex(frame["hex"])) for frame in sent_frames(published)] == [rm.FRAME_HEADER_SIZE + 9] * 2
+
+
+def test_ack_confirms_every_message_in_the_batch(published):
+    rm.register_device(DEVICE_ID)
+    for i in range(3):
+        rm.enqueue_to_lora(DEVICE_ID, {"set": i})
+    rm.send_new_messages()
+    channel = rm.channels[DEVICE_ID]
+    assert len(channel.in_flight[0].row_ids) == 3
+
+    channel.handle_ack({"count": 0})
+
+    assert not channel.in_flight
+    assert rm.store.pending_messages() == []
@@ -0,0 +1,70 @@
+import json
+from types import SimpleNamespace
+
+import reliability_manager as rm
+from reliability_manager import DedupCache
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+def reliable_message(count, msg):
+    message_data = {"id": DEVICE_ID, "count": count, "msg": msg}
+    return SimpleNamespace(topic=f"{rm.MQTT_FROM_LORA_TOPIC}/{DEVICE_ID}/reliable/telemetry",
+        payload=json.dumps(message_data).encode('utf-8'))
+
+
+def forwarded(published):
+    return [json.loads(payload)["count"] for topic, payload in published
+        if topic == f"{rm.MQTT_DEDUPLICATED_TOPIC}/{DEVICE_ID}/telemetry"]
+
+
+def acks(published):
+    return [json.loads(json.loads(payload)["message"]) for topic, payload in published
+        if topic == rm.MQTT_TO_LORA_TOPIC]
+
+
+def test_copies_are_detected_by_sequence_and_content():
+    cache = DedupCache()
+    assert not cache.is_duplicate(DEVICE_ID, 3, "a")
+    assert cache.is_duplicate(DEVICE_ID, 3, "a")
+    # Misma secuencia con otro contenido: el nodo se ha reiniciado
+    assert not cache.is_duplicate(DEVICE_ID, 3, "b")
+    assert not cache.is_duplicate("a0b1c2d3e4f5", 3, "b")
+
+
+def test_entries_expire(monkeypatch):
+    cache = DedupCache()
+    now = 1000
+    monkeypatch.setattr(rm.time, "time", lambda: now)
+    cache.is_duplicate(DEVICE_ID, 3, "a")
+    now += rm.DEDUP_TTL_S
+    assert not cache.is_duplicate(DEVICE_ID, 3, "a")
+
+
+def test_opposite_sequence_is_forgotten():
+    cache = DedupCache()
+    cache.is_duplicate(DEVICE_ID, 3, "a")
+    cache.is_duplicate(DEVICE_ID, 3 + rm.ACK_MAX_COUNT // 2, "b")
+    assert not cache.is_duplicate(DEVICE_ID, 3, "a")
+
+
+def test_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(rm, "DEDUP_MAX_ENTRIES", 3)
+    cache = DedupCache()
+    for seq in range(4):
+        cache.is_duplicate(DEVICE_ID, seq, "a")
+    assert len(cache._entries) == 3
+    assert not cache.is_duplicate(DEVICE_ID, 0, "a")
+
+
+def test_copies_are_acked_but_forwarded_once(published):
+    rm.register_device(DEVICE_ID)
+    for _ in range(2):
+        rm.on_message(rm.mqttc, None, reliable_message(5, {"temp": 21}))
+    rm.on_message(rm.mqttc, None, reliable_message(6, {"temp": 22}))
+
+    assert forwarded(published) == [5, 6]
+    assert [ack["ack"] for ack in acks(published)] == [5, 5, 6]
+    # El ACK de la 6 confirma también la 5
+    assert acks(published)[-1]["sack"] == 0b1
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import reliability_manager as rm
+from lora_airtime import DutyCycleBudget, time_on_air
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+def test_time_on_air_matches_the_datasheet_formula():
+    # Valores de la calculadora de Semtech (BW 125 kHz, CR 4/5, preámbulo de 8 símbolos)
+    assert time_on_air(10, 7, 125, 5, 8) == pytest.approx(0.041216)
+    assert time_on_air(51, 12, 125, 5, 8) == pytest.approx(2.465792)
+
+
+def test_budget_goes_into_debt_and_refills(monkeypatch):
+    now = 1000
+    monkeypatch.setattr("lora_airtime.time.monotonic", lambda: now)
+    budget = DutyCycleBudget(0.01, 3600)
+    budget.consume(budget.capacity + 1)
+    assert budget.ready_in() == pytest.approx(100)
+    now += 100
+    assert budget.ready_in() == 0
+    now += 10 ** 6
+    assert budget.status()["available_airtime_s"] == budget.capacity
+
+
+def test_restore_refills_for_the_time_elapsed(monkeypatch):
+    budget = DutyCycleBudget(0.01, 3600)
+    budget.restore({"tokens": -1, "at": rm.time.time() - 50})
+    assert budget.status()["available_airtime_s"] == pytest.approx(-0.5, abs=0.01)
+
+
+def test_transmit_charges_the_budget_at_the_network_sf(published, monkeypatch):
+    monkeypatch.setattr(rm, "network_sf", 12)
+    payload = json.dumps({"hex": bytes(51).hex()})
+    airtime = rm.transmit(payload)
+    assert airtime == pytest.approx(2.465792)
+    assert rm.airtime_budget.status()["available_airtime_s"] == pytest.approx(
+        rm.airtime_budget.capacity - airtime, abs=0.01)
+    assert published == [(rm.MQTT_TO_LORA_TOPIC, payload)]
+
+
+def test_no_new_messages_without_budget(published):
+    rm.register_device(DEVICE_ID)
+    rm.airtime_budget.consume(rm.airtime_budget.capacity + 1)
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 1})
+    rm.send_new_messages()
+    assert not rm.channels[DEVICE_ID].in_flight
+    # Tampoco se reenvía lo que haya vencido
+    rm.airtime_budget.tokens = rm.airtime_budget.capacity
+    rm.send_new_messages()
+    pending = rm.channels[DEVICE_ID].in_flight[0]
+    rm.airtime_budget.consume(rm.airtime_budget.capacity + 1)
+    rm.channels[DEVICE_ID].retransmit_expired(pending.deadline)
+    assert pending.tries == 1
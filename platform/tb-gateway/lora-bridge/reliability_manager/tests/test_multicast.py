@@ -0,0 +1,69 @@
+import json
+from types import SimpleNamespace
+
+import reliability_manager as rm
+
+
+GROUP_ID = "group"
+DEVICE_ID = "f024f9b18b08"
+
+
+def fw_frame(size=64):
+    return bytes([0xF1]) + bytes(rm.FRAME_HEADER_SIZE - 1) + bytes(size)
+
+
+def multicast(payload):
+    rm.on_message(rm.mqttc, None,
+        SimpleNamespace(topic=f"{rm.MQTT_MULTICAST_TO_LORA_TOPIC}/{GROUP_ID}", payload=payload))
+
+
+def group_deliveries(published):
+    return [json.loads(payload) for topic, payload in published if topic == rm.MQTT_DELIVERY_TOPIC.format(GROUP_ID)]
+
+
+def lora_frames(published):
+    return [payload for topic, payload in published if topic == rm.MQTT_TO_LORA_TOPIC]
+
+
+def test_one_frame_on_air_at_a_time(published, monkeypatch):
+    now = rm.time.monotonic()
+    monkeypatch.setattr(rm.time, "monotonic", lambda: now)
+    multicast(fw_frame())
+    multicast(fw_frame())
+
+    rm.send_new_messages()
+    assert len(lora_frames(published)) == 1
+    remaining = rm.multicast_channel.settle()
+    assert remaining > 0
+    assert group_deliveries(published) == []
+
+    # Cuando termina de emitirse se avisa y sale la siguiente
+    now += remaining
+    assert rm.multicast_channel.settle() is None
+    assert group_deliveries(published) == [{"status": "SENT", "bytes": 64}]
+    rm.send_new_messages()
+    assert len(lora_frames(published)) == 2
+
+
+def test_device_fragments_go_first(published):
+    rm.register_device(DEVICE_ID)
+    multicast(fw_frame())
+    rm.enqueue_to_lora(DEVICE_ID, bytearray(fw_frame()))
+    rm.send_new_messages()
+    assert "hex" in json.loads(lora_frames(published)[0])
+    assert rm.channels[DEVICE_ID].in_flight
+    assert rm.multicast_channel.on_air is not None
+
+
+def test_json_multicast_is_addressed_to_the_group(published):
+    multicast(json.dumps({"fw_group": 1}).encode('utf-8'))
+    rm.send_new_messages()
+    message = json.loads(json.loads(lora_frames(published)[0])["message"])
+    assert message == {"fw_group": 1, "id": GROUP_ID}
+
+
+def test_purge_discards_queued_group_frames(published):
+    multicast(fw_frame())
+    multicast(fw_frame())
+    rm.purge_bulk_messages(GROUP_ID)
+    assert not rm.multicast_channel.queue
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+import pytest
+
+import reliability_manager as rm
+from lora_airtime import DutyCycleBudget
+from message_store import MessageStore
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+@pytest.fixture
+def restart(monkeypatch, store_path):
+    """
+    Simula un reinicio del gestor: estado en memoria vacío y almacén reabierto.
+    """
+    def restart():
+        rm.store.flush()
+        monkeypatch.setattr(rm, "store", MessageStore(store_path))
+        monkeypatch.setattr(rm, "channels", OrderedDict())
+        monkeypatch.setattr(rm, "airtime_budget", DutyCycleBudget(rm.lora_duty_cycle, rm.lora_duty_cycle_window_s))
+        monkeypatch.setattr(rm, "network_sf", rm.lora_sf)
+        monkeypatch.setattr(rm, "sf_switch", None)
+        rm.register_initial_devices()
+        rm.restore_pending_messages()
+        rm.restore_network_sf()
+        rm.restore_duty_cycle_budget()
+    return restart
+
+
+def test_messages_in_flight_are_resent_with_their_sequence(restart, published):
+    rm.register_device(DEVICE_ID)
+    channel = rm.get_channel(DEVICE_ID)
+    for i in range(2):
+        rm.enqueue_to_lora(DEVICE_ID, {"set": i, "value": "x" * (rm.LORA_MAX_PAYLOAD // 2)})
+    rm.send_new_messages()
+    # El primero se ha reenviado hasta agotar casi los intentos antes del reinicio
+    for _ in range(rm.MAX_RETRIES - 1):
+        channel.retransmit_expired(channel.in_flight[0].deadline)
+    assert channel.in_flight[0].tries == rm.MAX_RETRIES
+
+    restart()
+
+    channel = rm.channels[DEVICE_ID]
+    assert sorted(channel.in_flight) == [0, 1]
+    assert channel.in_flight[0].msg_data["set"] == 0
+    assert all(pending.tries == 1 for pending in channel.in_flight.values())
+    assert channel.next_seq == 2
+    # Un vencimiento tras el reinicio es un reenvío, no un descarte
+    channel.retransmit_expired(channel.in_flight[0].deadline)
+    assert channel.in_flight[0].tries == 2
+
+
+def test_queued_messages_keep_their_order(restart, published):
+    rm.register_device(DEVICE_ID)
+    for i in range(3):
+        rm.enqueue_to_lora(DEVICE_ID, {"set": i})
+
+    restart()
+
+    channel = rm.channels[DEVICE_ID]
+    assert not channel.in_flight
+    assert [msg_data for _, msg_data in channel.queues["control"]] == [{"set": i} for i in range(3)]
+
+
+def test_acked_messages_are_not_restored(restart, published):
+    rm.register_device(DEVICE_ID)
+    rm.enqueue_to_lora(DEVICE_ID, bytearray([0xF1]) + bytes(rm.FRAME_HEADER_SIZE + 16))
+    rm.send_new_messages()
+    rm.channels[DEVICE_ID].handle_ack({"count": 0})
+
+    restart()
+
+    channel = rm.channels[DEVICE_ID]
+    assert not channel.in_flight and not channel.queues["bulk"]
+    assert channel.next_seq == 1
+
+
+def test_duty_cycle_budget_survives_restart(restart, published):
+    rm.airtime_budget.consume(rm.airtime_budget.capacity)
+    # Cada transmisión guarda el presupuesto restante
+    rm.transmit(rm.format_text_message({"id": DEVICE_ID, "ack": 0}).encode('utf-8'))
+    consumed = rm.airtime_budget.capacity - rm.airtime_budget.status()["available_airtime_s"]
+
+    restart()
+
+    assert rm.airtime_budget.ready_in() > 0
+    assert rm.airtime_budget.status()["available_airtime_s"] == pytest.approx(
+        rm.airtime_budget.capacity - consumed, abs=0.01)
+
+
+def test_network_sf_and_announced_switch_survive_restart(restart, published):
+    rm.register_device(DEVICE_ID)
+    rm.apply_network_sf(rm.lora_sf + 2)
+    rm.announce_sf_switch(rm.lora_sf + 1)
+    announced = rm.sf_switch
+
+    restart()
+
+    assert rm.network_sf == rm.lora_sf + 2
+    assert rm.sf_switch == announced
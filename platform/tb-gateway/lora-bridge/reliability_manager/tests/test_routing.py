@@ -0,0 +1,74 @@
+import json
+from types import SimpleNamespace
+
+import reliability_manager as rm
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+def message(topic, payload):
+    if not isinstance(payload, bytes):
+        payload = json.dumps(payload).encode('utf-8')
+    return SimpleNamespace(topic=topic, payload=payload)
+
+
+def test_resolve_route_parses_each_topic_family():
+    assert rm.resolve_route(f"{rm.MQTT_FROM_LORA_TOPIC}/{DEVICE_ID}/reliable/telemetry") == \
+        (rm.handle_reliable_from_lora, DEVICE_ID)
+    assert rm.resolve_route(f"{rm.MQTT_FROM_LORA_TOPIC}/{DEVICE_ID}/ack") == (rm.handle_ack_from_lora, DEVICE_ID)
+    assert rm.resolve_route(f"{rm.MQTT_FROM_LORA_TOPIC}/{DEVICE_ID}/link") == (rm.handle_link_report, DEVICE_ID)
+    assert rm.resolve_route(f"{rm.MQTT_RELIABLE_TO_LORA_TOPIC}/{DEVICE_ID}") == (rm.handle_to_lora, DEVICE_ID)
+    assert rm.resolve_route(f"{rm.MQTT_MULTICAST_TO_LORA_TOPIC}/group") == (rm.handle_multicast_to_lora, "group")
+    assert rm.resolve_route(f"{rm.MQTT_ADMIN_TOPIC}/register") == (rm.handle_admin, "register")
+
+
+def test_resolve_route_ignores_other_topics():
+    assert rm.resolve_route(f"{rm.MQTT_FROM_LORA_TOPIC}/{DEVICE_ID}/reliable") == (None, None)
+    assert rm.resolve_route(f"{rm.MQTT_FROM_LORA_TOPIC}/{DEVICE_ID}/ack/extra") == (None, None)
+    assert rm.resolve_route(f"{rm.MQTT_RELIABLE_TO_LORA_TOPIC}/{DEVICE_ID}/extra") == (None, None)
+    assert rm.resolve_route("thingsboard/other") == (None, None)
+
+
+def test_messages_for_unregistered_devices_are_ignored(published):
+    topic = f"{rm.MQTT_RELIABLE_TO_LORA_TOPIC}/{DEVICE_ID}"
+    rm.on_message(rm.mqttc, None, message(topic, {"set": 1}))
+    assert not rm.channels
+    assert topic not in rm.routes
+
+
+def test_routes_are_cached_for_registered_devices(published, monkeypatch):
+    rm.register_device(DEVICE_ID)
+    topic = f"{rm.MQTT_RELIABLE_TO_LORA_TOPIC}/{DEVICE_ID}"
+    rm.on_message(rm.mqttc, None, message(topic, {"set": 1}))
+    assert rm.routes[topic] == (rm.handle_to_lora, DEVICE_ID)
+
+    # Los siguientes mensajes no vuelven a analizar el topic
+    monkeypatch.setattr(rm, "resolve_route", lambda topic: (None, None))
+    rm.on_message(rm.mqttc, None, message(topic, {"set": 2}))
+    assert [msg_data for _, msg_data in rm.channels[DEVICE_ID].queues["control"]] == [{"set": 1}, {"set": 2}]
+
+
+def test_register_and_unregister_at_runtime(published):
+    rm.on_message(rm.mqttc, None, message(f"{rm.MQTT_ADMIN_TOPIC}/register", {"id": DEVICE_ID}))
+    assert list(rm.channels) == [DEVICE_ID]
+    assert rm.store.registered_devices() == [DEVICE_ID]
+    topic = f"{rm.MQTT_RELIABLE_TO_LORA_TOPIC}/{DEVICE_ID}"
+    rm.on_message(rm.mqttc, None, message(topic, {"set": 1}))
+
+    rm.on_message(rm.mqttc, None, message(f"{rm.MQTT_ADMIN_TOPIC}/unregister", {"id": DEVICE_ID}))
+
+    assert not rm.channels
+    assert rm.store.registered_devices() == []
+    # La ruta cacheada del dispositivo dado de baja se olvida
+    assert topic not in rm.routes
+    rm.on_message(rm.mqttc, None, message(topic, {"set": 2}))
+    assert not rm.channels
+    device_lists = [json.loads(payload) for topic, payload in published if topic == rm.MQTT_DEVICES_TOPIC]
+    assert device_lists == [[DEVICE_ID], []]
+
+
+def test_multicast_is_accepted_for_any_group(published):
+    rm.on_message(rm.mqttc, None, message(f"{rm.MQTT_MULTICAST_TO_LORA_TOPIC}/group", {"fw_group": 1}))
+    assert len(rm.multicast_channel.queue) == 1
+    assert rm.multicast_channel.queue[0][0] == "group"
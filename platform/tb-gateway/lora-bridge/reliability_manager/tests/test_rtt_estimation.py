@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+import reliability_manager as rm
+from reliability_manager import RttEstimator
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+def test_first_sample_initialises_srtt_and_rttvar():
+    rtt = RttEstimator()
+    assert rtt.rto == rm.INITIAL_RTO_S
+    rtt.add_sample(4)
+    assert (rtt.srtt, rtt.rttvar) == (4, 2)
+    assert rtt.rto == 4 + 4 * 2
+
+
+def test_later_samples_are_smoothed():
+    rtt = RttEstimator()
+    rtt.add_sample(4)
+    rtt.add_sample(8)
+    assert rtt.rttvar == pytest.approx(0.75 * 2 + 0.25 * 4)
+    assert rtt.srtt == pytest.approx(0.875 * 4 + 0.125 * 8)
+    assert rtt.rto == pytest.approx(rtt.srtt + 4 * rtt.rttvar)
+
+
+def test_rto_is_bounded():
+    rtt = RttEstimator()
+    rtt.add_sample(0.01)
+    assert rtt.rto == rm.MIN_RTO_S
+    rtt = RttEstimator()
+    rtt.add_sample(100)
+    assert rtt.rto == rm.MAX_RTO_S
+
+
+def test_timeout_backs_off_with_jitter():
+    rtt = RttEstimator()
+    rtt.add_sample(2)
+    for tries in (1, 2, 3):
+        backoff = rtt.rto * 2 ** (tries - 1)
+        assert backoff <= rtt.timeout(tries) <= backoff * (1 + rm.RTO_JITTER)
+    assert rtt.timeout(10) <= rm.MAX_RTO_S * (1 + rm.RTO_JITTER)
+
+
+def test_ack_of_first_transmission_feeds_the_estimator(published, monkeypatch):
+    channel = rm.get_channel(DEVICE_ID)
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 1})
+    rm.send_new_messages()
+    sent_at = channel.in_flight[0].first_sent
+    monkeypatch.setattr(rm.time, "time", lambda: sent_at + 3)
+
+    channel.handle_ack({"count": 0})
+
+    assert channel.rtt.srtt == pytest.approx(3)
+    estimates = [json.loads(payload) for topic, payload in published
+        if topic == rm.MQTT_RTT_TOPIC.format(DEVICE_ID)]
+    assert estimates == [channel.rtt.status()]
+
+
+def test_ack_of_retransmission_is_ignored(published):
+    # Algoritmo de Karn
+    channel = rm.get_channel(DEVICE_ID)
+    rm.enqueue_to_lora(DEVICE_ID, {"set": 1})
+    rm.send_new_messages()
+    pending = channel.in_flight[0]
+    channel.retransmit_expired(pending.deadline)
+    assert pending.tries == 2
+
+    channel.handle_ack({"count": 0})
+
+    assert not channel.in_flight
+    assert channel.rtt.srtt is None
+    assert not [topic for topic, _ in published if topic == rm.MQTT_RTT_TOPIC.format(DEVICE_ID)]
@@ -0,0 +1,98 @@
+import json
+
+import reliability_manager as rm
+
+
+DEVICE_ID = "f024f9b18b08"
+
+
+def fw_frame(index, size=64):
+    # Trama binaria de firmware (tipo 0xF1) con la cabecera del puente
+    return bytearray([0xF1]) + bytes(rm.FRAME_HEADER_SIZE - 1) + bytes([index % 256]) * size
+
+
+def sent_seqs(published):
+    seqs = []
+    for topic, payload in published:
+        if topic != rm.MQTT_TO_LORA_TOPIC:
+            continue
+        omg_message = json.loads(payload)
+        if "hex" in omg_message:
+            seqs.append(bytes.fromhex(omg_message["hex"])[rm.FRAME_SEQ_OFFSET])
+        else:
+            seqs.append(json.loads(omg_message["message"])["requires_ack"])
+    return seqs
+
+
+def test_sack_mask_marks_previous_sequences_modulo_ack_count():
+    assert rm.sack_mask(5, {4, 2}) == 0b101
+    # Las secuencias anteriores a 0 son las del final del espacio circular
+    assert rm.sack_mask(1, {0, 99, 98}) == 0b111
+    # Solo caben SACK_BITS secuencias anteriores
+    assert rm.sack_mask(20, {20 - 1 - rm.SACK_BITS}) == 0
+
+
+def test_acked_seqs_expands_the_sack_field():
+    assert rm.acked_seqs({"count": 5, "sack": 0b101}) == [5, 4, 2]
+    assert rm.acked_seqs({"count": 0, "sack": 0b11}) == [0, 99, 98]
+    assert rm.acked_seqs({"count": 7}) == [7]
+    assert rm.acked_seqs({}) == []
+
+
+def test_window_limits_messages_in_flight(published):
+    channel = rm.get_channel(DEVICE_ID)
+    # Cada mensaje ocupa más de media trama: no se agrupan
+    for i in range(rm.window_size + 2):
+        rm.enqueue_to_lora(DEVICE_ID, {"set": i, "value": "x" * (rm.LORA_MAX_PAYLOAD // 2)})
+    rm.send_new_messages()
+
+    assert sorted(channel.in_flight) == list(range(rm.window_size))
+    assert sent_seqs(published) == list(range(rm.window_size))
+    assert not channel.can_send("control")
+
+
+def test_selective_ack_frees_only_confirmed_sequences(published):
+    channel = rm.get_channel(DEVICE_ID)
+    for i in range(rm.window_size - 1):
+        rm.enqueue_to_lora(DEVICE_ID, fw_frame(i))
+    rm.send_new_messages()
+    in_flight = sorted(channel.in_flight)
+    assert in_flight == list(range(rm.window_size - 1))
+
+    # El nodo ha recibido la última y la primera, pero no las intermedias
+    last = in_flight[-1]
+    channel.handle_ack({"count": last, "sack": 1 << (last - 1)})
+
+    assert sorted(channel.in_flight) == in_flight[1:-1]
+    deliveries = [json.loads(payload) for topic, payload in published
+        if topic == rm.MQTT_DELIVERY_TOPIC.format(DEVICE_ID)]
+    assert deliveries == [{"status": "ACKED", "bytes": 64}] * 2
+    # Las secuencias confirmadas ya no están en el almacén
+    assert [message.seq for message in rm.store.pending_messages()] == in_flight[1:-1]
+
+
+def test_fragments_leave_room_for_priority_traffic(published):
+    channel = rm.get_channel(DEVICE_ID)
+    for i in range(rm.window_size + 1):
+        rm.enqueue_to_lora(DEVICE_ID, fw_frame(i))
+    rm.send_new_messages()
+    assert channel.bulk_in_flight() == rm.window_size - 1
+
+    rm.enqueue_to_lora(DEVICE_ID, {"rpc": {"method": "reboot"}})
+    rm.send_new_messages()
+    assert len(channel.in_flight) == rm.window_size
+    assert channel.in_flight[rm.window_size - 1].lane == "interactive"
+
+
+def test_bulk_json_waits_for_previous_fragments(published):
+    channel = rm.get_channel(DEVICE_ID)
+    rm.enqueue_to_lora(DEVICE_ID, fw_frame(0))
+    rm.enqueue_to_lora(DEVICE_ID, {"fw_query": 1})
+    rm.send_new_messages()
+    assert list(channel.in_flight) == [0]
+    assert not channel.can_send("bulk")
+
+    channel.handle_ack({"count": 0})
+    rm.send_new_messages()
+    assert list(channel.in_flight) == [1]
+    assert channel.in_flight[1].msg_data == {"fw_query": 1}
@@ -0,0 +1,199 @@
+"""
+Planificador de sesiones OTA por BLE.
+
+Reparte las transferencias entre los adaptadores HCI disponibles, con un máximo de
+sesiones simultáneas por adaptador. Las sesiones pendientes se agrupan por despliegue
+(título y versión del firmware) y los grupos se atienden por turnos, para que un
+despliegue grande no bloquee al resto. Si no se consigue establecer la conexión con
+un dispositivo, la sesión se vuelve a encolar tras una espera exponencial con jitter.
+"""
+
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+
+
+class BleConnectionError(Exception):
+    """
+    Fallo al establecer la conexión BLE con el dispositivo (la sesión se puede reintentar).
+    """
+
+
+class BleAdapter():
+
+    def __init__(self, name: str):
+        self.name = name
+        self.active_sessions = 0
+        self.cooldown_until = 0 # Instante (monotonic) hasta el que no se inician sesiones
+        # BlueZ no tolera bien varios establecimientos de conexión simultáneos en un
+        # mismo adaptador: se serializa la conexión, no la transferencia
+        self.connect_lock = asyncio.Lock()
+
+
+class _BleSession():
+
+    def __init__(self, job, group, device, run):
+        self.job = job
+        self.group = group
+        self.device = device
+        self.run = run
+        self.attempts = 0
+        self.not_before = 0
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+
+
+class BleTransferScheduler():
+
+    def __init__(self, adapter_names: list, max_sessions_per_adapter: int,
+        max_connect_attempts: int = 5, backoff_base_s: float = 2, backoff_max_s: float = 60
+    ):
+        """
+        Parámetros:
+            adapter_names: nombres de los adaptadores HCI a usar (p.ej. ["hci0", "hci1"])
+            max_sessions_per_adapter: sesiones simultáneas permitidas en cada adaptador
+            max_connect_attempts: intentos de conexión por sesión antes de darla por fallida
+            backoff_base_s, backoff_max_s: espera tras el primer fallo de conexión y espera máxima
+        """
+        self.adapters = [BleAdapter(name) for name in adapter_names]
+        self.max_sessions_per_adapter = max_sessions_per_adapter
+        self.max_connect_attempts = max_connect_attempts
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self._queues = OrderedDict() # grupo -> deque de sesiones pendientes
+        self._active_devices = set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher_task = None
+
+
+    async def submit(self, job, group, device: str, run):
+        """
+        Encola una sesión y espera a que termine, devolviendo su resultado.
+        Parámetros:
+            job: TransferJob asociado (se le notifican reintentos y cambios de fase)
+            group: clave de reparto justo entre sesiones (p.ej. (fw_title, fw_version))
+            device: dirección MAC del dispositivo (no se abren dos sesiones a la vez con él)
+            run: corrutina run(adapter) que realiza la sesión sobre el BleAdapter asignado;
+                 debe lanzar BleConnectionError si falla el establecimiento de la conexión
+        """
+        if self._dispatcher_task is None:
+            self._dispatcher_task = asyncio.create_task(self._dispatch())
+        session = _BleSession(job, group, device, run)
+        self._enqueue(session)
+        try:
+            return await asyncio.shield(session.future)
+        except asyncio.CancelledError:
+            self._cancel(session)
+            raise
+
+
+    def status(self) -> dict:
+        return {
+            "adapters": {
+                adapter.name: {
+                    "active_sessions": adapter.active_sessions,
+                    "max_sessions": self.max_sessions_per_adapter,
+                    "cooldown_s": max(adapter.cooldown_until - time.monotonic(), 0),
+                } for adapter in self.adapters
+            },
+            "queued_sessions": {
+                f"{group}": len(sessions) for group, sessions in self._queues.items()
+            },
+        }
+
+
+    def _enqueue(self, session: _BleSession):
+        self._queues.setdefault(session.group, deque()).append(session)
+        self._wakeup.set()
+
+
+    def _cancel(self, session: _BleSession):
+        sessions = self._queues.get(session.group)
+        if sessions is not None and session in sessions:
+            sessions.remove(session)
+            if not sessions:
+                del self._queues[session.group]
+        if session.task is not None:
+            session.task.cancel()
+
+
+    def _free_adapter(self, now):
+        available = [
+            adapter for adapter in self.adapters
+            if adapter.active_sessions < self.max_sessions_per_adapter and adapter.cooldown_until <= now
+        ]
+        return min(available, key=lambda adapter: adapter.active_sessions, default=None)
+
+
+    def _next_ready_session(self, now):
+        # Turno rotatorio entre grupos: se toma la primera sesión lista del primer grupo
+        # que tenga alguna y ese grupo pasa al final de la cola
+        for group in list(self._queues):
+            sessions = self._queues[group]
+            for session in sessions:
+                if session.not_before <= now and session.device not in self._active_devices:
+                    sessions.remove(session)
+                    if sessions:
+                        self._queues.move_to_end(group)
+                    else:
+                        del self._queues[group]
+                    return session
+        return None
+
+
+    def _next_wakeup_delay(self, now):
+        instants = [session.not_before for sessions in self._queues.values() for session in sessions]
+        instants += [adapter.cooldown_until for adapter in self.adapters]
+        future_instants = [instant for instant in instants if instant > now]
+        return min(future_instants) - now if future_instants else None
+
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            adapter = self._free_adapter(now)
+            session = self._next_ready_session(now) if adapter is not None else None
+            if session is not None:
+                adapter.active_sessions += 1
+                self._active_devices.add(session.device)
+                session.task = asyncio.create_task(self._run_session(session, adapter))
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_wakeup_delay(now))
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def _run_session(self, session: _BleSession, adapter: BleAdapter):
+        session.attempts += 1
+        try:
+            result = await session.run(adapter)
+            if not session.future.done():
+                session.future.set_result(result)
+        except BleConnectionError as e:
+            if session.attempts >= self.max_connect_attempts:
+                if not session.future.done():
+                    session.future.set_exception(e)
+            else:
+                backoff = min(self.backoff_base_s * 2 ** (session.attempts - 1), self.backoff_max_s)
+                backoff *= random.uniform(0.5, 1.5)
+                print(f"Conexión con {session.device} fallida en {adapter.name} ({e}). "
+                    f"Reintento {session.attempts}/{self.max_connect_attempts - 1} en {backoff:.1f}s")
+                session.not_before = time.monotonic() + backoff
+                # El adaptador también descansa brevemente antes de aceptar otra conexión
+                adapter.cooldown_until = time.monotonic() + self.backoff_base_s
+                session.job.record_retry()
+                session.job.enter_phase("BACKOFF")
+                self._enqueue(session)
+        except asyncio.CancelledError:
+            if not session.future.done():
+                session.future.cancel()
+        except Exception as e:
+            if not session.future.done():
+                session.future.set_exception(e)
+        finally:
+            adapter.active_sessions -= 1
+            self._active_devices.discard(session.device)
+            self._wakeup.set()
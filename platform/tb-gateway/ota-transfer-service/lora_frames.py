@@ -0,0 +1,81 @@
+"""
+Tramas binarias para enviar el firmware por LoRa.
+
+Cabecera (14 bytes, big-endian) seguida de la carga útil:
+    tipo de trama (1) | id del dispositivo (6) | secuencia fiable (1) | bloque (2) | offset (4)
+
+El id del dispositivo son los 6 bytes de su MAC (el "lora_id" en hexadecimal). La
+secuencia fiable la asigna el gestor de fiabilidad del puente LoRa antes de enviarla,
+por lo que aquí se deja a 0. El firmware se divide en bloques de FW_BLOCK_SIZE bytes y
+cada trama lleva uno o varios bloques seguidos: el índice es el de su primer bloque y el
+offset indica la posición de la carga útil dentro del paquete.
+
+En las transferencias a un grupo, las tramas multicast llevan el id del grupo en lugar del
+de un dispositivo y no usan la secuencia fiable. Las tramas de paridad llevan el XOR de
+varios fragmentos consecutivos del mismo tamaño (el último, completado con ceros si es
+más corto): el campo de secuencia indica cuántos son y el índice, el primer bloque del
+primero. Con ellas un nodo al que le falte uno solo de esos fragmentos puede reconstruirlo.
+
+El índice de bloque ocupa 2 bytes, por lo que el paquete no puede superar MAX_FW_SIZE
+(2 MiB con bloques de 32 bytes).
+
+time_on_air() es la misma estimación que usa el puente LoRa para su ciclo de trabajo.
+"""
+
+import math
+import struct
+
+FW_FRAGMENT_FRAME = 0xF1
+FW_MULTICAST_FRAME = 0xF2
+FW_PARITY_FRAME = 0xF3
+FRAME_HEADER = struct.Struct('>B6sBHI')
+FW_BLOCK_SIZE = 32
+MAX_FW_BLOCK_INDEX = 0xFFFF
+MAX_FW_SIZE = (MAX_FW_BLOCK_INDEX + 1) * FW_BLOCK_SIZE
+
+
+def check_fw_size(fw_size: int):
+    """
+    Lanza ValueError si el paquete no se puede direccionar con el índice de bloque de las tramas.
+    """
+    if fw_size > MAX_FW_SIZE:
+        raise ValueError(f"El paquete ({fw_size} bytes) supera el tamaño máximo que se puede "
+            f"enviar por LoRa ({MAX_FW_SIZE} bytes)")
+
+
+def _check_block_index(index: int):
+    if not 0 <= index <= MAX_FW_BLOCK_INDEX:
+        raise ValueError(f"Índice de bloque {index} fuera del rango de la trama (0-{MAX_FW_BLOCK_INDEX})")
+
+
+def encode_fw_fragment(lora_id: str, index: int, offset: int, payload: bytes,
+    frame_type: int = FW_FRAGMENT_FRAME
+) -> bytes:
+    _check_block_index(index)
+    return FRAME_HEADER.pack(
+        frame_type, bytes.fromhex(lora_id), 0, index, offset
+    ) + payload
+
+
+def encode_fw_parity(group_id: str, index: int, offset: int, fragments: list) -> bytes:
+    _check_block_index(index)
+    parity = bytearray(max(len(fragment) for fragment in fragments))
+    for fragment in fragments:
+        for i, byte in enumerate(fragment):
+            parity[i] ^= byte
+    return FRAME_HEADER.pack(
+        FW_PARITY_FRAME, bytes.fromhex(group_id), len(fragments), index, offset
+    ) + parity
+
+
+def time_on_air(payload_len: int, sf: int, bw_khz: float, coding_rate: int, preamble_len: int) -> float:
+    """
+    Tiempo en el aire (segundos) de una trama LoRa de payload_len bytes, con cabecera
+    explícita y CRC, según la fórmula de la hoja de datos del SX1276.
+    """
+    symbol_time = (2 ** sf) / (bw_khz * 1000)
+    low_dr_optimize = 1 if symbol_time > 0.016 else 0
+    payload_symbols = 8 + max(
+        math.ceil((8 * payload_len - 4 * sf + 44) / (4 * (sf - 2 * low_dr_optimize))) * coding_rate, 0
+    )
+    return (preamble_len + 4.25) * symbol_time + payload_symbols * symbol_time
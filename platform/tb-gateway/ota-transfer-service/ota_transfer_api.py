@@ -1,28 +1,300 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
 from bleak import BleakClient
 import paho.mqtt.client as mqtt
 import json
-import httpx
+import asyncio
 import base64
+import httpx
 import binascii
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from package_cache import PackageCache, PackageKey, PackageFetchError
+from ble_scheduler import BleTransferScheduler, BleConnectionError
+from lora_frames import (
+    encode_fw_fragment, encode_fw_parity, check_fw_size, time_on_air, FW_BLOCK_SIZE, FW_MULTICAST_FRAME
+)
 
 TB_REST_API_HOST="host.docker.internal"
 TB_REST_API_PORT="8080"
 
+# Caché de paquetes OTA
+OTA_CACHE_DIR = os.getenv('ota_cache_dir', '/tmp/ota-package-cache')
+OTA_CACHE_MAX_BYTES = int(os.getenv('ota_cache_max_mb', '256')) * 1024 * 1024
+
 # BLE
 FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID = 'f4c7000e-40c5-88cc-c1d6-77bfb6baf772'
 BLE_FRAGMENT_SIZE = 128
+# Modo de transferencia por ventanas (escrituras sin respuesta y confirmación acumulativa)
+FIRMWARE_ACK_CHARACTERISTIC_UUID = 'f4c70010-40c5-88cc-c1d6-77bfb6baf772'
+BLE_WINDOWED_MODE = 0x01
+BLE_MAX_WINDOW_SIZE = 8 # Ventana máxima que admite el dispositivo
+BLE_WINDOW_SIZE = int(os.getenv('ble_window_size', '8'))
+if not 1 <= BLE_WINDOW_SIZE <= BLE_MAX_WINDOW_SIZE:
+    raise ValueError(f"ble_window_size debe estar entre 1 y {BLE_MAX_WINDOW_SIZE} (valor: {BLE_WINDOW_SIZE})")
+BLE_MAX_FRAGMENT_VALUE_SIZE = 512 # Tamaño máximo de la característica de fragmentos en el dispositivo
+BLE_ACK_TIMEOUT_S = 2
+BLE_MAX_WINDOW_RETRIES = 10
+BLE_ADAPTERS = os.getenv('ble_adapters', 'hci0').split(',')
+BLE_MAX_SESSIONS_PER_ADAPTER = int(os.getenv('ble_max_sessions_per_adapter', '3'))
+BLE_MAX_CONNECT_ATTEMPTS = int(os.getenv('ble_max_connect_attempts', '5'))
 
 # LoRa
 MOSQUITTO_BROKER_HOST = "host.docker.internal"
 MOSQUITTO_BROKER_PORT = 1884
 MQTT_USERNAME = "device"
 MQTT_PASSWORD = "updatable"
-LORA_FRAGMENT_SIZE = 128
-
-app = FastAPI()
+# Tamaño de fragmento mientras el puente LoRa no haya publicado uno para el nodo. El puente
+# publica (retained) en LORA_DATARATE_TOPIC el tamaño recomendado según la calidad del enlace
+LORA_DEFAULT_FRAGMENT_SIZE = 128
+LORA_DATARATE_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/{}/datarate"
+# El puente LoRa informa de cada fragmento entregado al nodo (o emitido al grupo): el progreso
+# de las transferencias LoRa se mide con estos avisos, no con las publicaciones en el broker
+LORA_DELIVERY_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/{}/delivery"
+# Al cancelarse o fallar una transferencia se descartan en el puente sus fragmentos pendientes
+LORA_PURGE_TOPIC = "thingsboard/OMG_ESP32_LORA/bridge/admin/purge"
+# Mensajes fiables desde LoRa, sin duplicados (los reenvía el gestor de fiabilidad del puente LoRa)
+LORA_UPLINK_TOPIC = "thingsboard/OMG_ESP32_LORA/deduplicated"
+LORA_MAX_REPAIR_ROUNDS = 20
+# Tiempo máximo de espera del informe de fragmentos recibidos, desde que el puente LoRa
+# entrega la consulta (que va detrás de los fragmentos encolados antes que ella)
+LORA_BITMAP_REPORT_TIMEOUT_S = int(os.getenv('lora_bitmap_report_timeout_s', '120'))
+# Parámetros de radio y ciclo de trabajo del gateway LoRa (los mismos que en el puente), con
+# los que se estima cuánto tarda el puente en entregar lo que tiene encolado
+LORA_SF = int(os.getenv('lora_sf', '7'))
+LORA_BW_KHZ = float(os.getenv('lora_bw_khz', '125'))
+LORA_CODING_RATE = int(os.getenv('lora_coding_rate', '5'))
+LORA_PREAMBLE_LEN = int(os.getenv('lora_preamble_len', '8'))
+LORA_DUTY_CYCLE = float(os.getenv('lora_duty_cycle', '0.01'))
+# Espera máxima entre dos avisos de entrega: LORA_DELIVERY_TIMEOUT_S más el tiempo que tarda
+# en emitirse todo lo encolado, multiplicado por LORA_DELIVERY_MARGIN (reenvíos, otro tráfico)
+LORA_DELIVERY_TIMEOUT_S = 120
+LORA_DELIVERY_MARGIN = 3
+LORA_MESSAGE_OVERHEAD = 32 # Bytes que añade el puente a los mensajes JSON (id, secuencia)
+# Transferencias a grupos: los fragmentos se envían una sola vez por multicast y se repara
+# la unión de los bloques que faltan a los miembros. Cada LORA_PARITY_GROUP_SIZE fragmentos
+# se envía una trama de paridad (0 para no enviarlas)
+LORA_RELIABLE_TOPIC = "thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/reliable/{}"
+LORA_MULTICAST_TOPIC = "thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/multicast/{}"
+LORA_PARITY_GROUP_SIZE = int(os.getenv('lora_parity_group_size', '8'))
+# Los miembros responden a las consultas multicast en un instante aleatorio dentro de un
+# periodo de LORA_REPORT_SLOT_S segundos por miembro, para no colisionar
+LORA_REPORT_SLOT_S = 2
+
+# Trabajos de transferencia
+MAX_FINISHED_JOBS = 1000 # Trabajos terminados que se conservan para su consulta
 
 mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+package_cache = PackageCache(OTA_CACHE_DIR, OTA_CACHE_MAX_BYTES)
+ble_scheduler = BleTransferScheduler(
+    BLE_ADAPTERS, BLE_MAX_SESSIONS_PER_ADAPTER, BLE_MAX_CONNECT_ATTEMPTS
+)
+transfer_jobs = OrderedDict() # id -> TransferJob, en orden de creación
+lora_bitmap_reports = {} # lora_id -> asyncio.Queue con los informes de bloques recibidos
+lora_fragment_sizes = {} # lora_id -> tamaño de fragmento recomendado por el puente LoRa
+lora_spreading_factors = {} # lora_id -> SF indicado por el puente LoRa
+lora_flows = {} # lora_id o grupo -> LoraFlow de la transferencia en curso
+event_loop = None
+
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties):
+    client.subscribe(f"{LORA_UPLINK_TOPIC}/+/fw_bitmap")
+    client.subscribe(LORA_DATARATE_TOPIC.format('+'))
+    client.subscribe(LORA_DELIVERY_TOPIC.format('+'))
+
+
+def on_mqtt_datarate(lora_id, payload):
+    try:
+        datarate = json.loads(payload.decode('utf-8'))
+        fragment_size = datarate["fragment_size"]
+    except (ValueError, KeyError) as e:
+        print(f"Tasa de datos de {lora_id} no válida: {e}")
+        return
+    lora_fragment_sizes[lora_id] = fragment_size
+    lora_spreading_factors[lora_id] = datarate.get("sf", LORA_SF)
+
+
+def on_mqtt_delivery(target_id, payload):
+    flow = lora_flows.get(target_id)
+    if flow is None:
+        return
+    try:
+        delivery = json.loads(payload.decode('utf-8'))
+    except ValueError as e:
+        print(f"Aviso de entrega hacia {target_id} no válido: {e}")
+        return
+    event_loop.call_soon_threadsafe(flow.on_delivery, delivery)
+
+
+def on_mqtt_message(client, userdata, msg):
+    lora_id = msg.topic.split('/')[3]
+    if msg.topic == LORA_DATARATE_TOPIC.format(lora_id):
+        on_mqtt_datarate(lora_id, msg.payload)
+        return
+    if msg.topic == LORA_DELIVERY_TOPIC.format(lora_id):
+        on_mqtt_delivery(lora_id, msg.payload)
+        return
+    # Se ejecuta en el hilo de paho: el informe se entrega al bucle de eventos
+    reports = lora_bitmap_reports.get(lora_id)
+    if reports is None:
+        return
+    try:
+        report = json.loads(msg.payload.decode('utf-8')).get("msg", {})
+    except ValueError as e:
+        print(f"Informe de fragmentos de {lora_id} no válido: {e}")
+        return
+    event_loop.call_soon_threadsafe(reports.put_nowait, report)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    # Conexión MQTT compartida por todas las transferencias LoRa concurrentes
+    mqttc.on_connect = on_mqtt_connect
+    mqttc.on_message = on_mqtt_message
+    mqttc.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    mqttc.connect(MOSQUITTO_BROKER_HOST, MOSQUITTO_BROKER_PORT)
+    mqttc.loop_start()
+    yield
+    mqttc.disconnect()
+    mqttc.loop_stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class TransferJob():
+    """
+    Transferencia OTA hacia un dispositivo que se ejecuta en segundo plano.
+    Registra su progreso y el tiempo que pasa en cada fase para poder consultarlo
+    mientras dura la transferencia y una vez terminada.
+    """
+
+    FINAL_STATES = ("DONE", "FAILED", "CANCELLED")
+
+    def __init__(self, connectivity: str, device: str, fw_title: str, fw_version: str):
+        self.id = uuid.uuid4().hex
+        self.connectivity = connectivity
+        self.device = device
+        self.fw_title = fw_title
+        self.fw_version = fw_version
+        self.state = "QUEUED"
+        self.error = None
+        self.total_bytes = None
+        self.bytes_sent = 0
+        self.fragments_sent = 0
+        self.retries = 0
+        self.members = None # Transferencias a grupos: lora_id -> estado de cada miembro
+        self.created_at = time.time()
+        self.transfer_started_at = None
+        self.finished_at = None
+        self.phase_durations = {} # fase -> segundos acumulados en ella
+        self._phase_started_at = time.monotonic()
+        self.task = None
+
+
+    def enter_phase(self, state: str):
+        now = time.monotonic()
+        self.phase_durations[self.state] = \
+            self.phase_durations.get(self.state, 0) + now - self._phase_started_at
+        self._phase_started_at = now
+        self.state = state
+        if state == "TRANSFERRING" and self.transfer_started_at is None:
+            self.transfer_started_at = now
+        if state in self.FINAL_STATES:
+            self.finished_at = time.time()
+
+
+    def record_fragment(self, size: int):
+        self.bytes_sent += size
+        self.fragments_sent += 1
+
+
+    def record_retry(self):
+        self.retries += 1
+
+
+    def record_delivery(self, delivery: dict):
+        # Transferencias LoRa: solo avanzan los fragmentos que el puente ha entregado al nodo
+        # (ACKED) o emitido al grupo (SENT); los descartados (DROPPED) se recuperan al reparar
+        if delivery.get("status") in ("ACKED", "SENT") and delivery.get("bytes"):
+            self.record_fragment(delivery["bytes"])
+
+
+    def status(self) -> dict:
+        fragment_rate = None
+        byte_rate = None
+        eta_s = None
+        if self.transfer_started_at is not None:
+            elapsed = time.monotonic() - self.transfer_started_at
+            if elapsed > 0 and self.fragments_sent > 0:
+                fragment_rate = self.fragments_sent / elapsed
+                byte_rate = self.bytes_sent / elapsed
+        if byte_rate and self.total_bytes is not None and self.state not in self.FINAL_STATES:
+            eta_s = max(self.total_bytes - self.bytes_sent, 0) / byte_rate
+        phase_durations = dict(self.phase_durations)
+        if self.state not in self.FINAL_STATES:
+            phase_durations[self.state] = phase_durations.get(self.state, 0) + \
+                time.monotonic() - self._phase_started_at
+        return {
+            "job_id": self.id,
+            "connectivity": self.connectivity,
+            "device": self.device,
+            "fw_title": self.fw_title,
+            "fw_version": self.fw_version,
+            "state": self.state,
+            "error": self.error,
+            "total_bytes": self.total_bytes,
+            "bytes_sent": self.bytes_sent,
+            "fragments_sent": self.fragments_sent,
+            "fragment_rate": fragment_rate,
+            "byte_rate": byte_rate,
+            "retries": self.retries,
+            "eta_s": eta_s,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "phase_durations_s": phase_durations,
+            "members": self.members,
+        }
+
+
+async def run_transfer_job(job: TransferJob, transfer):
+    """
+    Ejecuta la corrutina de transferencia de un trabajo, registrando su estado final.
+    """
+    try:
+        await transfer
+        job.enter_phase("DONE")
+        print(f"Trabajo {job.id} completado")
+    except asyncio.CancelledError:
+        job.enter_phase("CANCELLED")
+        print(f"Trabajo {job.id} cancelado")
+    except Exception as e:
+        job.error = f"({type(e).__name__}) {e}"
+        job.enter_phase("FAILED")
+        print(f"Trabajo {job.id} fallido: {job.error}")
+
+
+def submit_transfer_job(job: TransferJob, transfer) -> dict:
+    transfer_jobs[job.id] = job
+    job.task = asyncio.create_task(run_transfer_job(job, transfer))
+    # Se olvidan los trabajos terminados más antiguos
+    finished_jobs = [j for j in transfer_jobs.values() if j.state in TransferJob.FINAL_STATES]
+    for old_job in finished_jobs[:max(len(finished_jobs) - MAX_FINISHED_JOBS, 0)]:
+        del transfer_jobs[old_job.id]
+    print(f"Trabajo {job.id} encolado ({job.connectivity}, {job.device})")
+    return {"job_id": job.id, "state": job.state}
+
+
+def get_transfer_job(job_id: str) -> TransferJob:
+    job = transfer_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Trabajo {job_id} no encontrado")
+    return job
+
 
 def device_mac_from_name(name: str) -> str:
     with open('/tb-gw-config/myBleConnector.json', 'r') as file:
@@ -34,75 +306,524 @@ def device_mac_from_name(name: str) -> str:
     return device_name_mac_dict[name]
 
 
-async def transfer_firmware_BLE(mac_address, fw_data):
-    import traceback
-    try:
-        async with BleakClient(mac_address) as client:
-            fw_size = len(fw_data)
-            print(f"Tamaño del firmware: {fw_size} bytes")
-            coded_fw_size = fw_size.to_bytes(4, byteorder='big')
-            await client.write_gatt_char(FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, coded_fw_size, response=True)
-            for i in range(0, fw_size, BLE_FRAGMENT_SIZE):
-                fragment = fw_data[i : i+BLE_FRAGMENT_SIZE]
-                print(f"Escribiendo fragmento {i}")
-                await client.write_gatt_char(FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, fragment, response=True)
-    except Exception as e:
-            print(f"Ocurrió un error: {e}")
-            traceback.print_exc()
-
-
-@app.post("/trigger_ble_ota_transfer")
-async def trigger_ble_ota_transfer(
-    device_name: str, fw_title: str, fw_version: str, access_token: str
-):
-    print(f"Se transferirá el paquete OTA al dispositivo {device_name}")
-    mac_address = device_mac_from_name(device_name)
-
+async def fetch_fw_info(access_token):
+    """
+    Consulta los atributos compartidos del dispositivo para obtener el checksum
+    (y su algoritmo) y el tamaño del firmware que tiene asignado.
+    """
     url = f"http://{TB_REST_API_HOST}:{TB_REST_API_PORT}"\
-          f"/api/v1/{access_token}/firmware?title={fw_title}&version={fw_version}"
-    print(f"Recuperando paquete OTA mediante la API REST del servidor Thingsboard (GET {url})")
+          f"/api/v1/{access_token}/attributes?sharedKeys=fw_checksum,fw_checksum_algorithm,fw_size"
     async with httpx.AsyncClient() as client:
         response = await client.get(url)
-
-    # Verifica si la solicitud fue exitosa
     if response.status_code != 200:
-        print("Solicitud fallida")
-        return "No se ha podido recuperar el paquete OTA asociado al dispositivo."
-
-    binary_data = response.content
-    print("Firmware recibido.")
-
-    print("Iniciando transferencia del firmware")
-    await transfer_firmware_BLE(mac_address, binary_data)
-
-    return "Paquete OTA transferido"
+        raise PackageFetchError(f"No se han podido consultar los atributos del dispositivo "
+            f"(HTTP {response.status_code})")
+    shared_attrs = response.json().get("shared", {})
+    if any(attr not in shared_attrs for attr in ("fw_checksum", "fw_checksum_algorithm", "fw_size")):
+        raise PackageFetchError("El dispositivo no tiene asignados los atributos fw_checksum, "
+            "fw_checksum_algorithm y fw_size")
+    return shared_attrs["fw_checksum"], shared_attrs["fw_checksum_algorithm"], int(shared_attrs["fw_size"])
+
+
+async def retrieve_ota_package(access_token, fw_title, fw_version):
+    """
+    Devuelve el paquete OTA asignado al dispositivo, pasando por la caché compartida
+    para que una misma versión se descargue una única vez para toda la flota.
+    El paquete puede estar aún descargándose: se lee con CachedPackage.fragments().
+    Hay que liberarlo con package_cache.release() al terminar la transferencia.
+    """
+    fw_checksum, fw_checksum_alg, fw_size = await fetch_fw_info(access_token)
+    key = PackageKey(fw_title, fw_version, fw_checksum)
 
+    url = f"http://{TB_REST_API_HOST}:{TB_REST_API_PORT}"\
+          f"/api/v1/{access_token}/firmware?title={fw_title}&version={fw_version}"
 
-async def transfer_firmware_LoRa(lora_id, fw_data):
-
-    mqttc.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    mqttc.connect(MOSQUITTO_BROKER_HOST, MOSQUITTO_BROKER_PORT)
-    mqttc.loop_start()
+    async def fetch():
+        print(f"Recuperando paquete OTA mediante la API REST del servidor Thingsboard (GET {url})")
+        async with httpx.AsyncClient() as client:
+            async with client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    raise PackageFetchError(f"Descarga del paquete fallida (HTTP {response.status_code})")
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+
+    return await package_cache.get(key, fw_checksum_alg, fw_size, fetch)
+
+
+async def transfer_firmware_BLE_legacy(job: TransferJob, client, package):
+    """
+    Transferencia con fragmentos de BLE_FRAGMENT_SIZE bytes escritos con respuesta,
+    para dispositivos que no ofrecen la característica de confirmación acumulativa.
+    """
+    fw_size = package.expected_size
+    coded_fw_size = fw_size.to_bytes(4, byteorder='big')
+    await client.write_gatt_char(FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, coded_fw_size, response=True)
+    job.enter_phase("TRANSFERRING")
+    async for fragment in package.fragments(BLE_FRAGMENT_SIZE):
+        print(f"Escribiendo fragmento {job.bytes_sent}")
+        await client.write_gatt_char(FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, fragment, response=True)
+        job.record_fragment(len(fragment))
+
+
+async def negotiated_mtu(client) -> int:
+    """
+    MTU de la conexión BLE. Con BlueZ, bleak devuelve siempre el mínimo (23) hasta que se
+    fuerza la adquisición del MTU, y para ello solo hay una función interna del backend
+    (comprobado con bleak 1.0.1, la versión de requirements.txt; es lo que hace el ejemplo
+    mtu_size.py de bleak). Si otra versión no la tiene, se usa el valor público mtu_size,
+    con lo que la transferencia funciona igual pero con fragmentos más pequeños.
+    """
+    backend = getattr(client, "_backend", None)
+    if type(backend).__name__ == "BleakClientBlueZDBus":
+        try:
+            await backend._acquire_mtu()
+        except AttributeError as e:
+            print(f"No se ha podido adquirir el MTU en BlueZ ({e}). Se usa el que indica bleak")
+    return client.mtu_size
+
+
+async def transfer_firmware_BLE_windowed(job: TransferJob, client, package):
+    """
+    Transferencia con fragmentos ajustados al MTU negociado, escritos sin respuesta en
+    ventanas de BLE_WINDOW_SIZE fragmentos. Cada fragmento lleva delante su número de
+    secuencia (2 bytes) y el dispositivo notifica periódicamente el siguiente número que
+    espera (2 bytes) y un indicador de hueco (1 byte). Ante un hueco o si no llega la
+    confirmación, se reenvía desde el primer fragmento no confirmado.
+    """
+    mtu_size = await negotiated_mtu(client)
+    fragment_size = min(mtu_size - 3, BLE_MAX_FRAGMENT_VALUE_SIZE) - 2
+    print(f"MTU negociado: {mtu_size}. Fragmentos de {fragment_size} bytes")
+
+    acks = asyncio.Queue()
+    await client.start_notify(
+        FIRMWARE_ACK_CHARACTERISTIC_UUID, lambda _, data: acks.put_nowait(bytes(data))
+    )
+    fw_size = package.expected_size
+    header = fw_size.to_bytes(4, byteorder='big') + \
+        bytes([BLE_WINDOWED_MODE, BLE_WINDOW_SIZE]) + fragment_size.to_bytes(2, byteorder='big')
+    await client.write_gatt_char(FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, header, response=True)
+    job.enter_phase("TRANSFERRING")
+
+    fragments = package.fragments(fragment_size)
+    unacked = deque() # Fragmentos enviados (o por enviar) aún no confirmados
+    base = 0 # Índice del primer fragmento no confirmado
+    next_to_send = 0
+    exhausted = False
+    retries = 0
+    while True:
+        while len(unacked) < BLE_WINDOW_SIZE and not exhausted:
+            try:
+                unacked.append(await anext(fragments))
+            except StopAsyncIteration:
+                exhausted = True
+        if not unacked:
+            break
+
+        while next_to_send < base + len(unacked):
+            seq = (next_to_send & 0xFFFF).to_bytes(2, byteorder='big')
+            await client.write_gatt_char(
+                FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID, seq + unacked[next_to_send - base], response=False
+            )
+            next_to_send += 1
+
+        try:
+            ack = await asyncio.wait_for(acks.get(), BLE_ACK_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            retries += 1
+            if retries > BLE_MAX_WINDOW_RETRIES:
+                raise RuntimeError("El dispositivo no confirma la recepción de los fragmentos")
+            print(f"Confirmación no recibida. Reenviando desde el fragmento {base}")
+            job.record_retry()
+            next_to_send = base
+            continue
+
+        acked_next = base + ((int.from_bytes(ack[0:2], byteorder='big') - base) & 0xFFFF)
+        if acked_next > base + len(unacked):
+            continue # Confirmación obsoleta o corrupta
+        if acked_next > base:
+            retries = 0
+        for _ in range(acked_next - base):
+            job.record_fragment(len(unacked.popleft()))
+        base = acked_next
+        if len(ack) > 2 and ack[2] and next_to_send > base:
+            print(f"Hueco detectado por el dispositivo. Reenviando desde el fragmento {base}")
+            job.record_retry()
+            next_to_send = base
+        next_to_send = max(next_to_send, base)
+
+
+async def transfer_firmware_BLE(job: TransferJob, mac_address, package, adapter):
+    job.total_bytes = package.expected_size
+    job.enter_phase("CONNECTING")
+    client = BleakClient(mac_address, adapter=adapter.name)
+    async with adapter.connect_lock:
+        try:
+            await client.connect()
+        except Exception as e:
+            raise BleConnectionError(f"({type(e).__name__}) {e}") from e
+    print(f"Conectado a {mac_address} mediante {adapter.name}")
+    try:
+        print(f"Tamaño del firmware: {package.expected_size} bytes")
+        if client.services.get_characteristic(FIRMWARE_ACK_CHARACTERISTIC_UUID) is not None:
+            await transfer_firmware_BLE_windowed(job, client, package)
+        else:
+            print("El dispositivo no soporta el modo por ventanas. Usando fragmentos con respuesta")
+            await transfer_firmware_BLE_legacy(job, client, package)
+    finally:
+        await client.disconnect()
+
+
+async def ble_ota_transfer(job: TransferJob, access_token):
+    job.enter_phase("FETCHING")
+    mac_address = device_mac_from_name(job.device)
+    package = await retrieve_ota_package(access_token, job.fw_title, job.fw_version)
+    try:
+        job.enter_phase("WAITING_ADAPTER")
+        print("Transferencia del firmware en espera de un adaptador BLE libre")
+        await ble_scheduler.submit(
+            job, (job.fw_title, job.fw_version), mac_address,
+            lambda adapter: transfer_firmware_BLE(job, mac_address, package, adapter)
+        )
+    finally:
+        package_cache.release(package)
 
-    fw_fragments_topic = f"thingsboard/OMG_ESP32_LORA/commands/MQTTtoLORA/reliable/{lora_id}"
-
-    fw_size = len(fw_data)
-    print(f"Tamaño del firmware: {fw_size} bytes")
-    # coded_fw_size = fw_size.to_bytes(4, byteorder='big')
-    for i in range(0, fw_size, LORA_FRAGMENT_SIZE):
-        print(f"Enviando fragmento {i}")
-        fragment = fw_data[i : i+LORA_FRAGMENT_SIZE]
-        fragment_str = base64.b64encode(fragment).decode('utf-8')
-        msg_to_send = json.dumps({
-            "fw_fragment": fragment_str
-        }).encode('utf-8')
-        msg_info = mqttc.publish(fw_fragments_topic, msg_to_send, qos=2)
-        msg_info.wait_for_publish()
 
-    mqttc.disconnect()
-    mqttc.loop_stop()
+@app.post("/trigger_ble_ota_transfer")
+async def trigger_ble_ota_transfer(
+    device_name: str, fw_title: str, fw_version: str, access_token: str
+):
+    print(f"Se transferirá el paquete OTA al dispositivo {device_name}")
+    job = TransferJob("BLE", device_name, fw_title, fw_version)
+    return submit_transfer_job(job, ble_ota_transfer(job, access_token))
+
+
+async def publish_to_lora(topic, payload):
+    msg_info = mqttc.publish(topic, payload, qos=2)
+    # Se espera fuera del bucle de eventos para no bloquear el resto de trabajos
+    await asyncio.to_thread(msg_info.wait_for_publish)
+
+
+def abort_lora_transfer(lora_ids: list, group_id=None):
+    """
+    Descarta en el puente LoRa los fragmentos aún no entregados de una transferencia
+    cancelada o fallida, y pide a los nodos que abandonen la descarga.
+    """
+    targets = lora_ids if group_id is None else [group_id, *lora_ids]
+    for target_id in targets:
+        mqttc.publish(LORA_PURGE_TOPIC, json.dumps({"id": target_id}), qos=2)
+    for lora_id in lora_ids:
+        mqttc.publish(LORA_RELIABLE_TOPIC.format(lora_id), json.dumps({"fw_cancel": True}), qos=2)
+    print(f"Transferencia abandonada: descartando fragmentos pendientes hacia {targets}")
+
+
+class LoraFlow():
+    """
+    Envíos de una transferencia LoRa hacia un nodo o un grupo que el puente LoRa aún no ha
+    resuelto. El puente los entrega en orden (carril bulk), de modo que cuando no queda
+    ninguno pendiente el nodo ya ha recibido (o perdido) todo lo publicado hasta entonces.
+    """
+
+    def __init__(self, job: TransferJob):
+        self.job = job
+        self.pending = deque() # Tamaño en el aire de los envíos aún sin resolver
+        self._changed = asyncio.Event()
+
+
+    async def publish(self, topic, payload: bytes):
+        is_json = payload.startswith(b'{')
+        self.pending.append(len(payload) + (LORA_MESSAGE_OVERHEAD if is_json else 0))
+        await publish_to_lora(topic, payload)
+
+
+    def on_delivery(self, delivery: dict):
+        if self.pending:
+            self.pending.popleft()
+        self.job.record_delivery(delivery)
+        self._changed.set()
+
+
+    def airtime(self, sf: int) -> float:
+        return sum(
+            time_on_air(size, sf, LORA_BW_KHZ, LORA_CODING_RATE, LORA_PREAMBLE_LEN) for size in self.pending
+        )
+
+
+    async def drain(self):
+        """
+        Espera a que el puente resuelva todo lo publicado. El plazo se recalcula con cada
+        aviso de entrega a partir de lo que queda encolado en el puente.
+        """
+        while self.pending:
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), lora_delivery_timeout())
+            except asyncio.TimeoutError:
+                raise RuntimeError("El puente LoRa no ha entregado los envíos pendientes") from None
+
+
+def lora_delivery_timeout() -> float:
+    # Todas las transferencias comparten la radio (y el ciclo de trabajo) del gateway
+    sf = max(lora_spreading_factors.values(), default=LORA_SF)
+    queued_airtime = sum(flow.airtime(sf) for flow in lora_flows.values())
+    return LORA_DELIVERY_TIMEOUT_S + queued_airtime / LORA_DUTY_CYCLE * LORA_DELIVERY_MARGIN
+
+
+def lora_fragment_size(lora_id) -> int:
+    # Múltiplo del tamaño de bloque, que es la unidad de los índices y del mapa de bits
+    fragment_size = lora_fragment_sizes.get(lora_id, LORA_DEFAULT_FRAGMENT_SIZE)
+    return max(fragment_size // FW_BLOCK_SIZE, 1) * FW_BLOCK_SIZE
+
+
+def missing_blocks(report: dict, block_count: int) -> list:
+    """
+    Índices de los bloques que faltan según un informe del nodo, que contiene el
+    tramo del mapa de bits de bloques recibidos que empieza en el bloque "from".
+    Un mapa vacío indica que no se ha recibido ningún bloque desde "from".
+    """
+    first = report["from"]
+    bitmap = base64.b64decode(report["bitmap"])
+    if not bitmap:
+        return list(range(first, block_count))
+    return [
+        first + bit for bit in range(len(bitmap) * 8)
+        if first + bit < block_count and not bitmap[bit // 8] & (1 << (bit % 8))
+    ]
+
+
+def group_blocks(blocks: list, max_blocks: int) -> list:
+    """
+    Agrupa bloques consecutivos en fragmentos de como mucho max_blocks bloques.
+    Devuelve una lista de (primer bloque, número de bloques).
+    """
+    groups = []
+    for block in blocks:
+        if groups and groups[-1][0] + groups[-1][1] == block and groups[-1][1] < max_blocks:
+            groups[-1] = (groups[-1][0], groups[-1][1] + 1)
+        else:
+            groups.append((block, 1))
+    return groups
+
+
+async def wait_for_bitmap_report(flow: LoraFlow, topic, reports: asyncio.Queue, repair_round: int) -> dict:
+    # El nodo informa por iniciativa propia al completar la descarga
+    while not reports.empty():
+        report = reports.get_nowait()
+        if report.get("done"):
+            return report
+    await flow.publish(topic, json.dumps({"fw_query": repair_round}).encode('utf-8'))
+    await flow.drain()
+    return await next_bitmap_report(reports, repair_round)
+
+
+async def next_bitmap_report(reports: asyncio.Queue, repair_round: int, spread_s: int = 0) -> dict:
+    deadline = time.monotonic() + LORA_BITMAP_REPORT_TIMEOUT_S + spread_s
+    while True:
+        try:
+            report = await asyncio.wait_for(reports.get(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            raise RuntimeError("El nodo no ha informado de los fragmentos recibidos") from None
+        # Se ignoran los informes de rondas anteriores
+        if report.get("done") or report.get("round") == repair_round:
+            return report
+
+
+async def transfer_firmware_LoRa(job: TransferJob, lora_id, package):
+
+    check_fw_size(package.expected_size)
+    if lora_id in lora_bitmap_reports:
+        raise RuntimeError(f"Ya hay una transferencia en curso hacia {lora_id}")
+    reports = asyncio.Queue()
+    lora_bitmap_reports[lora_id] = reports
+    flow = LoraFlow(job)
+    lora_flows[lora_id] = flow
+
+    fw_fragments_topic = LORA_RELIABLE_TOPIC.format(lora_id)
+
+    fw_size = package.expected_size
+    block_count = (fw_size + FW_BLOCK_SIZE - 1) // FW_BLOCK_SIZE
+    job.total_bytes = fw_size
+    print(f"Tamaño del firmware: {fw_size} bytes ({block_count} bloques)")
+    completed = False
+    try:
+        job.enter_phase("TRANSFERRING")
+        # El tamaño de fragmento se consulta en cada envío: puede cambiar durante la
+        # transferencia si varía la calidad del enlace
+        offset = 0
+        while offset < fw_size:
+            fragment = await package.read_range(offset, lora_fragment_size(lora_id))
+            index = offset // FW_BLOCK_SIZE
+            print(f"Enviando fragmento (bloque {index}, {len(fragment)} bytes)")
+            await flow.publish(fw_fragments_topic, encode_fw_fragment(lora_id, index, offset, fragment))
+            offset += len(fragment)
+
+        # Rondas de reparación: se reenvían solo los bloques que le faltan al nodo
+        for repair_round in range(1, LORA_MAX_REPAIR_ROUNDS + 1):
+            job.enter_phase("WAITING_REPORT")
+            report = await wait_for_bitmap_report(flow, fw_fragments_topic, reports, repair_round)
+            if report.get("done"):
+                print(f"El nodo {lora_id} ha recibido todo el firmware")
+                completed = True
+                return
+            missing = missing_blocks(report, block_count)
+            print(f"Ronda de reparación {repair_round}: reenviando {len(missing)} bloques")
+            job.enter_phase("REPAIRING")
+            for index, blocks in group_blocks(missing, lora_fragment_size(lora_id) // FW_BLOCK_SIZE):
+                offset = index * FW_BLOCK_SIZE
+                fragment = await package.read_range(offset, blocks * FW_BLOCK_SIZE)
+                await flow.publish(fw_fragments_topic, encode_fw_fragment(lora_id, index, offset, fragment))
+                job.record_retry()
+        raise RuntimeError(f"Firmware incompleto tras {LORA_MAX_REPAIR_ROUNDS} rondas de reparación")
+    finally:
+        del lora_bitmap_reports[lora_id]
+        del lora_flows[lora_id]
+        if not completed:
+            abort_lora_transfer([lora_id])
+
+
+def new_multicast_group() -> str:
+    group = bytearray(os.urandom(6))
+    group[0] |= 0x01 # Bit de multicast, como en las direcciones MAC: no coincide con ningún nodo
+    return group.hex()
+
+
+async def send_multicast_first_pass(flow: LoraFlow, topic, group_id, package, fragment_size):
+    """
+    Envía todo el firmware al grupo en fragmentos de fragment_size bytes, seguidos cada
+    LORA_PARITY_GROUP_SIZE fragmentos de una trama de paridad.
+    """
+    fw_size = package.expected_size
+    parity_fragments = []
+    offset = 0
+    while offset < fw_size:
+        fragment = await package.read_range(offset, fragment_size)
+        await flow.publish(topic,
+            encode_fw_fragment(group_id, offset // FW_BLOCK_SIZE, offset, fragment, FW_MULTICAST_FRAME))
+        offset += len(fragment)
+        if LORA_PARITY_GROUP_SIZE > 0:
+            parity_fragments.append(fragment)
+            if len(parity_fragments) == LORA_PARITY_GROUP_SIZE or offset >= fw_size:
+                parity_offset = offset - sum(len(fragment) for fragment in parity_fragments)
+                # La paridad ocupa lo que el fragmento más largo, que debe ser un número entero
+                # de bloques: no se envía si el último tramo es solo un fragmento final más corto
+                if len(parity_fragments[0]) % FW_BLOCK_SIZE == 0:
+                    await flow.publish(topic, encode_fw_parity(
+                        group_id, parity_offset // FW_BLOCK_SIZE, parity_offset, parity_fragments))
+                parity_fragments = []
+
+
+async def wait_for_member_report(lora_id, flow: LoraFlow, reports: asyncio.Queue, repair_round: int, spread_s: int):
+    """
+    Espera la respuesta de un miembro a la consulta multicast de la ronda indicada (ya
+    emitida por el puente). Si no responde se le consulta directamente y, si tampoco, se
+    devuelve None.
+    """
+    try:
+        return await next_bitmap_report(reports, repair_round, spread_s)
+    except RuntimeError:
+        pass
+    print(f"El nodo {lora_id} no ha respondido a la consulta multicast. Consultando directamente")
+    try:
+        return await wait_for_bitmap_report(flow, LORA_RELIABLE_TOPIC.format(lora_id), reports, repair_round)
+    except RuntimeError as e:
+        print(f"Nodo {lora_id} excluido de la transferencia: {e}")
+        return None
+
+
+async def transfer_firmware_LoRa_group(job: TransferJob, lora_ids: list, package):
+
+    check_fw_size(package.expected_size)
+    busy = [lora_id for lora_id in lora_ids if lora_id in lora_bitmap_reports]
+    if busy:
+        raise RuntimeError(f"Ya hay transferencias en curso hacia {busy}")
+    member_reports = {lora_id: asyncio.Queue() for lora_id in lora_ids}
+    lora_bitmap_reports.update(member_reports)
+
+    group_id = job.device
+    group_flow = LoraFlow(job)
+    member_flows = {lora_id: LoraFlow(job) for lora_id in lora_ids}
+    lora_flows.update(member_flows)
+    lora_flows[group_id] = group_flow
+    multicast_topic = LORA_MULTICAST_TOPIC.format(group_id)
+    fw_size = package.expected_size
+    block_count = (fw_size + FW_BLOCK_SIZE - 1) // FW_BLOCK_SIZE
+    # El tamaño de fragmento lo limita el miembro con peor enlace
+    fragment_size = min(lora_fragment_size(lora_id) for lora_id in lora_ids)
+    job.total_bytes = fw_size
+    job.members = {lora_id: "TRANSFERRING" for lora_id in lora_ids}
+    print(f"Tamaño del firmware: {fw_size} bytes ({block_count} bloques) para el grupo {group_id}")
+    try:
+        # Los miembros aceptan las tramas dirigidas al grupo a partir de este mensaje, así
+        # que se espera a que lo reciban antes de empezar a emitirlas
+        for lora_id in lora_ids:
+            await member_flows[lora_id].publish(LORA_RELIABLE_TOPIC.format(lora_id),
+                json.dumps({"fw_group": group_id}).encode('utf-8'))
+        await asyncio.gather(*[flow.drain() for flow in member_flows.values()])
+        job.enter_phase("TRANSFERRING")
+        await send_multicast_first_pass(group_flow, multicast_topic, group_id, package, fragment_size)
+
+        # Rondas de reparación: se reenvía la unión de los bloques que faltan a los miembros
+        pending = list(lora_ids)
+        for repair_round in range(1, LORA_MAX_REPAIR_ROUNDS + 1):
+            job.enter_phase("WAITING_REPORT")
+            query = {"fw_query": repair_round, "spread": len(pending) * LORA_REPORT_SLOT_S}
+            await group_flow.publish(multicast_topic, json.dumps(query).encode('utf-8'))
+            await group_flow.drain()
+            reports = await asyncio.gather(*[
+                wait_for_member_report(lora_id, member_flows[lora_id], member_reports[lora_id],
+                    repair_round, query["spread"])
+                for lora_id in pending
+            ])
+            missing = set()
+            for lora_id, report in zip(list(pending), reports):
+                if report is None or report.get("done"):
+                    job.members[lora_id] = "FAILED" if report is None else "DONE"
+                    pending.remove(lora_id)
+                else:
+                    missing.update(missing_blocks(report, block_count))
+            if not pending:
+                break
+            print(f"Ronda de reparación {repair_round}: reenviando {len(missing)} bloques al grupo")
+            job.enter_phase("REPAIRING")
+            for index, blocks in group_blocks(sorted(missing), fragment_size // FW_BLOCK_SIZE):
+                offset = index * FW_BLOCK_SIZE
+                fragment = await package.read_range(offset, blocks * FW_BLOCK_SIZE)
+                await group_flow.publish(multicast_topic,
+                    encode_fw_fragment(group_id, index, offset, fragment, FW_MULTICAST_FRAME))
+                job.record_retry()
+        for lora_id in pending:
+            job.members[lora_id] = "FAILED"
+        failed = [lora_id for lora_id, state in job.members.items() if state == "FAILED"]
+        if failed:
+            raise RuntimeError(f"Firmware incompleto en los nodos {failed}")
+        print(f"Todos los nodos del grupo {group_id} han recibido el firmware")
+    finally:
+        for lora_id in lora_ids:
+            del lora_bitmap_reports[lora_id]
+            del lora_flows[lora_id]
+        del lora_flows[group_id]
+        unfinished = [lora_id for lora_id, state in job.members.items() if state != "DONE"]
+        if unfinished:
+            abort_lora_transfer(unfinished, group_id)
+
+
+async def lora_group_ota_transfer(job: TransferJob, lora_ids: list, access_token):
+    job.enter_phase("FETCHING")
+    package = await retrieve_ota_package(access_token, job.fw_title, job.fw_version)
+    try:
+        print("Iniciando transferencia multicast del firmware")
+        await transfer_firmware_LoRa_group(job, lora_ids, package)
+    finally:
+        package_cache.release(package)
 
 
+async def lora_ota_transfer(job: TransferJob, access_token):
+    job.enter_phase("FETCHING")
+    package = await retrieve_ota_package(access_token, job.fw_title, job.fw_version)
+    try:
+        print("Iniciando transferencia del firmware")
+        await transfer_firmware_LoRa(job, job.device, package)
+    finally:
+        package_cache.release(package)
 
 
 @app.post("/trigger_lora_ota_transfer")
@@ -110,25 +831,50 @@ async def trigger_lora_ota_transfer(
     device_name: str, fw_title: str, fw_version: str, access_token: str, lora_id: str
 ):
     print(f"Se transferirá el paquete OTA al dispositivo {lora_id}")
+    job = TransferJob("LoRa", lora_id, fw_title, fw_version)
+    return submit_transfer_job(job, lora_ota_transfer(job, access_token))
 
-    url = f"http://{TB_REST_API_HOST}:{TB_REST_API_PORT}"\
-          f"/api/v1/{access_token}/firmware?title={fw_title}&version={fw_version}"
-    print(f"Recuperando paquete OTA mediante la API REST del servidor Thingsboard (GET {url})")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-
-    # Verifica si la solicitud fue exitosa
-    if response.status_code != 200:
-        print("Solicitud fallida")
-        return "No se ha podido recuperar el paquete OTA asociado al dispositivo."
-
-    binary_data = response.content
-    print("Firmware recibido.")
 
-    print("Iniciando transferencia del firmware")
-    await transfer_firmware_LoRa(lora_id, binary_data)
-
-    return "Implementando para LoRa"
+@app.post("/trigger_lora_group_ota_transfer")
+async def trigger_lora_group_ota_transfer(
+    fw_title: str, fw_version: str, access_token: str, lora_ids: str
+):
+    """
+    Transfiere el paquete OTA a la vez a varios dispositivos LoRa (lora_ids separados por
+    comas), que deben haber recibido ya los atributos de la OTA desde Thingsboard. El
+    access_token puede ser el de cualquiera de ellos (solo se usa para descargar el paquete).
+    """
+    lora_id_list = list(dict.fromkeys(lora_id for lora_id in lora_ids.split(',') if lora_id))
+    if not lora_id_list:
+        raise HTTPException(status_code=400, detail="No se ha indicado ningún dispositivo")
+    group_id = new_multicast_group()
+    print(f"Se transferirá el paquete OTA al grupo {group_id}: {lora_id_list}")
+    job = TransferJob("LoRa", group_id, fw_title, fw_version)
+    return submit_transfer_job(job, lora_group_ota_transfer(job, lora_id_list, access_token))
+
+
+@app.get("/ble_adapters")
+async def ble_adapters_status():
+    return ble_scheduler.status()
+
+
+@app.get("/transfer_jobs")
+async def list_transfer_jobs(state: str = None):
+    return [job.status() for job in transfer_jobs.values() if state is None or job.state == state]
+
+
+@app.get("/transfer_jobs/{job_id}")
+async def transfer_job_status(job_id: str):
+    return get_transfer_job(job_id).status()
+
+
+@app.delete("/transfer_jobs/{job_id}")
+async def cancel_transfer_job(job_id: str):
+    job = get_transfer_job(job_id)
+    if job.state not in TransferJob.FINAL_STATES:
+        job.task.cancel()
+        print(f"Cancelando trabajo {job_id}")
+    return {"job_id": job.id, "state": job.state}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+"""
+Caché de paquetes OTA compartida por todas las transferencias del servicio.
+
+Los paquetes se guardan en disco, direccionados por su checksum, y se indexan por
+(título, versión, checksum). La caché tiene un tamaño máximo y expulsa primero los
+paquetes usados hace más tiempo (LRU), salvo los que está usando alguna transferencia:
+cada get() debe ir seguido de un release() cuando la transferencia deja de leer el
+paquete. Si varias transferencias piden a la vez un paquete que aún no está en caché,
+todas comparten una única descarga.
+
+Un paquete se puede leer por fragmentos mientras aún se está descargando, de forma que
+la transferencia por radio empieza con los primeros bytes recibidos de Thingsboard y
+la memoria usada no depende del tamaño del paquete.
+"""
+
+import asyncio
+import hashlib
+import os
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+PACKAGE_SUFFIX = ".pkg"
+PARTIAL_SUFFIX = ".part"
+
+
+class PackageKey(NamedTuple):
+    title: str
+    version: str
+    checksum: str
+
+
+class PackageFetchError(Exception):
+    """
+    Error al recuperar un paquete OTA desde Thingsboard.
+    """
+
+
+class CachedPackage():
+
+    def __init__(self, key: PackageKey, path: str, expected_size: int):
+        self.key = key
+        self.path = path
+        self.expected_size = expected_size
+        self.size = 0 # Bytes ya escritos en disco
+        self.complete = False
+        self.error = None
+        self.users = 0 # Transferencias que lo están usando (no se puede expulsar)
+        self._progress = asyncio.Condition()
+        self._fetch_task = None
+
+
+    async def _update_progress(self, size=None, complete=False, error=None):
+        async with self._progress:
+            if size is not None:
+                self.size = size
+            self.complete = self.complete or complete
+            self.error = error
+            self._progress.notify_all()
+
+
+    async def _wait_until_available(self, end: int):
+        async with self._progress:
+            await self._progress.wait_for(
+                lambda: self.size >= end or self.complete or self.error is not None
+            )
+
+
+    async def _read_fragments(self, fragment_size: int):
+        if self.error is not None:
+            raise PackageFetchError("Descarga del paquete interrumpida") from self.error
+        # El descriptor abierto sigue siendo válido aunque el fichero se renombre al
+        # completarse la descarga o se borre al ser expulsado de la caché
+        with open(self.path, 'rb') as package_file:
+            offset = 0
+            while True:
+                await self._wait_until_available(min(offset + fragment_size, self.expected_size))
+                if self.error is not None:
+                    raise PackageFetchError("Descarga del paquete interrumpida") from self.error
+                if offset >= self.size and self.complete:
+                    return
+                fragment = package_file.read(min(fragment_size, self.size - offset))
+                offset += len(fragment)
+                yield fragment
+
+
+    async def read_range(self, offset: int, size: int) -> bytes:
+        """
+        Lee size bytes del paquete a partir de offset, esperando a que estén descargados.
+        """
+        await self._wait_until_available(min(offset + size, self.expected_size))
+        if self.error is not None:
+            raise PackageFetchError("Descarga del paquete interrumpida") from self.error
+        with open(self.path, 'rb') as package_file:
+            package_file.seek(offset)
+            return package_file.read(size)
+
+
+    async def fragments(self, fragment_size: int, read_ahead: int = 8):
+        """
+        Itera asíncronamente sobre el contenido del paquete en fragmentos de fragment_size
+        bytes (el último puede ser menor), a medida que están disponibles en disco.
+        Se leen por adelantado como mucho read_ahead fragmentos, de modo que la lectura
+        del paquete se solapa con el envío por radio sin acumularlo en memoria.
+        """
+        buffer = asyncio.Queue(read_ahead)
+        end_of_package = object()
+
+        async def producer():
+            try:
+                async for fragment in self._read_fragments(fragment_size):
+                    await buffer.put(fragment)
+                await buffer.put(end_of_package)
+            except Exception as e:
+                await buffer.put(e)
+
+        producer_task = asyncio.create_task(producer())
+        try:
+            while True:
+                item = await buffer.get()
+                if item is end_of_package:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer_task.cancel()
+
+
+class _Crc32():
+    """
+    Adaptador de zlib.crc32 con la interfaz de hashlib.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+
+def new_checksum(algorithm: str):
+    """
+    Devuelve un objeto con la interfaz de hashlib (update/hexdigest) para el
+    algoritmo de checksum indicado por Thingsboard (SHA256, MD5, CRC32...).
+    """
+    algorithm = algorithm.lower().replace('-', '')
+    if algorithm == "crc32":
+        return _Crc32()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError as e:
+        raise PackageFetchError(f"Algoritmo de checksum no soportado: {algorithm}") from e
+
+
+class PackageCache():
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Parámetros:
+            cache_dir: directorio donde se almacenan los paquetes
+            max_bytes: tamaño máximo que pueden ocupar en conjunto los paquetes cacheados
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # PackageKey -> CachedPackage, del menos al más reciente
+        self._in_flight = {} # PackageKey -> CachedPackage cuya descarga está en curso
+        os.makedirs(cache_dir, exist_ok=True)
+        # Los paquetes de una ejecución anterior no están indexados: se descartan (solo los
+        # ficheros de la caché, por si el directorio se comparte con otros)
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith((PACKAGE_SUFFIX, PACKAGE_SUFFIX + PARTIAL_SUFFIX)):
+                os.remove(os.path.join(cache_dir, file_name))
+
+
+    async def get(self, key: PackageKey, checksum_algorithm: str, expected_size: int, fetch) -> CachedPackage:
+        """
+        Devuelve el paquete identificado por key. Si no está en caché se inicia su
+        descarga (o se reutiliza la que esté en curso) y se devuelve sin esperar a que
+        termine: su contenido se puede ir leyendo con CachedPackage.fragments().
+        El paquete no se expulsa de la caché hasta que se llama a release().
+        Parámetros:
+            key: título, versión y checksum del paquete
+            checksum_algorithm: algoritmo con el que se verifica la descarga
+            expected_size: tamaño del paquete reportado por la plataforma
+            fetch: función sin argumentos que devuelve un iterador asíncrono de bloques
+                   de bytes con el contenido del paquete
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            entry.users += 1
+            print(f"Paquete {key.title}({key.version}) servido desde la caché")
+            return entry
+
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            entry.users += 1
+            print(f"Paquete {key.title}({key.version}) en descarga. Compartiendo la descarga en curso")
+            return entry
+
+        print(f"Paquete {key.title}({key.version}) no cacheado. Iniciando descarga")
+        path = self._path_for(key.checksum)
+        entry = CachedPackage(key, self._partial_path_for(key.checksum), expected_size)
+        entry.users = 1
+        # Se abre (y trunca) el fichero antes de devolver la entrada, para que los
+        # lectores puedan abrirlo desde el primer momento
+        open(entry.path, 'wb').close()
+        self._in_flight[key] = entry
+        entry._fetch_task = asyncio.create_task(
+            self._fetch_into_cache(entry, path, checksum_algorithm, fetch)
+        )
+        return entry
+
+
+    def _path_for(self, checksum: str) -> str:
+        return os.path.join(self.cache_dir, f"{checksum.lower()}{PACKAGE_SUFFIX}")
+
+
+    def _partial_path_for(self, checksum: str) -> str:
+        # Cada descarga escribe en su propio fichero parcial, aunque otro título/versión
+        # con el mismo checksum se esté descargando a la vez; el fichero completo se
+        # renombra de forma atómica a la ruta compartida
+        return os.path.join(self.cache_dir,
+            f"{checksum.lower()}.{uuid.uuid4().hex}{PACKAGE_SUFFIX}{PARTIAL_SUFFIX}")
+
+
+    def release(self, entry: CachedPackage):
+        """
+        Indica que una transferencia ha dejado de usar un paquete obtenido con get().
+        """
+        entry.users -= 1
+        self._evict()
+
+
+    def _cached_bytes(self) -> int:
+        # Los paquetes con el mismo checksum comparten fichero: se cuenta una sola vez
+        return sum({entry.path: entry.size for entry in self._entries.values()}.values())
+
+
+    async def _fetch_into_cache(self, entry: CachedPackage, path: str, checksum_algorithm: str, fetch):
+        key = entry.key
+        partial_path = entry.path
+        size = 0
+        try:
+            checksum = new_checksum(checksum_algorithm)
+            with open(partial_path, 'wb') as partial_file:
+                async for chunk in fetch():
+                    partial_file.write(chunk)
+                    partial_file.flush()
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    await entry._update_progress(size=size)
+            if size != entry.expected_size:
+                raise PackageFetchError(f"Tamaño del paquete descargado ({size} bytes) distinto "
+                    f"del reportado por la plataforma ({entry.expected_size} bytes)")
+            if checksum.hexdigest() != key.checksum.lower():
+                raise PackageFetchError("El checksum del paquete descargado no coincide con el "
+                    "reportado por la plataforma")
+            os.replace(partial_path, path)
+            entry.path = path
+        except Exception as e:
+            print(f"Error al descargar el paquete {key.title}({key.version}): {e}")
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            await entry._update_progress(error=e)
+            return
+        finally:
+            self._in_flight.pop(key, None)
+
+        self._entries[key] = entry
+        await entry._update_progress(complete=True)
+        print(f"Paquete {key.title}({key.version}) cacheado ({size} bytes)")
+        self._evict()
+
+
+    def _evict(self):
+        # Se conserva siempre el paquete más reciente, aunque supere el límite por sí solo,
+        # y los que estén usando las transferencias en curso
+        for key, entry in list(self._entries.items())[:-1]:
+            if self._cached_bytes() <= self.max_bytes:
+                return
+            if entry.users > 0:
+                continue
+            del self._entries[key]
+            # Otro título/versión puede compartir el mismo contenido (y el mismo fichero)
+            if not any(other.path == entry.path for other in self._entries.values()):
+                os.remove(entry.path)
+            print(f"Paquete {key.title}({key.version}) expulsado de la caché")
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# Los módulos del servicio se importan como en el contenedor (desde su directorio)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# ota_transfer_api crea la caché de paquetes al importarse
+os.environ.setdefault('ota_cache_dir', tempfile.mkdtemp(prefix="ota-cache-test-"))
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+from ble_scheduler import BleConnectionError, BleTransferScheduler
+
+
+class FakeJob():
+
+    def __init__(self):
+        self.retries = 0
+        self.phases = []
+
+    def record_retry(self):
+        self.retries += 1
+
+    def enter_phase(self, state):
+        self.phases.append(state)
+
+
+def test_sessions_are_spread_over_adapters_within_their_limit():
+    active = {}
+    peak = {}
+
+    async def session(adapter):
+        active[adapter.name] = active.get(adapter.name, 0) + 1
+        peak[adapter.name] = max(peak.get(adapter.name, 0), active[adapter.name])
+        await asyncio.sleep(0.01)
+        active[adapter.name] -= 1
+        return adapter.name
+
+    async def scenario():
+        scheduler = BleTransferScheduler(["hci0", "hci1"], 2)
+        return await asyncio.gather(*[
+            scheduler.submit(FakeJob(), ("fw", "v2"), f"device-{i}", session) for i in range(8)
+        ])
+
+    adapters = asyncio.run(scenario())
+    assert sorted(adapters) == ["hci0"] * 4 + ["hci1"] * 4
+    assert peak == {"hci0": 2, "hci1": 2}
+
+
+def test_deployments_take_turns():
+    order = []
+
+    def session_for(name):
+        async def session(adapter):
+            order.append(name)
+            await asyncio.sleep(0)
+        return session
+
+    async def scenario():
+        scheduler = BleTransferScheduler(["hci0"], 1)
+        await asyncio.gather(
+            *[scheduler.submit(FakeJob(), "big", f"big-{i}", session_for(f"big-{i}")) for i in range(3)],
+            scheduler.submit(FakeJob(), "small", "small-0", session_for("small-0")),
+        )
+
+    asyncio.run(scenario())
+    assert order == ["big-0", "small-0", "big-1", "big-2"]
+
+
+def test_one_session_at_a_time_per_device():
+    running = set()
+
+    async def session(adapter):
+        assert "device" not in running
+        running.add("device")
+        await asyncio.sleep(0.01)
+        running.discard("device")
+
+    async def scenario():
+        scheduler = BleTransferScheduler(["hci0", "hci1"], 2)
+        await asyncio.gather(*[scheduler.submit(FakeJob(), "fw", "device", session) for _ in range(3)])
+
+    asyncio.run(scenario())
+
+
+def test_connection_failures_are_retried_with_backoff():
+    attempts = []
+    job = FakeJob()
+
+    async def session(adapter):
+        attempts.append(adapter.name)
+        if len(attempts) < 3:
+            raise BleConnectionError("sin respuesta")
+        return "ok"
+
+    async def scenario():
+        scheduler = BleTransferScheduler(["hci0"], 1, max_connect_attempts=5, backoff_base_s=0.01)
+        return await scheduler.submit(job, "fw", "device", session)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert len(attempts) == 3
+    assert job.retries == 2
+    assert job.phases == ["BACKOFF", "BACKOFF"]
+
+
+def test_session_fails_after_the_last_connection_attempt():
+    async def session(adapter):
+        raise BleConnectionError("sin respuesta")
+
+    async def scenario():
+        scheduler = BleTransferScheduler(["hci0"], 1, max_connect_attempts=2, backoff_base_s=0.01)
+        await scheduler.submit(FakeJob(), "fw", "device", session)
+
+    with pytest.raises(BleConnectionError):
+        asyncio.run(scenario())
+
+
+def test_cancelled_session_leaves_the_queue():
+    started = []
+
+    async def slow_session(adapter):
+        started.append("slow")
+        await asyncio.sleep(0.05)
+
+    async def queued_session(adapter):
+        started.append("queued")
+
+    async def scenario():
+        scheduler = BleTransferScheduler(["hci0"], 1)
+        slow = asyncio.create_task(scheduler.submit(FakeJob(), "fw", "a", slow_session))
+        queued = asyncio.create_task(scheduler.submit(FakeJob(), "fw", "b", queued_session))
+        await asyncio.sleep(0.01)
+        assert scheduler.status()["queued_sessions"] == {"fw": 1}
+        queued.cancel()
+        await slow
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert scheduler.status()["queued_sessions"] == {}
+
+    asyncio.run(scenario())
+    assert started == ["slow"]
@@ -0,0 +1,108 @@
+import asyncio
+import os
+
+import ota_transfer_api as api
+from ota_transfer_api import TransferJob
+
+
+class FakePackage():
+
+    def __init__(self, content):
+        self.content = content
+        self.expected_size = len(content)
+
+    async def fragments(self, fragment_size):
+        for start in range(0, len(self.content), fragment_size):
+            yield self.content[start:start + fragment_size]
+
+
+class FakeBleDevice():
+    """
+    Cliente BLE simulado que responde como UpdatableBlePeripheral en el modo por
+    ventanas. Los fragmentos con las secuencias de lost_seqs se pierden la primera vez.
+    """
+
+    def __init__(self, mtu_size, lost_seqs=()):
+        self.mtu_size = mtu_size
+        self.lost_seqs = set(lost_seqs)
+        self.firmware = b""
+        self.header = None
+        self.expected_seq = 0
+        self.gap_reported = False
+        self.notify = None
+
+    async def start_notify(self, uuid, callback):
+        assert uuid == api.FIRMWARE_ACK_CHARACTERISTIC_UUID
+        self.notify = callback
+
+    async def write_gatt_char(self, uuid, data, response):
+        assert uuid == api.FIRMWARE_FRAGMENT_CHARACTERISTIC_UUID
+        if self.header is None:
+            self.header = data
+            return
+        assert not response
+        seq = int.from_bytes(data[0:2], 'big')
+        if seq in self.lost_seqs:
+            self.lost_seqs.discard(seq)
+            return
+        if seq != self.expected_seq:
+            if not self.gap_reported:
+                self._ack(True)
+                self.gap_reported = True
+            return
+        self.gap_reported = False
+        self.firmware += data[2:]
+        self.expected_seq += 1
+        fw_size = int.from_bytes(self.header[0:4], 'big')
+        if self.expected_seq % self.header[5] == 0 or len(self.firmware) >= fw_size:
+            self._ack(False)
+
+    def _ack(self, gap):
+        data = self.expected_seq.to_bytes(2, 'big') + bytes([1 if gap else 0])
+        asyncio.get_running_loop().call_soon(self.notify, None, bytearray(data))
+
+
+def test_windowed_transfer_uses_the_mtu_and_recovers_lost_fragments():
+    content = os.urandom(5000)
+    device = FakeBleDevice(mtu_size=100, lost_seqs={3, 20})
+    job = TransferJob("BLE", "device", "fw", "v2")
+
+    asyncio.run(api.transfer_firmware_BLE_windowed(job, device, FakePackage(content)))
+
+    assert device.firmware == content
+    assert int.from_bytes(device.header[6:8], 'big') == 100 - 3 - 2
+    assert device.header[5] == api.BLE_WINDOW_SIZE
+    assert job.bytes_sent == len(content)
+    assert job.retries == 2
+
+
+def test_mtu_is_acquired_on_bluez():
+    class BleakClientBlueZDBus():
+        mtu_size = 23
+
+        async def _acquire_mtu(self):
+            self.mtu_size = 247
+
+    class Client():
+        _backend = BleakClientBlueZDBus()
+
+        @property
+        def mtu_size(self):
+            return self._backend.mtu_size
+
+    assert asyncio.run(api.negotiated_mtu(Client())) == 247
+
+
+def test_mtu_falls_back_to_the_public_value():
+    class BleakClientBlueZDBus():
+        pass
+
+    class Client():
+        _backend = BleakClientBlueZDBus()
+        mtu_size = 23
+
+    class OtherBackendClient():
+        mtu_size = 185
+
+    assert asyncio.run(api.negotiated_mtu(Client())) == 23
+    assert asyncio.run(api.negotiated_mtu(OtherBackendClient())) == 185
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import pytest
+
+import ota_transfer_api as api
+from ota_transfer_api import LoraFlow, TransferJob
+
+
+@pytest.fixture
+def published(monkeypatch):
+    published = []
+
+    async def publish_to_lora(topic, payload):
+        published.append((topic, payload))
+
+    monkeypatch.setattr(api, "publish_to_lora", publish_to_lora)
+    monkeypatch.setattr(api, "lora_flows", {})
+    monkeypatch.setattr(api, "lora_spreading_factors", {})
+    return published
+
+
+def test_flow_counts_json_overhead_and_resolves_in_order(published):
+    async def scenario():
+        flow = LoraFlow(TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2"))
+        await flow.publish("topic", b"\xf1" + bytes(99))
+        await flow.publish("topic", b'{"fw_query": 1}')
+        assert list(flow.pending) == [100, 15 + api.LORA_MESSAGE_OVERHEAD]
+        flow.on_delivery({"status": "ACKED", "bytes": 99})
+        assert list(flow.pending) == [15 + api.LORA_MESSAGE_OVERHEAD]
+        return flow
+
+    flow = asyncio.run(scenario())
+    assert flow.job.bytes_sent == 99
+
+
+def test_delivery_timeout_grows_with_queued_airtime(published):
+    async def scenario():
+        idle_timeout = api.lora_delivery_timeout()
+        flow = LoraFlow(TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2"))
+        api.lora_flows["a0b1c2d3e4f5"] = flow
+        for _ in range(10):
+            await flow.publish("topic", bytes(142))
+        sf7_timeout = api.lora_delivery_timeout()
+        api.lora_spreading_factors["a0b1c2d3e4f5"] = 12
+        return idle_timeout, sf7_timeout, api.lora_delivery_timeout()
+
+    idle_timeout, sf7_timeout, sf12_timeout = asyncio.run(scenario())
+    assert idle_timeout == api.LORA_DELIVERY_TIMEOUT_S
+    assert idle_timeout < sf7_timeout < sf12_timeout
+
+
+def test_drain_fails_when_the_bridge_stops_delivering(published, monkeypatch):
+    monkeypatch.setattr(api, "lora_delivery_timeout", lambda: 0.01)
+
+    async def scenario():
+        flow = LoraFlow(TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2"))
+        await flow.publish("topic", bytes(10))
+        await flow.publish("topic", bytes(10))
+        asyncio.get_running_loop().call_soon(flow.on_delivery, {"status": "ACKED", "bytes": 10})
+        with pytest.raises(RuntimeError):
+            await flow.drain()
+        assert len(flow.pending) == 1
+
+    asyncio.run(scenario())
+
+
+def test_report_timeout_starts_after_the_query_is_delivered(published, monkeypatch):
+    monkeypatch.setattr(api, "LORA_BITMAP_REPORT_TIMEOUT_S", 0.05)
+
+    async def scenario():
+        flow = LoraFlow(TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2"))
+        reports = asyncio.Queue()
+        await flow.publish("topic", bytes(100)) # Fragmento aún en la cola del puente
+        waiting = asyncio.create_task(api.wait_for_bitmap_report(flow, "topic", reports, 2))
+        # El puente tarda más que el plazo del informe en entregar fragmento y consulta
+        await asyncio.sleep(0.1)
+        assert json.loads(published[-1][1]) == {"fw_query": 2}
+        flow.on_delivery({"status": "ACKED", "bytes": 100})
+        await asyncio.sleep(0.1)
+        flow.on_delivery({"status": "ACKED"})
+        # Los informes de rondas anteriores se descartan
+        reports.put_nowait({"round": 1, "from": 0, "bitmap": ""})
+        reports.put_nowait({"round": 2, "from": 3, "bitmap": ""})
+        return await waiting
+
+    assert asyncio.run(scenario()) == {"round": 2, "from": 3, "bitmap": ""}
+
+
+def test_completion_report_skips_the_query(published):
+    async def scenario():
+        flow = LoraFlow(TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2"))
+        reports = asyncio.Queue()
+        reports.put_nowait({"round": 1, "from": 0, "bitmap": ""})
+        reports.put_nowait({"done": True})
+        return await api.wait_for_bitmap_report(flow, "topic", reports, 2)
+
+    assert asyncio.run(scenario()) == {"done": True}
+    assert published == []
@@ -0,0 +1,56 @@
+import pytest
+
+from lora_frames import (
+    FRAME_HEADER, FW_BLOCK_SIZE, FW_FRAGMENT_FRAME, FW_MULTICAST_FRAME, FW_PARITY_FRAME, MAX_FW_SIZE,
+    check_fw_size, encode_fw_fragment, encode_fw_parity, time_on_air
+)
+
+LORA_ID = "a0b1c2d3e4f5"
+
+
+def test_fragment_frame_layout():
+    frame = encode_fw_fragment(LORA_ID, 3, 3 * FW_BLOCK_SIZE, b"payload")
+    assert FRAME_HEADER.size == 14
+    assert FRAME_HEADER.unpack(frame[:FRAME_HEADER.size]) == \
+        (FW_FRAGMENT_FRAME, bytes.fromhex(LORA_ID), 0, 3, 96)
+    assert frame[FRAME_HEADER.size:] == b"payload"
+
+
+def test_multicast_frame_type():
+    frame = encode_fw_fragment(LORA_ID, 0, 0, b"x", FW_MULTICAST_FRAME)
+    assert frame[0] == FW_MULTICAST_FRAME
+
+
+def test_parity_frame_xors_fragments_padding_the_shorter_ones():
+    fragments = [bytes([0x0F] * 4), bytes([0xF0] * 4), bytes([0xFF] * 2)]
+    frame = encode_fw_parity(LORA_ID, 5, 5 * FW_BLOCK_SIZE, fragments)
+    frame_type, _, count, index, offset = FRAME_HEADER.unpack(frame[:FRAME_HEADER.size])
+    assert (frame_type, count, index, offset) == (FW_PARITY_FRAME, 3, 5, 160)
+    assert frame[FRAME_HEADER.size:] == bytes([0x00, 0x00, 0xFF, 0xFF])
+
+
+def test_last_addressable_block():
+    last_index = MAX_FW_SIZE // FW_BLOCK_SIZE - 1
+    frame = encode_fw_fragment(LORA_ID, last_index, last_index * FW_BLOCK_SIZE, b"x")
+    assert FRAME_HEADER.unpack(frame[:FRAME_HEADER.size])[3] == 0xFFFF
+
+
+@pytest.mark.parametrize("encode", [
+    lambda index: encode_fw_fragment(LORA_ID, index, index * FW_BLOCK_SIZE, b"x"),
+    lambda index: encode_fw_parity(LORA_ID, index, index * FW_BLOCK_SIZE, [b"x" * FW_BLOCK_SIZE]),
+])
+def test_block_index_overflow_is_an_error(encode):
+    with pytest.raises(ValueError):
+        encode(0x10000)
+
+
+def test_package_size_limit():
+    check_fw_size(MAX_FW_SIZE)
+    with pytest.raises(ValueError):
+        check_fw_size(MAX_FW_SIZE + 1)
+
+
+def test_time_on_air_matches_the_datasheet_formula():
+    # Valores de referencia de la calculadora de Semtech (BW 125 kHz, CR 4/5, preámbulo 8)
+    assert time_on_air(20, 7, 125, 5, 8) == pytest.approx(0.05658, abs=1e-5)
+    assert time_on_air(51, 12, 125, 5, 8) == pytest.approx(2.46579, abs=1e-5)
@@ -0,0 +1,110 @@
+import asyncio
+import base64
+import json
+import os
+
+import pytest
+
+import ota_transfer_api as api
+from lora_frames import FRAME_HEADER, FW_BLOCK_SIZE
+from ota_transfer_api import TransferJob, group_blocks, missing_blocks
+
+LORA_ID = "a0b1c2d3e4f5"
+
+
+def bitmap_report(received, first, block_count, repair_round):
+    """
+    Informe como los del nodo: bit i del mapa = bloque first + i recibido.
+    """
+    bitmap = bytearray((block_count - first + 7) // 8)
+    for block in received:
+        if block >= first:
+            bitmap[(block - first) // 8] |= 1 << ((block - first) % 8)
+    return {"from": first, "bitmap": base64.b64encode(bitmap).decode(), "round": repair_round}
+
+
+def test_missing_blocks_from_bitmap():
+    report = bitmap_report({0, 1, 3, 9}, 0, 10, 1)
+    assert missing_blocks(report, 10) == [2, 4, 5, 6, 7, 8]
+
+
+def test_missing_blocks_ignores_padding_bits_past_the_end():
+    report = bitmap_report({4}, 4, 6, 1)
+    assert missing_blocks(report, 6) == [5]
+
+
+def test_empty_bitmap_means_nothing_received_from_the_first_block():
+    assert missing_blocks({"from": 7, "bitmap": ""}, 10) == [7, 8, 9]
+
+
+def test_group_blocks_merges_consecutive_blocks_up_to_the_fragment_size():
+    assert group_blocks([0, 1, 2, 3, 4, 7, 8, 10], 3) == [(0, 3), (3, 2), (7, 2), (10, 1)]
+    assert group_blocks([], 4) == []
+
+
+class FakePackage():
+
+    def __init__(self, content):
+        self.content = content
+        self.expected_size = len(content)
+
+    async def read_range(self, offset, size):
+        return self.content[offset:offset + size]
+
+
+class SimulatedNode():
+    """
+    Nodo LoRa simulado tras el puente: cada envío se entrega en orden y se confirma al
+    momento, salvo los fragmentos que se pierden en la primera pasada.
+    """
+
+    def __init__(self, fw_size, lost_blocks):
+        self.firmware = bytearray(fw_size)
+        self.block_count = (fw_size + FW_BLOCK_SIZE - 1) // FW_BLOCK_SIZE
+        self.received = set()
+        self.lost_blocks = set(lost_blocks)
+        self.queries = []
+        self.fragments = []
+
+    async def publish(self, topic, payload):
+        if payload.startswith(b'{'):
+            message = json.loads(payload)
+            if "fw_query" in message:
+                self.queries.append(message["fw_query"])
+                self.report(message["fw_query"])
+        else:
+            _, _, _, index, offset = FRAME_HEADER.unpack(payload[:FRAME_HEADER.size])
+            data = payload[FRAME_HEADER.size:]
+            self.fragments.append(index)
+            if index in self.lost_blocks:
+                self.lost_blocks.discard(index)
+            else:
+                self.firmware[offset:offset + len(data)] = data
+                self.received.update(range(index, index + (len(data) + FW_BLOCK_SIZE - 1) // FW_BLOCK_SIZE))
+        api.lora_flows[LORA_ID].on_delivery({"status": "ACKED", "bytes": len(payload)})
+
+    def report(self, repair_round):
+        if len(self.received) == self.block_count:
+            report = {"done": True}
+        else:
+            report = bitmap_report(self.received, min(set(range(self.block_count)) - self.received),
+                self.block_count, repair_round)
+        api.lora_bitmap_reports[LORA_ID].put_nowait(report)
+
+
+def test_transfer_repairs_only_the_missing_blocks(monkeypatch):
+    content = os.urandom(20 * FW_BLOCK_SIZE + 5)
+    node = SimulatedNode(len(content), lost_blocks={4, 12})
+    monkeypatch.setattr(api, "publish_to_lora", node.publish)
+    monkeypatch.setattr(api, "abort_lora_transfer", lambda *args: pytest.fail("transferencia abandonada"))
+    monkeypatch.setitem(api.lora_fragment_sizes, LORA_ID, 4 * FW_BLOCK_SIZE)
+    job = TransferJob("LoRa", LORA_ID, "fw", "v2")
+
+    asyncio.run(api.transfer_firmware_LoRa(job, LORA_ID, FakePackage(content)))
+
+    assert bytes(node.firmware) == content
+    # Primera pasada (6 fragmentos) y reparación de los dos perdidos (4 bloques cada uno)
+    assert node.fragments == [0, 4, 8, 12, 16, 20, 4, 12]
+    assert node.queries == [1, 2]
+    assert job.retries == 2
+    assert LORA_ID not in api.lora_flows and LORA_ID not in api.lora_bitmap_reports
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+import ota_transfer_api as api
+from lora_frames import FRAME_HEADER, FW_BLOCK_SIZE, FW_MULTICAST_FRAME, FW_PARITY_FRAME
+from ota_transfer_api import LoraFlow, TransferJob
+
+# Reconstrucción del lado del nodo (MicroPython), que debe entender las tramas del servicio
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "..", "..", "..", "devices", "micropython", "src", "lib"))
+from thingsboard_ota_helpers.fw_parity import parity_fragment_starts, recover_fragment
+
+GROUP_ID = "a1b1c2d3e4f5"
+
+
+class FakePackage():
+
+    def __init__(self, content):
+        self.content = content
+        self.expected_size = len(content)
+
+    async def read_range(self, offset, size):
+        return self.content[offset:offset + size]
+
+
+def first_pass_frames(monkeypatch, content, fragment_size, parity_group_size):
+    frames = []
+
+    async def publish_to_lora(topic, payload):
+        frames.append(FRAME_HEADER.unpack(payload[:FRAME_HEADER.size]) + (payload[FRAME_HEADER.size:],))
+
+    monkeypatch.setattr(api, "publish_to_lora", publish_to_lora)
+    monkeypatch.setattr(api, "LORA_PARITY_GROUP_SIZE", parity_group_size)
+    flow = LoraFlow(TransferJob("LoRa", GROUP_ID, "fw", "v2"))
+    asyncio.run(api.send_multicast_first_pass(flow, "topic", GROUP_ID, FakePackage(content), fragment_size))
+    return frames
+
+
+def node_accepts(index, offset, parity):
+    # Misma comprobación que UpdatableLoraNode._handle_fw_parity
+    return index * FW_BLOCK_SIZE == offset and len(parity) % FW_BLOCK_SIZE == 0
+
+
+@pytest.mark.parametrize("fw_size", [
+    8 * 96,          # Múltiplo del tamaño de fragmento
+    8 * 96 + 40,     # Último fragmento más corto, pero de varios bloques
+    4 * 96 + 5,      # Último tramo con fragmentos completos y uno final corto
+    3 * 96,          # Menos fragmentos que el tamaño de grupo
+])
+def test_each_lost_fragment_is_recovered_from_parity(monkeypatch, fw_size):
+    content = os.urandom(fw_size)
+    frames = first_pass_frames(monkeypatch, content, 96, 4)
+    parity_frames = [frame for frame in frames if frame[0] == FW_PARITY_FRAME]
+    assert parity_frames
+    for _, group, count, index, offset, parity in parity_frames:
+        assert group == bytes.fromhex(GROUP_ID)
+        assert node_accepts(index, offset, parity)
+        starts = parity_fragment_starts(offset, len(parity), count, fw_size)
+        assert len(starts) == count
+        for lost in starts:
+            recovered = recover_fragment(parity, (
+                content[start:start + len(parity)] for start in starts if start != lost
+            ))
+            end = min(lost + len(parity), fw_size)
+            assert bytes(recovered[:end - lost]) == content[lost:end]
+
+
+def test_no_parity_for_a_trailing_short_fragment_alone(monkeypatch):
+    content = os.urandom(4 * 96 + 5)
+    frames = first_pass_frames(monkeypatch, content, 96, 4)
+    assert [frame[0] for frame in frames] == [FW_MULTICAST_FRAME] * 4 + [FW_PARITY_FRAME, FW_MULTICAST_FRAME]
+
+
+def test_parity_can_be_disabled(monkeypatch):
+    content = os.urandom(1000)
+    frames = first_pass_frames(monkeypatch, content, 96, 0)
+    assert all(frame[0] == FW_MULTICAST_FRAME for frame in frames)
+    assert b"".join(frame[5] for frame in frames) == content
@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import os
+import zlib
+
+import pytest
+
+from package_cache import PackageCache, PackageFetchError, PackageKey
+
+
+def package_key(title, content, version="v1"):
+    return PackageKey(title, version, hashlib.sha256(content).hexdigest())
+
+
+class FakeFetch():
+    """
+    Descarga simulada: entrega el contenido en bloques, cediendo el control entre ellos.
+    """
+
+    def __init__(self, content, chunk_size=100):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self._chunks()
+
+    async def _chunks(self):
+        for start in range(0, len(self.content), self.chunk_size):
+            await asyncio.sleep(0)
+            yield self.content[start:start + self.chunk_size]
+
+
+async def read_all(entry, fragment_size=64):
+    return b"".join([fragment async for fragment in entry.fragments(fragment_size)])
+
+
+async def wait_cached(entry):
+    await entry._fetch_task
+
+
+def test_concurrent_gets_share_one_download(tmp_path):
+    content = os.urandom(1000)
+    key = package_key("fw", content)
+    fetch = FakeFetch(content)
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 10_000)
+        first = await cache.get(key, "SHA256", len(content), fetch)
+        second = await cache.get(key, "SHA256", len(content), fetch)
+        assert first is second
+        assert first.users == 2
+        assert await read_all(first) == content
+        assert await read_all(second, 300) == content
+
+    asyncio.run(scenario())
+    assert fetch.calls == 1
+
+
+def test_cached_package_is_served_without_downloading(tmp_path):
+    content = os.urandom(500)
+    key = package_key("fw", content)
+    fetch = FakeFetch(content)
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 10_000)
+        entry = await cache.get(key, "SHA256", len(content), fetch)
+        await wait_cached(entry)
+        cache.release(entry)
+        again = await cache.get(key, "SHA256", len(content), fetch)
+        assert again is entry
+        assert await again.read_range(100, 50) == content[100:150]
+
+    asyncio.run(scenario())
+    assert fetch.calls == 1
+
+
+def test_keys_with_the_same_checksum_do_not_share_partial_files(tmp_path):
+    content = os.urandom(3000)
+    fetch = FakeFetch(content, chunk_size=250)
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 100_000)
+        first = await cache.get(package_key("fw-a", content), "SHA256", len(content), fetch)
+        second = await cache.get(package_key("fw-b", content), "SHA256", len(content), fetch)
+        assert first.path != second.path
+        assert await read_all(first) == content
+        assert await read_all(second) == content
+        await wait_cached(first)
+        await wait_cached(second)
+        assert first.path == second.path
+
+    asyncio.run(scenario())
+    assert [name for name in os.listdir(tmp_path)] == [f"{hashlib.sha256(content).hexdigest()}.pkg"]
+
+
+def test_evicts_least_recently_used_package(tmp_path):
+    contents = [os.urandom(400) for _ in range(3)]
+    keys = [package_key(f"fw-{i}", content) for i, content in enumerate(contents)]
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 1000)
+        entries = []
+        for key, content in zip(keys, contents):
+            entry = await cache.get(key, "SHA256", len(content), FakeFetch(content))
+            await wait_cached(entry)
+            cache.release(entry)
+            entries.append(entry)
+        return cache, entries
+
+    cache, entries = asyncio.run(scenario())
+    assert list(cache._entries) == keys[1:]
+    assert not os.path.exists(entries[0].path)
+    assert all(os.path.exists(entry.path) for entry in entries[1:])
+
+
+def test_package_in_use_is_not_evicted(tmp_path):
+    contents = [os.urandom(400) for _ in range(4)]
+    keys = [package_key(f"fw-{i}", content) for i, content in enumerate(contents)]
+
+    async def cache_package(cache, key, content):
+        entry = await cache.get(key, "SHA256", len(content), FakeFetch(content))
+        await wait_cached(entry)
+        cache.release(entry)
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 1000)
+        pinned = await cache.get(keys[0], "SHA256", len(contents[0]), FakeFetch(contents[0]))
+        await wait_cached(pinned)
+        for key, content in zip(keys[1:3], contents[1:3]):
+            await cache_package(cache, key, content)
+        assert list(cache._entries) == [keys[0], keys[2]]
+        # Una vez liberado vuelve a ser el primero en expulsarse
+        cache.release(pinned)
+        await cache_package(cache, keys[3], contents[3])
+        assert list(cache._entries) == [keys[2], keys[3]]
+
+    asyncio.run(scenario())
+
+
+def test_checksum_mismatch_fails_readers_and_is_not_cached(tmp_path):
+    content = os.urandom(600)
+    key = PackageKey("fw", "v1", "00" * 32)
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 10_000)
+        entry = await cache.get(key, "SHA256", len(content), FakeFetch(content))
+        with pytest.raises(PackageFetchError):
+            await read_all(entry)
+        assert key not in cache._entries
+        assert key not in cache._in_flight
+
+    asyncio.run(scenario())
+    assert os.listdir(tmp_path) == []
+
+
+def test_size_mismatch_is_an_error(tmp_path):
+    content = os.urandom(600)
+    key = package_key("fw", content)
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 10_000)
+        entry = await cache.get(key, "SHA256", len(content) + 1, FakeFetch(content))
+        await wait_cached(entry)
+        assert isinstance(entry.error, PackageFetchError)
+
+    asyncio.run(scenario())
+
+
+def test_crc32_checksum(tmp_path):
+    content = os.urandom(700)
+    key = PackageKey("fw", "v1", f"{zlib.crc32(content):08x}")
+
+    async def scenario():
+        cache = PackageCache(str(tmp_path), 10_000)
+        entry = await cache.get(key, "CRC32", len(content), FakeFetch(content))
+        assert await read_all(entry) == content
+        await wait_cached(entry)
+        assert entry.complete
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import os
+
+import httpx
+import pytest
+
+import ota_transfer_api as api
+from package_cache import PackageCache, PackageFetchError
+
+
+class FakeThingsboard():
+    """
+    API REST de Thingsboard simulada: atributos del dispositivo y descarga del paquete,
+    que se entrega en varios bloques.
+    """
+
+    def __init__(self, content, attributes=None, package_status=200):
+        self.content = content
+        self.attributes = attributes if attributes is not None else {
+            "fw_checksum": hashlib.sha256(content).hexdigest(),
+            "fw_checksum_algorithm": "SHA256",
+            "fw_size": len(content),
+        }
+        self.package_status = package_status
+        self.package_requests = 0
+
+    def handler(self, request):
+        if request.url.path.endswith("/attributes"):
+            return httpx.Response(200, json={"shared": self.attributes})
+        self.package_requests += 1
+        return httpx.Response(self.package_status, content=self._chunks())
+
+    async def _chunks(self):
+        for start in range(0, len(self.content), 1000):
+            await asyncio.sleep(0)
+            yield self.content[start:start + 1000]
+
+
+@pytest.fixture
+def thingsboard(monkeypatch, tmp_path):
+    server = FakeThingsboard(os.urandom(4500))
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(api.httpx, "AsyncClient",
+        lambda: async_client(transport=httpx.MockTransport(server.handler)))
+    monkeypatch.setattr(api, "package_cache", PackageCache(str(tmp_path), 100_000))
+    return server
+
+
+async def read_all(package):
+    return b"".join([fragment async for fragment in package.fragments(128)])
+
+
+def test_package_is_streamed_into_the_cache_once(thingsboard):
+    async def scenario():
+        first = await api.retrieve_ota_package("token", "fw", "v2")
+        second = await api.retrieve_ota_package("token", "fw", "v2")
+        contents = await asyncio.gather(read_all(first), read_all(second))
+        api.package_cache.release(first)
+        api.package_cache.release(second)
+        return contents
+
+    assert asyncio.run(scenario()) == [thingsboard.content] * 2
+    assert thingsboard.package_requests == 1
+
+
+def test_download_error_reaches_the_reader(thingsboard):
+    thingsboard.package_status = 404
+
+    async def scenario():
+        package = await api.retrieve_ota_package("token", "fw", "v2")
+        with pytest.raises(PackageFetchError):
+            await read_all(package)
+
+    asyncio.run(scenario())
+
+
+def test_missing_firmware_attributes(thingsboard):
+    del thingsboard.attributes["fw_size"]
+    with pytest.raises(PackageFetchError):
+        asyncio.run(api.retrieve_ota_package("token", "fw", "v2"))
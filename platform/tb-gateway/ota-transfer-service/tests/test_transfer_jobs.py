@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+from fastapi import HTTPException
+
+import ota_transfer_api as api
+from ota_transfer_api import TransferJob
+
+
+@pytest.fixture(autouse=True)
+def transfer_jobs(monkeypatch):
+    jobs = OrderedDict()
+    monkeypatch.setattr(api, "transfer_jobs", jobs)
+    return jobs
+
+
+def test_job_records_progress_and_phases():
+    job = TransferJob("BLE", "device", "fw", "v2")
+    job.enter_phase("FETCHING")
+    job.enter_phase("TRANSFERRING")
+    job.total_bytes = 1000
+    job.record_fragment(100)
+    job.record_fragment(150)
+    job.record_retry()
+    status = job.status()
+    assert status["state"] == "TRANSFERRING"
+    assert status["bytes_sent"] == 250
+    assert status["fragments_sent"] == 2
+    assert status["retries"] == 1
+    assert status["eta_s"] is not None
+    assert set(status["phase_durations_s"]) == {"QUEUED", "FETCHING", "TRANSFERRING"}
+
+
+def test_lora_progress_counts_only_resolved_fragments():
+    job = TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2")
+    job.record_delivery({"status": "ACKED", "bytes": 96})
+    job.record_delivery({"status": "SENT", "bytes": 64})
+    job.record_delivery({"status": "DROPPED", "bytes": 96})
+    job.record_delivery({"status": "ACKED", "bytes": 0})
+    assert (job.bytes_sent, job.fragments_sent) == (160, 2)
+
+
+def test_finished_job_has_no_eta():
+    job = TransferJob("BLE", "device", "fw", "v2")
+    job.enter_phase("TRANSFERRING")
+    job.total_bytes = 1000
+    job.record_fragment(100)
+    job.enter_phase("DONE")
+    status = job.status()
+    assert status["eta_s"] is None
+    assert status["finished_at"] is not None
+
+
+def test_jobs_run_in_background_until_a_final_state(transfer_jobs):
+    async def transfer_ok(job):
+        job.enter_phase("TRANSFERRING")
+        await asyncio.sleep(0)
+
+    async def transfer_error(job):
+        raise RuntimeError("sin respuesta")
+
+    async def scenario():
+        done_job = TransferJob("BLE", "a", "fw", "v2")
+        failed_job = TransferJob("BLE", "b", "fw", "v2")
+        response = api.submit_transfer_job(done_job, transfer_ok(done_job))
+        assert response == {"job_id": done_job.id, "state": "QUEUED"}
+        api.submit_transfer_job(failed_job, transfer_error(failed_job))
+        await asyncio.gather(done_job.task, failed_job.task)
+        return done_job, failed_job
+
+    done_job, failed_job = asyncio.run(scenario())
+    assert done_job.state == "DONE"
+    assert failed_job.state == "FAILED"
+    assert failed_job.error == "(RuntimeError) sin respuesta"
+    assert list(transfer_jobs) == [done_job.id, failed_job.id]
+
+
+def test_job_endpoints_list_query_and_cancel(transfer_jobs):
+    async def endless_transfer():
+        await asyncio.Event().wait()
+
+    async def scenario():
+        running = TransferJob("LoRa", "a0b1c2d3e4f5", "fw", "v2")
+        finished = TransferJob("BLE", "b", "fw", "v2")
+        api.submit_transfer_job(running, endless_transfer())
+        api.submit_transfer_job(finished, asyncio.sleep(0))
+        await finished.task
+        assert [job["job_id"] for job in await api.list_transfer_jobs(state="DONE")] == [finished.id]
+        assert (await api.transfer_job_status(running.id))["state"] == "QUEUED"
+        await api.cancel_transfer_job(running.id)
+        await asyncio.gather(running.task)
+        assert running.state == "CANCELLED"
+        # Cancelar un trabajo terminado no lo modifica
+        assert (await api.cancel_transfer_job(finished.id))["state"] == "DONE"
+        with pytest.raises(HTTPException) as error:
+            await api.transfer_job_status("desconocido")
+        assert error.value.status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_oldest_finished_jobs_are_forgotten(transfer_jobs, monkeypatch):
+    monkeypatch.setattr(api, "MAX_FINISHED_JOBS", 2)
+
+    async def scenario():
+        jobs = []
+        for device in "abcd":
+            job = TransferJob("BLE", device, "fw", "v2")
+            api.submit_transfer_job(job, asyncio.sleep(0))
+            await job.task
+            jobs.append(job)
+        return jobs
+
+    jobs = asyncio.run(scenario())
+    # La limpieza se hace al encolar: el último trabajo aún no había terminado
+    assert list(transfer_jobs) == [job.id for job in jobs[1:]]